@@ -0,0 +1,377 @@
+"""
+このファイルは、プロセス全体で共有するキャッシュ（クエリの埋め込みベクトル等）が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import time
+import atexit
+import asyncio
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def normalize_query(query):
+    """
+    キャッシュのキーとして使うため、ユーザー入力値を正規化
+
+    Args:
+        query: ユーザー入力値
+
+    Returns:
+        NFKC正規化（全角/半角の統一）・前後の空白除去・連続する空白の集約を行った文字列
+    """
+    query = unicodedata.normalize("NFKC", query)
+    return re.sub(r"\s+", " ", query).strip()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class QueryEmbeddingCache:
+    """
+    クエリの埋め込みベクトルを保持する、スレッドセーフなLRUキャッシュ
+
+    Streamlitのセッションをまたいでプロセス全体で共有し、
+    同じ質問が繰り返された場合は埋め込みAPIを呼ばずにベクトルを返す
+    """
+
+    def __init__(self, max_size, path=None):
+        self.max_size = max_size
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        # 前回の保存以降に追加されたエントリ数
+        self._unsaved = 0
+
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def get(self, query, namespace=""):
+        """
+        キャッシュ済みのベクトルを取得（存在しない場合はNone）
+        """
+        key = (namespace, normalize_query(query))
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self._misses += 1
+                return None
+            # 参照されたエントリを末尾（最近使用）に移動
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return vector
+
+    def put(self, query, vector, namespace=""):
+        """
+        ベクトルをキャッシュに追加（上限を超えた場合、最も長く使われていないエントリを削除）
+        """
+        key = (namespace, normalize_query(query))
+        with self._lock:
+            self._entries[key] = np.asarray(vector, dtype=np.float32)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._unsaved += 1
+            should_save = self.path and self._unsaved >= ct.QUERY_EMBEDDING_CACHE_SAVE_INTERVAL
+
+        if should_save:
+            self.save(self.path)
+
+    def get_or_compute(self, query, compute, namespace=""):
+        """
+        キャッシュ済みのベクトルを取得し、存在しない場合は計算してキャッシュに追加
+
+        Args:
+            query: ユーザー入力値
+            compute: 埋め込みベクトルを計算する関数（引数はユーザー入力値）
+            namespace: 埋め込みモデル名など、同じ入力値でもベクトルが異なる場合の区別に使う値
+
+        Returns:
+            埋め込みベクトル
+        """
+        vector = self.get(query, namespace)
+        if vector is None:
+            # 埋め込みAPIの呼び出し中は、他のスレッドをブロックしないようロックを保持しない
+            vector = compute(query)
+            self.put(query, vector, namespace)
+        return vector
+
+    async def aget_or_compute(self, query, acompute, namespace=""):
+        """
+        「get_or_compute」の非同期版（「acompute」は埋め込みベクトルを計算するコルーチン関数）
+
+        キャッシュの参照・追加はメモリ上で完結するため、イベントループ上でそのまま実行する
+        """
+        vector = self.get(query, namespace)
+        if vector is None:
+            vector = await acompute(query)
+            if self.path and self._unsaved + 1 >= ct.QUERY_EMBEDDING_CACHE_SAVE_INTERVAL:
+                # ファイルへの保存を伴う場合は、イベントループをブロックしないようスレッドで実行
+                await asyncio.to_thread(self.put, query, vector, namespace)
+            else:
+                self.put(query, vector, namespace)
+        return vector
+
+    def stats(self):
+        """
+        キャッシュの利用状況（件数・ヒット数・ミス数・ヒット率）を取得
+        """
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 4) if total else 0.0
+            }
+
+    def save(self, path):
+        """
+        キャッシュの内容をファイルに保存
+
+        埋め込みモデルによってベクトルの次元数が異なるため、次元数ごとに別の配列として保存する
+        キャッシュが保存できなくても動作に支障はないため、失敗した場合は呼び出し元に例外を伝えない
+        """
+        with self._lock:
+            keys = list(self._entries)
+            vectors = list(self._entries.values())
+            self._unsaved = 0
+
+        # 次元数 → キャッシュ内の位置（LRUの順）のリスト
+        groups = {}
+        for position, vector in enumerate(vectors):
+            groups.setdefault(vector.shape[-1], []).append(position)
+
+        arrays = {"group_count": np.array(len(groups))}
+        for i, positions in enumerate(groups.values()):
+            arrays[f"positions_{i}"] = np.array(positions, dtype=np.int64)
+            arrays[f"namespaces_{i}"] = np.array([keys[p][0] for p in positions], dtype=str)
+            arrays[f"queries_{i}"] = np.array([keys[p][1] for p in positions], dtype=str)
+            arrays[f"vectors_{i}"] = np.array([vectors[p] for p in positions], dtype=np.float32)
+
+        tmp_path = f"{path}.tmp.npz"
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # 書き込み途中のファイルを読み込まないよう、一時ファイルに保存してから置き換え
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"DEBUG: クエリ埋め込みキャッシュの保存エラー: {type(e).__name__}: {str(e)}")
+
+    def load(self, path):
+        """
+        ファイルに保存したキャッシュの内容を読み込み
+        """
+        try:
+            with np.load(path) as data:
+                if "group_count" in data.files:
+                    entries = []
+                    for i in range(int(data["group_count"])):
+                        entries.extend(zip(
+                            data[f"positions_{i}"], data[f"namespaces_{i}"], data[f"queries_{i}"], data[f"vectors_{i}"]
+                        ))
+                    # 保存時のLRUの順に戻す
+                    entries.sort(key=lambda entry: entry[0])
+                    entries = [entry[1:] for entry in entries]
+                else:
+                    # 次元数ごとに分けて保存する前の形式
+                    entries = list(zip(data["namespaces"], data["queries"], data["vectors"]))
+            with self._lock:
+                for namespace, query, vector in entries:
+                    self._entries[(str(namespace), str(query))] = vector
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        except Exception as e:
+            # キャッシュが読み込めなくても動作に支障はないため、空のキャッシュで続行
+            print(f"DEBUG: クエリ埋め込みキャッシュの読み込みエラー: {type(e).__name__}: {str(e)}")
+
+
+class AnswerCache:
+    """
+    LLMの回答（参照元ドキュメントを含む）を保持する、2段階のキャッシュ
+
+    1段階目は「モード・検索条件・正規化した入力値」の完全一致、
+    2段階目はクエリの埋め込みベクトルのコサイン類似度がしきい値以上の入力値で回答を再利用する
+    エントリは有効期限（TTL）とLRUで削除し、インデックスのバージョンが変わった時点ですべて破棄する
+    """
+
+    def __init__(self, max_size, ttl_seconds, similarity_threshold):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        # (モード, 検索条件, 正規化した入力値) → {"response", "vector", "created_at"}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._index_version = None
+        self._exact_hits = 0
+        self._semantic_hits = 0
+        self._misses = 0
+
+    def get(self, mode, query, index_version, params=(), vector=None, similarity_threshold=None):
+        """
+        キャッシュ済みの回答を取得
+
+        Args:
+            mode: 回答モード
+            query: ユーザー入力値
+            index_version: 現在のインデックスのバージョン
+            params: 回答に影響する検索条件（k, 絞り込み条件など）のタプル
+            vector: 正規化済みのクエリベクトル（指定した場合のみ類似度による検索を行う）
+            similarity_threshold: 類似度の下限（未指定の場合はキャッシュ作成時の設定値）
+
+        Returns:
+            (回答, ヒット種別「exact」「semantic」) のタプル（キャッシュにない場合はNone）
+        """
+        key = (mode, params, normalize_query(query))
+        now = time.monotonic()
+
+        with self._lock:
+            self._sync_version(index_version)
+            self._purge_expired(now)
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._exact_hits += 1
+                return entry["response"], "exact"
+
+            if vector is not None:
+                # 同じモード・検索条件の回答のうち、クエリベクトルが最も類似するものを1回の行列積で探す
+                candidates = [k for k, e in self._entries.items() if k[:2] == key[:2] and e["vector"] is not None]
+                if candidates:
+                    matrix = np.vstack([self._entries[k]["vector"] for k in candidates])
+                    similarities = matrix @ np.asarray(vector, dtype=np.float32).reshape(-1)
+                    best = int(np.argmax(similarities))
+                    threshold = self.similarity_threshold if similarity_threshold is None else similarity_threshold
+                    if similarities[best] >= threshold:
+                        self._entries.move_to_end(candidates[best])
+                        self._semantic_hits += 1
+                        return self._entries[candidates[best]]["response"], "semantic"
+
+            self._misses += 1
+            return None
+
+    def put(self, mode, query, index_version, response, params=(), vector=None):
+        """
+        回答をキャッシュに追加（上限を超えた場合、最も長く使われていないエントリを削除）
+        """
+        key = (mode, params, normalize_query(query))
+        with self._lock:
+            self._sync_version(index_version)
+            self._entries[key] = {
+                "response": response,
+                "vector": None if vector is None else np.asarray(vector, dtype=np.float32).reshape(-1),
+                "created_at": time.monotonic()
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        キャッシュの利用状況（件数・ヒット数・ミス数・ヒット率）を取得
+        """
+        with self._lock:
+            hits = self._exact_hits + self._semantic_hits
+            total = hits + self._misses
+            return {
+                "size": len(self._entries),
+                "exact_hits": self._exact_hits,
+                "semantic_hits": self._semantic_hits,
+                "misses": self._misses,
+                "hit_rate": round(hits / total, 4) if total else 0.0
+            }
+
+    def _sync_version(self, index_version):
+        # インデックスが更新された場合、古いインデックスに基づく回答はすべて破棄
+        if index_version != self._index_version:
+            self._entries.clear()
+            self._index_version = index_version
+
+    def _purge_expired(self, now):
+        # 追加順（≒古い順）に並んでいるとは限らないため、全件を確認して期限切れを削除
+        expired = [k for k, e in self._entries.items() if now - e["created_at"] > self.ttl_seconds]
+        for k in expired:
+            del self._entries[k]
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中の場合に、その結果を後続のリクエストと共有する仕組み（single-flight）
+
+    先行のリクエストが「start」で登録し、「finish」で結果を設定するまで、
+    後続のリクエストは「join」で受け取ったFutureを待つ
+    結果の代わりにNoneを設定した場合は、先行の処理が失敗・中断されたことを表す
+    共有のイベントループ上でのみ使用するため、ロックは使わない
+    """
+
+    def __init__(self):
+        # キー → 結果を受け取るFuture
+        self._flights = {}
+        self._leaders = 0
+        self._followers = 0
+
+    def join(self, key):
+        """
+        実行中の処理の結果を受け取るFutureを取得（実行中でない場合はNone）
+        """
+        future = self._flights.get(key)
+        if future is not None:
+            self._followers += 1
+        return future
+
+    def start(self, key):
+        """
+        処理の開始を登録
+
+        Returns:
+            結果を受け取るFuture（「finish」に渡す）
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._flights[key] = future
+        self._leaders += 1
+        return future
+
+    def finish(self, key, result, future):
+        """
+        処理の結果を設定し、待っているリクエストに共有（2回目以降の呼び出しは何もしない）
+
+        登録を取り除くのは、同じキーで後から開始された処理の登録でない場合のみ
+        """
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        if not future.done():
+            future.set_result(result)
+
+    def stats(self):
+        """
+        実行中の処理数と、先行・後続のリクエスト数を取得
+        """
+        return {"in_flight": len(self._flights), "leaders": self._leaders, "followers": self._followers}
+
+
+############################################################
+# プロセス全体で共有するキャッシュ
+############################################################
+query_embedding_cache = QueryEmbeddingCache(ct.QUERY_EMBEDDING_CACHE_SIZE, ct.QUERY_EMBEDDING_CACHE_PATH)
+sentence_embedding_cache = QueryEmbeddingCache(ct.SENTENCE_EMBEDDING_CACHE_SIZE)
+answer_cache = AnswerCache(ct.ANSWER_CACHE_SIZE, ct.ANSWER_CACHE_TTL_SECONDS, ct.ANSWER_CACHE_SIMILARITY_THRESHOLD)
+answer_flights = SingleFlight()
+
+# プロセス終了時に、未保存のエントリをファイルに保存
+if ct.QUERY_EMBEDDING_CACHE_PATH:
+    atexit.register(query_embedding_cache.save, ct.QUERY_EMBEDDING_CACHE_PATH)
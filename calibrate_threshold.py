@@ -0,0 +1,141 @@
+"""
+このファイルは、類似度のしきい値（INQUIRY_SCORE_THRESHOLD等）をラベル付きの質問から算出するコマンドです。
+
+使い方:
+    python calibrate_threshold.py labelled_queries.jsonl [--min-recall 0.95] [--k 15] [--search-type similarity]
+
+質問ごとのスコアは、画面からの問い合わせと同じ処理で算出する
+    - DOC_SEARCH_SCORE_THRESHOLD: 「社内文書検索」モードの検索結果（元の質問のみ）の最大の類似度
+    - INQUIRY_SCORE_THRESHOLD: 「社内問い合わせ」モードの候補（元の質問での、言い換え・再ランキング前の検索結果）の最大の類似度
+      （言い換えはこの判定を通過した質問にのみ行うため、言い換えた質問での検索結果は含めない）
+
+入力ファイルは1行に1件、以下の形式のJSONを記述する
+    {"query": "人事部に所属している従業員情報を一覧化して", "relevant": true}
+    {"query": "今日の天気は？", "relevant": false}
+「relevant」は、社内文書に回答の根拠となる情報が存在する質問かどうかを表す
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import sys
+import json
+import argparse
+from datetime import date
+import constants as ct
+from initialize import build_sharded_index
+from resources import run_async
+from retrieval import aretrieve
+from utils import aretrieve_inquiry_candidates
+
+
+############################################################
+# 関数定義
+############################################################
+
+def load_labelled_queries(path):
+    """
+    ラベル付きの質問をJSONLファイルから読み込み
+
+    Args:
+        path: JSONLファイルのパス
+
+    Returns:
+        (質問, 関連ありフラグ) のリスト
+    """
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                queries.append((item["query"], bool(item["relevant"])))
+    return queries
+
+
+def choose_threshold(scored, min_recall):
+    """
+    関連ありの質問の再現率を保ったまま、関連なしの質問を最も多く除外できるしきい値を選択
+
+    Args:
+        scored: (最大の類似度, 関連ありフラグ) のリスト
+        min_recall: 関連ありの質問のうち、しきい値以上となる割合の下限
+
+    Returns:
+        (しきい値, 関連ありの再現率, 関連なしの除外率)
+    """
+    relevant = [score for score, label in scored if label]
+    irrelevant = [score for score, label in scored if not label]
+
+    # 候補は、隣り合うスコアの中間値（スコアそのものだと同点の質問の扱いが不安定になるため）
+    scores = sorted({score for score, _ in scored})
+    candidates = [0.0] + [(a + b) / 2 for a, b in zip(scores, scores[1:])]
+
+    best = (0.0, 1.0, 0.0)
+    for threshold in candidates:
+        recall = sum(score >= threshold for score in relevant) / len(relevant) if relevant else 1.0
+        rejection = sum(score < threshold for score in irrelevant) / len(irrelevant) if irrelevant else 0.0
+        if recall >= min_recall and rejection > best[2]:
+            best = (threshold, recall, rejection)
+    return best
+
+
+def score_query(index, query, search_kwargs):
+    """
+    画面からの問い合わせと同じ処理で、質問の最大の類似度を回答モードごとに算出
+
+    Args:
+        index: 共有のインデックス
+        query: 質問
+        search_kwargs: 検索条件（k, search_type, folders, extensions）
+
+    Returns:
+        (「社内文書検索」モードの最大の類似度, 「社内問い合わせ」モードの最大の類似度)
+    """
+    vector = run_async(index.aembed_query(query))
+    doc_results = run_async(aretrieve(index, vector, **search_kwargs))
+    inquiry_results = run_async(aretrieve_inquiry_candidates(index, vector, search_kwargs))
+    return (
+        max((score for _, score in doc_results), default=0.0),
+        max((score for _, score in inquiry_results), default=0.0)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ラベル付きの質問から、類似度のしきい値を算出します。")
+    parser.add_argument("path", help="ラベル付きの質問のJSONLファイル")
+    parser.add_argument("--min-recall", type=float, default=0.95, help="関連ありの質問がしきい値以上となる割合の下限")
+    parser.add_argument("--k", type=int, default=15, help="取得件数（画面のサイドバーの設定値と合わせる）")
+    parser.add_argument("--search-type", default=ct.DEFAULT_SEARCH_TYPE, choices=ct.SEARCH_TYPES, help="検索方法")
+    args = parser.parse_args()
+
+    queries = load_labelled_queries(args.path)
+    if not queries:
+        print("ラベル付きの質問がありません。")
+        sys.exit(1)
+
+    index, _ = build_sharded_index()
+    search_kwargs = {"k": args.k, "search_type": args.search_type, "folders": (), "extensions": ()}
+
+    doc_scored = []
+    inquiry_scored = []
+    for query, label in queries:
+        doc_score, inquiry_score = score_query(index, query, search_kwargs)
+        doc_scored.append((doc_score, label))
+        inquiry_scored.append((inquiry_score, label))
+        print(f"{doc_score:.4f}\t{inquiry_score:.4f}\t{'関連あり' if label else '関連なし'}\t{query}")
+
+    relevant_count = sum(label for _, label in queries)
+    print()
+    print(f"現在の設定値: DOC_SEARCH_SCORE_THRESHOLD = {ct.DOC_SEARCH_SCORE_THRESHOLD}, INQUIRY_SCORE_THRESHOLD = {ct.INQUIRY_SCORE_THRESHOLD}")
+    print("推奨値（constants.pyに、コメントとあわせて記録してください）:")
+    for name, scored in [("DOC_SEARCH_SCORE_THRESHOLD", doc_scored), ("INQUIRY_SCORE_THRESHOLD", inquiry_scored)]:
+        threshold, recall, rejection = choose_threshold(scored, args.min_recall)
+        print(
+            f"# {date.today().isoformat()} 算出: 質問{len(queries)}件（関連あり{relevant_count}件）, "
+            f"k={args.k}, {args.search_type}, 再現率 {recall:.1%}, 除外率 {rejection:.1%}"
+        )
+        print(f"{name} = {threshold:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -57,6 +57,9 @@ def display_search_llm_response(llm_response):
     Returns:
         LLMからの回答を画面表示用に整形した辞書データ
     """
+    # 通常とは異なる方法で回答を用意した場合（時間内に検索が完了せず、過去の回答を代わりに返した等）は、注意書きを表示
+    if llm_response.get("notice"):
+        st.warning(llm_response["notice"], icon=ct.WARNING_ICON)
 
      # LLMからのレスポンスに参照元情報が入っており、かつ「該当資料なし」が回答として返された場合
     if llm_response["source_documents"] and llm_response["result"] != ct.NO_DOC_MATCH_ANSWER:
@@ -183,6 +186,9 @@ def display_search_llm_response(llm_response):
         content["mode"] = ct.ANSWER_MODE_1
         content["result"] = ct.NO_DOC_MATCH_MESSAGE
         content["no_file_path_flg"] = True
+
+    if llm_response.get("notice"):
+        content["notice"] = llm_response["notice"]
     
     return content
 
@@ -196,16 +202,25 @@ def display_contact_llm_response(llm_response):
     Returns:
         LLMからの回答を画面表示用に整形した辞書データ
     """
+    # ストリーミングの場合、検索済みの参照元を先に表示し、回答はトークンの到着に合わせて順次表示する
+    streaming = "result_stream" in llm_response
+
+    # 通常とは異なる方法で回答を用意した場合（LLMに接続できず、検索結果のみを返した等）は、注意書きを表示
+    if llm_response.get("notice"):
+        st.warning(llm_response["notice"], icon=ct.WARNING_ICON)
+
     # LLMからの回答を表示
-    st.markdown(llm_response["result"])
+    if not streaming:
+        st.markdown(llm_response["result"])
     
     print(f"DEBUG: 社内問い合わせモード開始")
     print(f"DEBUG: source_documents count: {len(llm_response.get('source_documents', []))}")
     
     # ユーザーの質問・要望に適切な回答を行うための情報が、社内文書のデータベースに存在しなかった場合
-    if llm_response["result"] != ct.INQUIRY_NO_MATCH_ANSWER:
+    if llm_response["result"] != ct.INQUIRY_NO_MATCH_ANSWER and llm_response["source_documents"]:
         # 区切り線を表示
-        st.divider()
+        if not streaming:
+            st.divider()
 
         # 補足メッセージを表示
         message = "情報源"
@@ -250,6 +265,14 @@ def display_contact_llm_response(llm_response):
             # ファイル情報をリストに順次追加
             file_info_list.append(file_info)
 
+    if streaming:
+        # 参照元の下に区切り線を表示し、回答をトークン単位で表示（表示し終えた回答全体を会話ログに格納）
+        st.divider()
+        llm_response["result"] = st.write_stream(llm_response["result_stream"])
+        # 締め切りに達して回答を途中で打ち切った場合は、回答の下に注意書きを表示
+        if llm_response.get("notice"):
+            st.warning(llm_response["notice"], icon=ct.WARNING_ICON)
+
     # 表示用の会話ログに格納するためのデータを用意
     # - 「mode」: モード（「社内文書検索」or「社内問い合わせ」）
     # - 「answer」: LLMからの回答
@@ -258,8 +281,10 @@ def display_contact_llm_response(llm_response):
     content = {}
     content["mode"] = ct.ANSWER_MODE_2
     content["result"] = llm_response["result"]
+    if llm_response.get("notice"):
+        content["notice"] = llm_response["notice"]
     # 参照元のドキュメントが取得できた場合のみ
-    if llm_response["result"] != ct.INQUIRY_NO_MATCH_ANSWER:
+    if llm_response["result"] != ct.INQUIRY_NO_MATCH_ANSWER and llm_response["source_documents"]:
         content["message"] = message
         content["file_info_list"] = file_info_list
 
@@ -278,6 +303,45 @@ def display_sidebar():
     with st.sidebar:        
         # モード選択をサイドバーに移動
         display_sidebar_mode_selection()
+        # 検索対象の絞り込み
+        display_sidebar_search_filter()
+
+def display_sidebar_search_filter():
+    """
+    サイドバーでの検索対象（フォルダ・ファイル形式）の絞り込みを表示
+    """
+    # インデックスの作成に失敗している場合は、絞り込み条件を表示しない
+    if 'index' not in st.session_state:
+        return
+
+    index = st.session_state.index
+    folders = index.folders()
+    extensions = index.extensions()
+
+    st.markdown("---")
+    st.markdown("## 検索対象の絞り込み")
+
+    # 未選択の場合は、すべての社内文書を検索対象とする
+    st.session_state.search_folders = st.multiselect(
+        "フォルダ",
+        folders,
+        default=[f for f in getattr(st.session_state, 'search_folders', []) if f in folders],
+        help="選択したフォルダ（配下のフォルダを含む）の文書のみを検索します。未選択の場合はすべての文書が対象です。"
+    )
+    st.session_state.search_extensions = st.multiselect(
+        "ファイル形式",
+        extensions,
+        default=[e for e in getattr(st.session_state, 'search_extensions', []) if e in extensions],
+        help="選択したファイル形式の文書のみを検索します。未選択の場合はすべての形式が対象です。"
+    )
+    current_type = getattr(st.session_state, 'search_type', ct.DEFAULT_SEARCH_TYPE)
+    st.session_state.search_type = st.selectbox(
+        "検索方法",
+        ct.SEARCH_TYPES,
+        index=ct.SEARCH_TYPES.index(current_type) if current_type in ct.SEARCH_TYPES else 0,
+        format_func=lambda search_type: ct.SEARCH_TYPE_LABELS.get(search_type, search_type),
+        help="「件数を自動調整」では関連性の高い文書がはっきりしている質問で参照する件数を減らし、「多様性を考慮」では同じファイルの似た内容のチャンクが並ばないように選びます。"
+    )
                 
 def display_sidebar_mode_selection():
     """
@@ -25,6 +25,7 @@ LINK_SOURCE_ICON = ":material/link: "
 WARNING_ICON = ":material/warning:"
 ERROR_ICON = ":material/error:"
 SPINNER_TEXT = "回答生成中..."
+QUEUE_STATUS_TEXT = "回答の順番待ち中です（{position}番目、目安: 約{eta}秒）"
 
 
 # ==========================================
@@ -43,6 +44,48 @@ LOG_FILE = "app.log"
 # ==========================================
 MODEL = "gpt-4o-mini"
 TEMPERATURE = 0.5
+# 「社内問い合わせ」モードの回答生成に使うモデル
+ANSWER_MODEL = "gpt-3.5-turbo"
+ANSWER_TEMPERATURE = 0
+# 「社内問い合わせ」モードの回答を、トークン単位で画面に表示するかどうか
+ANSWER_STREAMING_ENABLED = True
+# OpenAI APIへの接続に使うHTTPコネクションプールの設定
+HTTP_MAX_CONNECTIONS = 50
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_TIMEOUT_SECONDS = 60
+# LLM呼び出しの流量制御（全セッション合計の同時実行数・1分あたりのトークン数の上限）
+LLM_MAX_CONCURRENCY = 8
+LLM_TOKENS_PER_MINUTE = 90000
+# トークン数の算出に使うエンコーディング
+TOKEN_ENCODING_NAME = "cl100k_base"
+# 回答のトークン数の見積もり（呼び出し前のトークン使用量の予約に使用）
+LLM_ESTIMATED_OUTPUT_TOKENS = 500
+# 1回の呼び出しにかかる時間の初期値（待ち時間の目安の算出に使用）
+LLM_INITIAL_SERVICE_SECONDS = 5
+# セッションごとのLLM呼び出し回数の上限（期間内の回数）
+SESSION_RATE_LIMIT_REQUESTS = 10
+SESSION_RATE_LIMIT_WINDOW_SECONDS = 60
+# 回答待ちの状況を画面に反映する間隔
+QUEUE_STATUS_POLL_SECONDS = 0.5
+# 埋め込み・LLM呼び出しのリトライ（ジッター付きの指数バックオフ）
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 8
+# ヘッジ（応答が直近の所要時間のp95を超えた場合に、同じ呼び出しをもう1件送る）
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_LATENCY_WINDOW = 200
+# サーキットブレーカー（連続失敗数がしきい値に達すると、一定時間は呼び出さずに即座に失敗させる）
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECONDS = 30
+# 回答を生成できない場合に、類似の質問への回答を代わりに返す際の類似度の下限
+FALLBACK_ANSWER_SIMILARITY_THRESHOLD = 0.85
+# 回答モードごとの、1回の質問にかける時間の上限（検索・生成・表示を含む秒数）
+# 上限までに生成が完了しない見込みの場合は、検索結果のみ、またはキャッシュ済みの回答を注意書き付きで返す
+REQUEST_DEADLINE_SECONDS = {
+    ANSWER_MODE_1: 10,
+    ANSWER_MODE_2: 45
+}
 
 # 問題2修正 start--------------------------------------------
 ############################################################
@@ -52,6 +95,43 @@ chunk_size_num = 500
 chunk_overlap_num = 50
 k_num = 5
 # 問題2修正 end----------------------------------------------
+# チャンク分割の区切り文字
+CHUNK_SEPARATOR = "\n"
+# 「社内問い合わせ」モードで、検索したチャンクを分割前のページ（親）の範囲に広げて文脈とする方法
+# （検索は小さなチャンクで行い、回答にはより広い範囲を使う。親のページは「pages.json」から取り出す）
+# - "window": チャンクの前後「PARENT_WINDOW_CHUNKS」個分のチャンクの範囲に広げる
+# - "parent": ページ全体に広げる（「PARENT_MAX_CHARS」を超える場合は、チャンクを中心にその文字数まで）
+# - "none": 広げない
+PARENT_CONTEXT_MODE = "window"
+PARENT_WINDOW_CHUNKS = 1
+PARENT_MAX_CHARS = 4000
+# プロンプトに埋め込む文脈（検索済みのドキュメント）のトークン数の上限（1回の呼び出しでまとめて回答する場合）
+CONTEXT_MAX_TOKENS = 3000
+# 「社内問い合わせ」モードの回答の生成方法
+# - "stuff": 文脈全体を1回の呼び出しで回答
+# - "map_reduce": 文脈のグループごとに回答に必要な情報を並列に抜き出し（map）、抜き出した情報から回答（reduce）
+# - "refine": 最初のグループで回答し、以降のグループで順に回答を改善
+# - "auto": 文脈全体のトークン数が「CONTEXT_MAX_TOKENS」以内ならstuff、グループが2つ以内ならrefine、それ以外はmap_reduce
+ANSWER_STRATEGY = "auto"
+# map_reduce・refineの場合の、文脈全体のトークン数の上限
+CONTEXT_MAX_TOTAL_TOKENS = 12000
+# map_reduce・refineの場合に、1回の呼び出しに含める文脈のトークン数の上限
+MAP_GROUP_MAX_TOKENS = 3000
+# 1回の質問あたりの、map呼び出しの同時実行数の上限
+MAP_MAX_CONCURRENCY = 4
+# チャンク分割時の位置の記録がないチャンクで、前後のチャンクの重複とみなす最小の文字数
+CONTEXT_MIN_OVERLAP_CHARS = 10
+# 文脈の圧縮（ドキュメントごとに、質問との類似度が高い文のみを残す）を行うかどうかと、残す文字数の割合
+CONTEXT_COMPRESSION_ENABLED = True
+CONTEXT_COMPRESSION_RATIO = 0.5
+# 文と質問の類似度の算出方法
+# - "embedding": 文の埋め込みベクトルとクエリベクトルのコサイン類似度（文の埋め込みはキャッシュして使い回す）
+# - "lexical": 文と質問の文字バイグラムの重なり（埋め込みAPIを呼ばない）
+CONTEXT_COMPRESSION_METHOD = "embedding"
+# 圧縮の対象とする最小の文数（文の数が少ないドキュメントはそのまま使う）
+CONTEXT_COMPRESSION_MIN_SENTENCES = 3
+# 文の区切り（句点・感嘆符・疑問符の直後と改行）
+SENTENCE_SPLIT_PATTERN = r"(?<=[。！？!?])|\n"
 
 # ==========================================
 # RAG参照用のデータソース系
@@ -66,6 +146,141 @@ SUPPORTED_EXTENSIONS = {
 WEB_URL_LOAD_TARGETS = [
     "https://generative-ai.web-camp.io/"
 ]
+# Webページから読み込んだデータを、絞り込み検索時に1つのフォルダとして扱う際の表示名
+WEB_FOLDER_LABEL = "Web"
+
+
+# ==========================================
+# インデックス（シャード）系
+# ==========================================
+# データフォルダ直下のフォルダごとにシャードを作成し、以下のフォルダに保存
+INDEX_DIR_PATH = "index"
+SHARD_MANIFEST_FILE = "manifest.json"
+SHARD_PAGES_FILE = "pages.json"
+# データフォルダ直下に置かれたファイルをまとめるシャード名
+ROOT_SHARD_NAME = "_root"
+# シャードへの並列検索に使うスレッド数
+SHARD_SEARCH_MAX_WORKERS = 8
+# チャンクの作成方法を変更した場合に値を上げ、保存済みのシャードを再作成させる
+INDEX_SCHEMA_VERSION = 3
+# 元ファイルが更新されていなくても再作成させるシャード名を、カンマ区切りで指定する環境変数（"*"の場合はすべて）
+# 例: FORCE_REBUILD_SHARDS=人事部,総務部 streamlit run main.py
+FORCE_REBUILD_SHARDS_ENV = "FORCE_REBUILD_SHARDS"
+# フォルダごとの重心ベクトルで検索対象のフォルダを絞り込む（ルーティング）かどうか
+ROUTING_ENABLED = True
+# 候補のフォルダ数がこの値以下の場合は、ルーティングせずに全件検索
+ROUTING_MIN_FOLDERS = 20
+# ルーティングで選択するフォルダ数
+ROUTING_TOP_FOLDERS = 3
+# 「社内文書検索」モードで、関連する文書とみなすコサイン類似度の下限（すべて下回る場合は「該当資料なし」）
+DOC_SEARCH_SCORE_THRESHOLD = 0.78
+# 「社内問い合わせ」モードで、最大のコサイン類似度がこの値を下回る場合はLLMを呼ばずに「情報なし」と回答
+# 最大のコサイン類似度は、元の質問での検索結果（言い換え・再ランキング前）の値（下回る場合は言い換えのLLM呼び出しも行わない）
+# 値は「python calibrate_threshold.py <ラベル付き質問のJSONLファイル>」で算出し、算出条件・結果をここに記録する
+# 現在の値は、ラベル付きの質問での算出を行う前の暫定値（DOC_SEARCH_SCORE_THRESHOLDも同様）
+INQUIRY_SCORE_THRESHOLD = 0.75
+
+
+# ==========================================
+# キャッシュ系
+# ==========================================
+# クエリの埋め込みベクトルのキャッシュ件数の上限
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+# クエリの埋め込みベクトルのキャッシュの保存先（Noneの場合は保存しない）
+QUERY_EMBEDDING_CACHE_PATH = "index/query_embeddings.npz"
+# 何件追加されるごとにキャッシュをファイルに保存するか
+QUERY_EMBEDDING_CACHE_SAVE_INTERVAL = 20
+# 文脈の圧縮に使う、文の埋め込みベクトルのキャッシュ件数の上限
+SENTENCE_EMBEDDING_CACHE_SIZE = 20000
+# LLMの回答のキャッシュ件数の上限
+ANSWER_CACHE_SIZE = 512
+# LLMの回答のキャッシュの有効期限（秒）
+ANSWER_CACHE_TTL_SECONDS = 60 * 60
+# 入力値が完全一致しない場合に、キャッシュ済みの回答を再利用するクエリベクトルのコサイン類似度の下限
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95
+
+
+# ==========================================
+# フレーズ検索系
+# ==========================================
+# 「社内文書検索」モードで、かぎ括弧・引用符で囲まれた入力をフレーズ検索の対象とする
+PHRASE_QUERY_PATTERN = r"[「『\"“](.+?)[」』\"”]"
+# 転置インデックスのn-gramの文字数（日本語を考慮し2文字単位）
+PHRASE_INDEX_NGRAM = 2
+
+
+# ==========================================
+# 会話履歴系
+# ==========================================
+# 質問の言い換えに、原文のまま使う直近のやりとりの件数（それより前のやりとりは要約して使う）
+CHAT_HISTORY_MAX_TURNS = 3
+# 会話の要約のトークン数の上限
+CHAT_SUMMARY_MAX_TOKENS = 300
+# 直前までの会話を前提とした質問とみなす入力（指示語・接続詞で始まる、前の話題を指す、「〜は？」だけの短い質問）
+# 該当しない入力は、会話履歴を使った言い換え（LLM呼び出し）を行わずにそのまま検索する
+FOLLOW_UP_PATTERN = (
+    r"^(それ|その|これ|この|あれ|あの|そこ|ここ|そう|では|じゃあ|で、|また|あと|ほか|他に|さらに|もっと|なぜ|どうして)"
+    r"|上記|前述|先ほど|さっき|それぞれ|詳しく|具体的に"
+    r"|^.{1,10}[はも][？?]$"
+)
+
+
+# ==========================================
+# クエリ拡張系
+# ==========================================
+# 「社内問い合わせ」モードで、ユーザー入力を別の表現に言い換えた質問でも検索し、結果を統合するかどうか
+QUERY_EXPANSION_ENABLED = True
+# 言い換えの数
+QUERY_EXPANSION_COUNT = 3
+# 言い換えの方法（"llm": LLMで言い換え、失敗した場合は規則で言い換える / "rule": 規則のみで言い換える）
+QUERY_EXPANSION_METHOD = "llm"
+# LLMでの言い換えを待つ秒数の上限（超えた場合は規則で言い換える）
+QUERY_EXPANSION_TIMEOUT_SECONDS = 5
+# 統合後の検索結果の件数の上限（言い換えで取りこぼしが減る分、少ない件数で足りる）
+QUERY_EXPANSION_FINAL_K = 8
+# Reciprocal Rank Fusion（各質問での順位 r に対し 1 / (RRF_K + r) を合計して統合）の定数
+RRF_K = 60
+# 規則での言い換えで取り除く、問いかけの表現
+QUERY_SUFFIX_PATTERN = (
+    r"(について|に関して|に関する|の)?(こと)?(を|は|が)?"
+    r"(教えて(ください|下さい)?|知りたい(です)?|とは(何|なん)(です|でしょう)か|はありますか|ありますか|ですか|でしょうか)?"
+    r"[?？。]*$"
+)
+# 規則での言い換えで使う、社内文書で使われる表現への置き換え
+QUERY_SYNONYMS = {
+    "有給": "年次有給休暇",
+    "休み": "休暇",
+    "給料": "給与",
+    "ボーナス": "賞与",
+    "ルール": "規程",
+    "規定": "規程",
+    "社員": "従業員",
+    "手続き": "申請",
+    "PC": "パソコン",
+    "在宅勤務": "テレワーク"
+}
+
+
+# ==========================================
+# 再ランキング系
+# ==========================================
+# 「社内問い合わせ」モードで、検索結果の候補を再ランキングしてから文脈を組み立てるかどうか
+RERANK_ENABLED = True
+# 再ランキングの方法（"lexical": 特徴量の重み付き和（オフラインで動作） / "cross_encoder": Cross-Encoderのモデル）
+RERANKER = "lexical"
+# 再ランキングの候補として検索する件数
+RERANK_FETCH_K = 20
+# 再ランキング後に残す件数（取得件数がこれより少ない場合は、取得件数と同じ）
+RERANK_TOP_N = 8
+# "lexical"の特徴量ごとの重み（ベクトルの類似度・本文の文字の重なり・ファイル名の文字の重なり）
+RERANK_LEXICAL_WEIGHTS = {
+    "vector": 0.6,
+    "lexical": 0.3,
+    "source": 0.1
+}
+# "cross_encoder"で使うモデル（sentence-transformersで読み込む）と、1回に採点する候補の数
+RERANK_CROSS_ENCODER_MODEL = "hotchpotch/japanese-reranker-cross-encoder-small-v1"
+RERANK_BATCH_SIZE = 32
 
 
 # ==========================================
@@ -73,6 +288,48 @@ WEB_URL_LOAD_TARGETS = [
 # ==========================================
 SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT = "会話履歴と最新の入力をもとに、会話履歴なしでも理解できる独立した入力テキストを生成してください。"
 
+SYSTEM_PROMPT_MAP = """
+    あなたは社内文書から情報を抜き出すアシスタントです。
+    以下の文脈から、ユーザー入力への回答に必要な情報のみを抜き出してください。
+
+    【条件】
+    1. 氏名・部署・日付・数値等の固有の情報は省略せずに抜き出してください。
+    2. 以下の文脈に関連する情報がない場合、「該当なし」とだけ回答してください。
+
+    【文脈】
+    {context}
+"""
+
+SYSTEM_PROMPT_REFINE = """
+    あなたは社内情報特化型のアシスタントです。
+    ユーザー入力に対する既存の回答を、以下の追加の文脈をもとに改善してください。
+
+    【条件】
+    1. 追加の文脈に回答に役立つ情報がある場合のみ、その情報を既存の回答に反映してください。
+    2. 追加の文脈が回答に役立たない場合、既存の回答をそのまま返してください。
+
+    【追加の文脈】
+    {context}
+"""
+
+SYSTEM_PROMPT_EXPAND_QUERY = """
+    あなたは社内文書の検索を支援するアシスタントです。
+    ユーザー入力の質問と同じ意味で、社内文書の検索に使える別の表現の質問を作成してください。
+
+    【条件】
+    1. 社内文書で使われそうな正式な用語・言い回しに置き換えてください。
+    2. 1行に1つずつ、質問のみを出力してください。
+"""
+
+SYSTEM_PROMPT_SUMMARIZE_HISTORY = """
+    あなたは会話の要約を作成するアシスタントです。
+    これまでの会話の要約と、その後の会話履歴をもとに、会話全体の要約を作成してください。
+
+    【条件】
+    1. 話題になった制度・手続き・文書名等の固有の情報は省略せずに残してください。
+    2. 要約のみを出力してください。
+"""
+
 SYSTEM_PROMPT_DOC_SEARCH = """
     あなたは社内の文書検索アシスタントです。
     以下の条件に基づき、ユーザー入力に対して回答してください。
@@ -107,6 +364,7 @@ SYSTEM_PROMPT_INQUIRY = """
 # ==========================================
 INQUIRY_NO_MATCH_ANSWER = "回答に必要な情報が見つかりませんでした。"
 NO_DOC_MATCH_ANSWER = "該当資料なし"
+MAP_NO_INFO_ANSWER = "該当なし"
 
 
 # ==========================================
@@ -121,6 +379,14 @@ NO_DOC_MATCH_MESSAGE = """
 CONVERSATION_LOG_ERROR_MESSAGE = "過去の会話履歴の表示に失敗しました。"
 GET_LLM_RESPONSE_ERROR_MESSAGE = "回答生成に失敗しました。"
 DISP_ANSWER_ERROR_MESSAGE = "回答表示に失敗しました。"
+# 回答を生成できなかった場合の注意書き（「{fallback}」の部分に、代わりに表示する内容が入る）
+LLM_UNAVAILABLE_NOTICE = "現在、回答生成サービスに接続しにくい状態のため、{fallback}を表示しています。"
+DEADLINE_EXCEEDED_NOTICE = "回答の生成が時間内に完了しない見込みのため、{fallback}を表示しています。"
+FALLBACK_CACHED_ANSWER_LABEL = "過去の類似した質問への回答"
+FALLBACK_SOURCES_LABEL = "関連する社内文書のみ"
+DEADLINE_TRUNCATED_NOTICE = "回答の生成が時間内に完了しなかったため、途中までの回答を表示しています。"
+UNAVAILABLE_ANSWER = "現在、回答を用意できませんでした。時間をおいて、再度お試しください。"
+RATE_LIMIT_MESSAGE = "短時間に多くの質問が送信されました。{retry_after}秒ほど待ってから、再度お試しください。"
 
 # ==========================================
 # サイドバー表示
@@ -137,4 +403,31 @@ MODE_DESCRIPTIONS = {
 # デフォルト設定
 DEFAULT_SEARCH_K = 3
 DEFAULT_SEARCH_TYPE = "similarity"
+# 検索時に指定できる検索方法
+# - "similarity": 類似度の高い順に、指定の件数を取得
+# - "adaptive": 類似度の高い順に取得した候補を、類似度の落ち込み方に応じた件数で打ち切る
+# - "mmr": 多めに取得した候補から、関連性が高く互いに重複の少ないチャンクを選ぶ（Maximal Marginal Relevance）
+SEARCH_TYPES = ["similarity", "adaptive", "mmr"]
+# サイドバーに表示する、検索方法の名称
+SEARCH_TYPE_LABELS = {
+    "similarity": "類似度順（件数固定）",
+    "adaptive": "類似度順（件数を自動調整）",
+    "mmr": "多様性を考慮（同じファイルの重複を抑える）"
+}
+# 「adaptive」の打ち切り方
+# - "gap": 隣り合う候補の類似度の差が最も大きい位置で打ち切る（差が「ADAPTIVE_K_MIN_GAP」未満の場合は打ち切らない）
+# - "relative": 最も高い類似度に対する比率が「ADAPTIVE_K_RELATIVE_THRESHOLD」を下回る候補を除く
+ADAPTIVE_K_METHOD = "gap"
+ADAPTIVE_K_MIN_GAP = 0.02
+ADAPTIVE_K_RELATIVE_THRESHOLD = 0.9
+# 「adaptive」で残す件数の下限・上限（候補は上限の件数まで取得し、打ち切った後に取得件数を超える分を除く）
+# 「社内問い合わせ」モードで再ランキング・クエリ拡張の候補を取得する場合は、候補の段階では打ち切らない
+ADAPTIVE_K_MIN = 2
+ADAPTIVE_K_MAX = 15
+# 「mmr」で取得する候補の件数（取得件数がこれより多い場合は、取得件数と同じ）
+MMR_FETCH_K = 30
+# 「mmr」の関連性と多様性の重み（1に近いほど関連性を、0に近いほど多様性を重視）
+MMR_LAMBDA = 0.5
+# 「mmr」で同じファイルから選ぶチャンクの件数の上限（Noneの場合は制限なし）
+MMR_MAX_PER_SOURCE = 2
 DEFAULT_SHOW_SOURCES = True
\ No newline at end of file
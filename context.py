@@ -0,0 +1,340 @@
+"""
+このファイルは、検索済みのドキュメントから、プロンプトに埋め込む文脈を組み立てる処理が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import asyncio
+import logging
+import numpy as np
+from langchain_core.documents import Document
+import constants as ct
+from phrase_index import normalize_text
+from resilience import TRANSIENT_ERRORS, CircuitOpenError
+
+
+############################################################
+# 関数定義
+############################################################
+
+def expand_to_parents(index, results, mode=ct.PARENT_CONTEXT_MODE):
+    """
+    検索結果のチャンクを、分割前のページ（親）の前後の範囲に広げる
+
+    広げた範囲の文書内の位置を「start_index」に記録するため、範囲が重なるチャンクは「pack_context」で1つにまとまる
+
+    Args:
+        index: 共有のインデックス（親のページの取得に使用）
+        results: (ドキュメント, 類似度) のリスト
+        mode: 広げ方（"window" / "parent" / "none"）
+
+    Returns:
+        (広げたドキュメント, 類似度) のリスト（親のページを参照できないチャンクはそのまま）
+    """
+    if mode == "none":
+        return results
+
+    expanded = []
+    for doc, score in results:
+        parent = index.get_parent(doc)
+        start = doc.metadata.get("start_index")
+        # チャンク分割時にページ内の位置を特定できなかったチャンクは、start_indexが-1になる
+        if parent is None or start is None or start < 0:
+            expanded.append((doc, score))
+            continue
+
+        text = parent.page_content
+        if mode == "parent" and len(text) <= ct.PARENT_MAX_CHARS:
+            window_start, window_end = 0, len(text)
+        else:
+            if mode == "parent":
+                margin = max((ct.PARENT_MAX_CHARS - len(doc.page_content)) // 2, 0)
+            else:
+                margin = ct.PARENT_WINDOW_CHUNKS * ct.chunk_size_num
+            window_start = max(start - margin, 0)
+            window_end = min(start + len(doc.page_content) + margin, len(text))
+
+        expanded.append((
+            Document(page_content=text[window_start:window_end], metadata={**doc.metadata, "start_index": window_start}),
+            score
+        ))
+    return expanded
+
+
+def pack_context(results, max_tokens=ct.CONTEXT_MAX_TOKENS):
+    """
+    検索結果のチャンクを、トークン数の上限以内の文脈に詰め直す
+
+    同じ文書・ページで隣り合うチャンクは1つの文章にまとめ、チャンク間の重複部分（chunk_overlap）を取り除く
+    まとめた文章は類似度の高い順に並べ、トークン数の上限に達した時点で打ち切る
+    （最初の文章だけで上限を超える場合は、上限のトークン数までに切り詰める）
+
+    Args:
+        results: (ドキュメント, 類似度) のリスト
+        max_tokens: 文脈のトークン数の上限
+
+    Returns:
+        文脈に含めるドキュメントのリスト（類似度の高い順）
+    """
+    from utils import count_tokens, truncate_tokens
+
+    # 同じ文書・ページのチャンクをまとめる（文書内の位置が分かる場合は、位置の順に並べる）
+    groups = {}
+    for doc, score in results:
+        groups.setdefault((doc.metadata.get("source"), doc.metadata.get("page")), []).append((doc, score))
+
+    passages = []
+    for chunks in groups.values():
+        if all(_has_position(doc) for doc, _ in chunks):
+            chunks = sorted(chunks, key=lambda item: item[0].metadata["start_index"])
+        passages.extend(merge_adjacent_chunks(chunks))
+    passages.sort(key=lambda item: item[1], reverse=True)
+
+    packed = []
+    used_tokens = 0
+    for doc, _ in passages:
+        tokens = count_tokens(doc.page_content)
+        if used_tokens + tokens > max_tokens:
+            if not packed:
+                doc = Document(page_content=truncate_tokens(doc.page_content, max_tokens), metadata=doc.metadata)
+                packed.append(doc)
+                used_tokens = count_tokens(doc.page_content)
+            break
+        packed.append(doc)
+        used_tokens += tokens
+
+    # 重複の除去・上限での打ち切りにより、削減できたプロンプトのトークン数をログ出力
+    original_tokens = sum(count_tokens(doc.page_content) for doc, _ in results)
+    logging.getLogger(ct.LOGGER_NAME).info({"context_packing": {
+        "chunks": len(results),
+        "passages": len(passages),
+        "packed": len(packed),
+        "tokens_before": original_tokens,
+        "tokens_after": used_tokens,
+        "tokens_saved": original_tokens - used_tokens
+    }})
+
+    return packed
+
+
+def merge_adjacent_chunks(chunks):
+    """
+    同じ文書・ページのチャンクのうち、隣り合うものを1つのドキュメントにまとめる
+
+    Args:
+        chunks: 同じ文書・ページの (ドキュメント, 類似度) のリスト（文書内の位置の順）
+
+    Returns:
+        (まとめたドキュメント, まとめたチャンクの最大の類似度) のリスト
+    """
+    merged = []
+    for doc, score in chunks:
+        if merged:
+            prev_doc, prev_score = merged[-1]
+            text = join_overlapping(prev_doc, doc)
+            if text is not None:
+                merged[-1] = (Document(page_content=text, metadata=prev_doc.metadata), max(prev_score, score))
+                continue
+        merged.append((doc, score))
+    return merged
+
+
+def join_overlapping(prev_doc, doc):
+    """
+    2つのチャンクが隣り合う（または重なる）場合に、重複部分を除いて連結した文章を返す
+
+    チャンク分割時に記録した文書内の位置（start_index）があればそれを使い、
+    ない場合（位置を記録する前に作成したシャード）は、前のチャンクの末尾と次のチャンクの先頭の一致で判定する
+
+    Args:
+        prev_doc: 前のチャンク
+        doc: 次のチャンク
+
+    Returns:
+        連結した文章（隣り合わない場合はNone）
+    """
+    prev_text = prev_doc.page_content
+    text = doc.page_content
+
+    if _has_position(prev_doc) and _has_position(doc):
+        prev_end = prev_doc.metadata["start_index"] + len(prev_text)
+        start = doc.metadata["start_index"]
+        # チャンクの区切り文字（改行）の分だけ離れている場合も、隣り合うものとみなす
+        if start > prev_end + len(ct.CHUNK_SEPARATOR):
+            return None
+        overlap = prev_end - start
+        if overlap <= 0:
+            return prev_text + ct.CHUNK_SEPARATOR + text
+        return prev_text + text[overlap:]
+
+    for size in range(min(len(prev_text), len(text), ct.chunk_overlap_num), ct.CONTEXT_MIN_OVERLAP_CHARS - 1, -1):
+        if prev_text.endswith(text[:size]):
+            return prev_text + text[size:]
+    return None
+
+
+def group_documents(docs, max_tokens=ct.MAP_GROUP_MAX_TOKENS):
+    """
+    文脈のドキュメントを、順番を保ったまま、グループごとのトークン数が上限以内になるようにまとめる
+
+    Args:
+        docs: 文脈のドキュメントのリスト
+        max_tokens: 1グループのトークン数の上限（1件で上限を超えるドキュメントは、単独のグループとする）
+
+    Returns:
+        ドキュメントのリストのリスト
+    """
+    from utils import count_tokens
+
+    groups = []
+    group_tokens = 0
+    for doc in docs:
+        tokens = count_tokens(doc.page_content)
+        if not groups or group_tokens + tokens > max_tokens:
+            groups.append([])
+            group_tokens = 0
+        groups[-1].append(doc)
+        group_tokens += tokens
+    return groups
+
+
+def choose_answer_strategy(context_tokens, group_count):
+    """
+    文脈全体のトークン数から、回答の生成方法を選ぶ
+
+    1回の呼び出しに収まる場合はstuff、グループが2つ以内の場合は、順に呼び出しても
+    map_reduce（並列のmap + reduce）と所要時間が変わらず呼び出し回数の少ないrefine、それ以外はmap_reduceとする
+
+    Args:
+        context_tokens: 文脈全体のトークン数
+        group_count: 文脈のグループ数
+
+    Returns:
+        "stuff" / "map_reduce" / "refine"
+    """
+    if context_tokens <= ct.CONTEXT_MAX_TOKENS:
+        return "stuff"
+    if group_count <= 2:
+        return "refine"
+    return "map_reduce"
+
+
+async def acompress_context(index, docs, query, query_vector, timeout=None):
+    """
+    文脈のドキュメントごとに、質問との類似度が高い文のみを残して圧縮する
+
+    各ドキュメントの文を類似度の高い順に選び、残した文字数が元の「CONTEXT_COMPRESSION_RATIO」に達した時点で打ち切る
+    （残した文は元の順に並べる）
+    文の埋め込みに失敗した場合（時間内に完了しない・埋め込みAPIに接続できない等）は、文字の重なりで類似度を算出する
+
+    Args:
+        index: 共有のインデックス（文の埋め込みに使用）
+        docs: 文脈のドキュメントのリスト
+        query: ユーザー入力値
+        query_vector: 正規化済みのクエリベクトル
+        timeout: 文の埋め込みを待つ秒数の上限（Noneの場合は制限なし）
+
+    Returns:
+        圧縮したドキュメントのリスト（文の数が少ないドキュメントはそのまま）
+    """
+    from utils import count_tokens
+
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    sentences_per_doc = [split_sentences(doc.page_content) for doc in docs]
+    targets = [
+        i for i, sentences in enumerate(sentences_per_doc)
+        if len(sentences) >= ct.CONTEXT_COMPRESSION_MIN_SENTENCES
+    ]
+    if not targets:
+        return docs
+    sentences = [sentence for i in targets for sentence in sentences_per_doc[i]]
+
+    scores = None
+    if ct.CONTEXT_COMPRESSION_METHOD == "embedding":
+        try:
+            matrix = await asyncio.wait_for(index.aembed_documents(sentences), timeout)
+            scores = matrix @ query_vector[0]
+        except (TimeoutError, CircuitOpenError, *TRANSIENT_ERRORS) as e:
+            logger.warning({"context_compression": "lexical_fallback", "error": type(e).__name__})
+    if scores is None:
+        scores = lexical_scores(sentences, query)
+
+    compressed = list(docs)
+    offset = 0
+    for i in targets:
+        count = len(sentences_per_doc[i])
+        kept = select_sentences(sentences_per_doc[i], scores[offset:offset + count], ct.CONTEXT_COMPRESSION_RATIO)
+        offset += count
+        compressed[i] = Document(page_content="\n".join(kept), metadata=docs[i].metadata)
+
+    tokens_before = sum(count_tokens(doc.page_content) for doc in docs)
+    tokens_after = sum(count_tokens(doc.page_content) for doc in compressed)
+    logger.info({"context_compression": {
+        "sentences": len(sentences),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after
+    }})
+
+    return compressed
+
+
+def split_sentences(text):
+    """
+    テキストを文に分割（空の文は除く）
+    """
+    return [sentence.strip() for sentence in re.split(ct.SENTENCE_SPLIT_PATTERN, text) if sentence.strip()]
+
+
+def lexical_scores(sentences, query):
+    """
+    文と質問の、文字バイグラムの集合のコサイン類似度を算出
+
+    Args:
+        sentences: 文のリスト
+        query: ユーザー入力値
+
+    Returns:
+        文ごとの類似度の配列
+    """
+    query_grams = _bigrams(query)
+    scores = []
+    for sentence in sentences:
+        grams = _bigrams(sentence)
+        if not grams or not query_grams:
+            scores.append(0.0)
+            continue
+        scores.append(len(grams & query_grams) / (len(grams) * len(query_grams)) ** 0.5)
+    return np.array(scores, dtype=np.float32)
+
+
+def select_sentences(sentences, scores, ratio):
+    """
+    類似度の高い順に、残した文字数が元の「ratio」に達するまで文を選ぶ（最低1文）
+
+    Returns:
+        選んだ文のリスト（元の順）
+    """
+    target = ratio * sum(len(sentence) for sentence in sentences)
+    kept = set()
+    length = 0
+    for i in np.argsort(-np.asarray(scores), kind="stable"):
+        if kept and length >= target:
+            break
+        kept.add(int(i))
+        length += len(sentences[i])
+    return [sentence for i, sentence in enumerate(sentences) if i in kept]
+
+
+def _has_position(doc):
+    # ページ内の位置（start_index）が記録されていて、位置を特定できたチャンクかどうか（特定できない場合は-1）
+    start = doc.metadata.get("start_index")
+    return start is not None and start >= 0
+
+
+def _bigrams(text):
+    text = normalize_text(text)
+    return {text[i:i + 2] for i in range(len(text) - 1)}
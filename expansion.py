@@ -0,0 +1,72 @@
+"""
+このファイルは、検索の取りこぼしを減らすため、ユーザー入力を別の表現の質問に言い換える処理（クエリ拡張）が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import constants as ct
+from cache import normalize_query
+
+
+############################################################
+# 関数定義
+############################################################
+
+def rule_based_paraphrases(query, count=ct.QUERY_EXPANSION_COUNT):
+    """
+    LLMを使わずに、規則に基づいてユーザー入力を言い換える（LLMで言い換えられない場合の代わり）
+
+    - 「〜について教えてください」等の問いかけの表現を除き、検索語だけにする
+    - 社内文書で使われる表現（「QUERY_SYNONYMS」）に置き換える
+
+    Args:
+        query: ユーザー入力値
+        count: 言い換えの最大数
+
+    Returns:
+        言い換えた質問のリスト（元の入力と同じものは含まない）
+    """
+    keywords = re.sub(ct.QUERY_SUFFIX_PATTERN, "", query.strip()).strip() or query.strip()
+
+    candidates = [keywords]
+    replaced = keywords
+    for word, synonym in ct.QUERY_SYNONYMS.items():
+        if word in replaced and synonym not in replaced:
+            replaced = replaced.replace(word, synonym)
+            candidates.append(replaced)
+
+    return unique_paraphrases(query, candidates, count)
+
+
+def parse_paraphrases(query, text, count=ct.QUERY_EXPANSION_COUNT):
+    """
+    LLMが出力した言い換え（1行に1つ）を取り出す
+
+    Args:
+        query: ユーザー入力値
+        text: LLMの出力
+        count: 言い換えの最大数
+
+    Returns:
+        言い換えた質問のリスト（元の入力と同じものは含まない）
+    """
+    # 行頭の箇条書きの記号・番号は除く
+    lines = [re.sub(r"^\s*(?:[-・*]|\d+[.)．、])\s*", "", line).strip() for line in text.splitlines()]
+    return unique_paraphrases(query, lines, count)
+
+
+def unique_paraphrases(query, candidates, count):
+    """
+    空の言い換え・元の入力や他の言い換えと同じもの（正規化後）を除き、最大「count」件を返す
+    """
+    seen = {normalize_query(query)}
+    paraphrases = []
+    for candidate in candidates:
+        key = normalize_query(candidate)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        paraphrases.append(candidate)
+    return paraphrases[:count]
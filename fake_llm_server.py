@@ -0,0 +1,206 @@
+"""
+このファイルは、OpenAI APIの代わりに応答するローカルの検証用サーバーです。
+
+LLM呼び出しの流量制御（同時実行数・待機順の表示等）や、障害時の動作（リトライ・ヘッジ等）を、
+実際のAPIを使わずに確認するために使用する
+
+使い方:
+    python fake_llm_server.py [--port 8765] [--latency 1.0] [--tokens-per-second 20] [--max-concurrency 4]
+
+アプリ側は、環境変数で接続先を切り替えて起動する
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=dummy streamlit run main.py
+
+「--max-concurrency」を超える同時リクエストには、OpenAI APIと同じく429（Too Many Requests）を返す
+
+障害を再現する場合は、以下の引数で一定割合のリクエストに障害を発生させる
+    --error-rate 0.3                      : 30%のリクエストに500（Internal Server Error）を返す
+    --slow-rate 0.1 --slow-latency 10     : 10%のリクエストの応答を、さらに10秒遅らせる
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+############################################################
+# 設定関連
+############################################################
+# 埋め込みベクトルの次元数
+EMBEDDING_DIMENSIONS = 256
+# チャットの回答として返す文章
+ANSWER_TEXT = "こちらは検証用サーバーからの回答です。社内文書の内容に基づいて回答しています。"
+
+
+############################################################
+# 関数定義
+############################################################
+
+def embed_text(text):
+    """
+    文字のバイグラムをハッシュで次元に割り当てた、正規化済みのベクトルを作成（同じ文章は常に同じベクトルになる）
+    """
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    for i in range(max(len(text) - 1, 1)):
+        gram = text[i:i + 2]
+        vector[int(hashlib.md5(gram.encode("utf-8")).hexdigest(), 16) % EMBEDDING_DIMENSIONS] += 1.0
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+############################################################
+# クラス定義
+############################################################
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    「/v1/chat/completions」（ストリーミング対応）と「/v1/embeddings」に応答するハンドラー
+    """
+
+    # サーバー起動時の引数で上書きする設定
+    latency = 1.0
+    tokens_per_second = 20.0
+    max_concurrency = 4
+    error_rate = 0.0
+    slow_rate = 0.0
+    slow_latency = 10.0
+    _in_flight = 0
+    _lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        with FakeOpenAIHandler._lock:
+            if FakeOpenAIHandler._in_flight >= self.max_concurrency:
+                over_limit = True
+            else:
+                over_limit = False
+                FakeOpenAIHandler._in_flight += 1
+        if over_limit:
+            print(f"429: 同時リクエスト数が上限（{self.max_concurrency}）を超えました: {self.path}")
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}})
+            return
+
+        try:
+            # 障害の注入（一定割合のリクエストを失敗させる・遅らせる）
+            if random.random() < self.error_rate:
+                print(f"500: 障害を注入しました: {self.path}")
+                self._send_json(500, {"error": {"message": "Injected failure", "type": "server_error"}})
+                return
+            if random.random() < self.slow_rate:
+                print(f"遅延: {self.slow_latency}秒の遅延を注入しました: {self.path}")
+                time.sleep(self.slow_latency)
+
+            if self.path.endswith("/chat/completions"):
+                self._chat_completions(body)
+            elif self.path.endswith("/embeddings"):
+                self._embeddings(body)
+            else:
+                self._send_json(404, {"error": {"message": f"Unknown path: {self.path}"}})
+        finally:
+            with FakeOpenAIHandler._lock:
+                FakeOpenAIHandler._in_flight -= 1
+
+    def _chat_completions(self, body):
+        time.sleep(self.latency)
+        model = body.get("model", "fake-model")
+        created = int(time.time())
+
+        if not body.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": ANSWER_TEXT},
+                    "finish_reason": "stop"
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(ANSWER_TEXT), "total_tokens": len(ANSWER_TEXT)}
+            })
+            return
+
+        # ストリーミングの場合、1文字ずつServer-Sent Eventsで返す
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i, char in enumerate(ANSWER_TEXT + "\0"):
+            last = char == "\0"
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {} if last else ({"role": "assistant", "content": char} if i == 0 else {"content": char}),
+                    "finish_reason": "stop" if last else None
+                }]
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if not last:
+                time.sleep(1 / self.tokens_per_second)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _embeddings(self, body):
+        inputs = body.get("input", [])
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        # トークンIDの配列で送られた場合も、文字列に変換して同じ方法でベクトル化
+        data = [
+            {"object": "embedding", "index": i, "embedding": embed_text(item if isinstance(item, str) else str(item))}
+            for i, item in enumerate(inputs)
+        ]
+        self._send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "fake-embedding"),
+            "usage": {"prompt_tokens": 0, "total_tokens": 0}
+        })
+
+    def _send_json(self, status, payload):
+        content = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} - {format % args}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI APIの代わりに応答する、ローカルの検証用サーバーを起動します。")
+    parser.add_argument("--port", type=int, default=8765, help="待ち受けるポート番号")
+    parser.add_argument("--latency", type=float, default=1.0, help="チャットの最初の応答までの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=20.0, help="ストリーミング時の1秒あたりの文字数")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="429を返さずに受け付ける同時リクエスト数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500を返すリクエストの割合")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="応答を遅らせるリクエストの割合")
+    parser.add_argument("--slow-latency", type=float, default=10.0, help="遅らせる場合の追加の秒数")
+    args = parser.parse_args()
+
+    FakeOpenAIHandler.latency = args.latency
+    FakeOpenAIHandler.tokens_per_second = args.tokens_per_second
+    FakeOpenAIHandler.max_concurrency = args.max_concurrency
+    FakeOpenAIHandler.error_rate = args.error_rate
+    FakeOpenAIHandler.slow_rate = args.slow_rate
+    FakeOpenAIHandler.slow_latency = args.slow_latency
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeOpenAIHandler)
+    print(f"検証用サーバーを起動しました: http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,14 +10,20 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 from uuid import uuid4
 import sys
+import json
+import hashlib
 import unicodedata
 from dotenv import load_dotenv
 import streamlit as st
 from langchain.text_splitter import CharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
 #from langchain_community.vectorstores import Chroma
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 import constants as ct
+from phrase_index import build_phrase_index
+from memory import ConversationMemory
+from resources import registry
+from retrieval import IndexShard, ShardedIndex, assign_parent_ids, load_shard, save_shard, sort_docs_by_folder
 
 
 ############################################################
@@ -98,33 +104,177 @@ def initialize_session_id():
 
 def initialize_retriever():
     """
-    画面読み込み時にRAGのRetriever（ベクターストアから検索するオブジェクト）を作成
+    画面読み込み時に、検索に使うインデックスをセッションから参照できるようにする
+    """
+    # すでにインデックスを参照済みの場合、後続の処理を中断
+    if "index" in st.session_state:
+        return
+
+    # インデックスはプロセス全体で1つだけ作成し、全セッションで共有する（読み取り専用）
+    # 検索条件（k, 絞り込み条件等）はリクエストごとに引数で指定するため、セッション間で干渉しない
+    st.session_state.index, st.session_state.phrase_index = load_shared_index()
+
+
+@st.cache_resource(show_spinner=False)
+def load_shared_index():
+    """
+    全セッションで共有する、ベクトル検索用のインデックスとフレーズ検索用のインデックスを作成
+
+    Returns:
+        (ShardedIndex, PhraseIndex)
     """
     # ロガーを読み込むことで、後続の処理中に発生したエラーなどがログファイルに記録される
     logger = logging.getLogger(ct.LOGGER_NAME)
 
-    # すでにRetrieverが作成済みの場合、後続の処理を中断
-    if "retriever" in st.session_state:
-        return
-    
-    # RAGの参照先となるデータソースの読み込み
-    docs_all = load_data_sources()
+    # シャード単位でベクターストアを読み込み（元ファイルが更新されたシャードのみ再作成）
+    index, pages = build_sharded_index()
+    logger.info({"shards": list(index.shards), "pages": len(pages), "index_version": index.version})
 
-    # OSがWindowsの場合、Unicode正規化と、cp932（Windows用の文字コード）で表現できない文字を除去
-    for doc in docs_all:
-        doc.page_content = adjust_string(doc.page_content)
-        for key in doc.metadata:
-            doc.metadata[key] = adjust_string(doc.metadata[key])
-    
-    # 埋め込みモデルの用意
-    embeddings = OpenAIEmbeddings()
-    
+    # 完全一致検索用のフレーズインデックスを作成（チャンク分割前のページ単位で作成）
+    return index, build_phrase_index(pages)
+
+
+def build_sharded_index(force_rebuild=None):
+    """
+    データフォルダ直下のフォルダ単位でシャードを作成・読み込み、まとめて検索できるインデックスを作成
+
+    Args:
+        force_rebuild: 保存済みのシャードがあっても再作成するシャード名の一覧（"*"を含む場合はすべて）
+                       未指定の場合は、環境変数「FORCE_REBUILD_SHARDS」の値を使う
+
+    Returns:
+        (ShardedIndex, 全シャードのチャンク分割前のドキュメント一覧)
+    """
+    # 埋め込みモデルの用意（APIキー・HTTPコネクションはプロセス全体で使い回す）
+    embeddings = registry.get_embeddings()
+    if force_rebuild is None:
+        force_rebuild = get_force_rebuild_shards()
+
+    shards = []
+    pages_all = []
+    for name, targets in list_shard_targets().items():
+        fingerprint = compute_shard_fingerprint(name, targets, embeddings)
+
+        rebuild = name in force_rebuild or "*" in force_rebuild
+        loaded = None if rebuild else load_shard(name, fingerprint, embeddings)
+        if loaded:
+            print(f"DEBUG: 保存済みのシャードを読み込み: {name}")
+            db, pages = loaded
+        else:
+            print(f"DEBUG: シャードを作成: {name}")
+            pages = load_shard_pages(name, targets)
+            # 読み込めるデータソースがないシャードは作成しない
+            if not pages:
+                continue
+            # 回答時にチャンクの前後の範囲を親のページから取り出せるよう、ページにIDを振ってからチャンク分割
+            assign_parent_ids(name, pages)
+            db = build_shard_db(pages, embeddings)
+            save_shard(name, fingerprint, db, pages)
+
+        shards.append(IndexShard(name, db, fingerprint, pages))
+        pages_all.extend(pages)
+
+    return ShardedIndex(shards, embeddings), pages_all
+
+
+def get_force_rebuild_shards():
+    """
+    環境変数「FORCE_REBUILD_SHARDS」から、再作成させるシャード名の一覧を取得
+
+    Returns:
+        シャード名の集合（未設定の場合は空）
+    """
+    value = os.getenv(ct.FORCE_REBUILD_SHARDS_ENV, "")
+    # macOSで入力されたシャード名も考慮しNFCで統一
+    return {unicodedata.normalize("NFC", name.strip()) for name in value.split(",") if name.strip()}
+
+
+def list_shard_targets():
+    """
+    シャード名と、シャードに含めるデータソース（ファイル・フォルダのパスまたはURL）の対応を取得
+
+    Returns:
+        シャード名 → データソースのリスト の辞書
+    """
+    targets = {}
+
+    # データフォルダの存在確認
+    if not os.path.exists(ct.RAG_TOP_FOLDER_PATH):
+        print(f"DEBUG: データフォルダが存在しません: {ct.RAG_TOP_FOLDER_PATH}")
+        os.makedirs(ct.RAG_TOP_FOLDER_PATH, exist_ok=True)
+        print(f"DEBUG: データフォルダを作成しました")
+
+    for entry in sorted(os.listdir(ct.RAG_TOP_FOLDER_PATH)):
+        full_path = os.path.join(ct.RAG_TOP_FOLDER_PATH, entry)
+        if os.path.isdir(full_path):
+            # フォルダはそれぞれ1つのシャードとする（macOSで作成されたフォルダ名も考慮しNFCで統一）
+            targets[unicodedata.normalize("NFC", entry)] = [full_path]
+        else:
+            # データフォルダ直下のファイルは、まとめて1つのシャードとする
+            targets.setdefault(ct.ROOT_SHARD_NAME, []).append(full_path)
+
+    if hasattr(ct, 'WEB_URL_LOAD_TARGETS') and ct.WEB_URL_LOAD_TARGETS:
+        targets[ct.WEB_FOLDER_LABEL] = list(ct.WEB_URL_LOAD_TARGETS)
+    else:
+        print("DEBUG: WEB_URL_LOAD_TARGETSが未定義または空です")
+
+    return targets
+
+
+def compute_shard_fingerprint(name, targets, embeddings):
+    """
+    シャードの元データとチャンク設定から、保存済みシャードの再利用可否を判定するためのフィンガープリントを算出
+
+    Args:
+        name: シャード名
+        targets: シャードに含めるデータソースのリスト
+        embeddings: 埋め込みモデル
+
+    Returns:
+        フィンガープリント（16進数の文字列）
+    """
+    items = [
+        ct.INDEX_SCHEMA_VERSION,
+        ct.chunk_size_num,
+        ct.chunk_overlap_num,
+        getattr(embeddings, "model", ""),
+        name
+    ]
+
+    for target in targets:
+        # URLの場合はURLのみを対象とする（Webページの更新を反映する場合は、シャードを再作成する）
+        if target.startswith(('http://', 'https://')):
+            items.append(target)
+            continue
+        paths = [target]
+        if os.path.isdir(target):
+            paths = [os.path.join(root, file) for root, _, files in os.walk(target) for file in files]
+        for path in sorted(paths):
+            stat = os.stat(path)
+            items.append([path, stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha256(json.dumps(items, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def build_shard_db(pages, embeddings):
+    """
+    シャードのページをチャンク分割し、ベクターストアを作成
+
+    Args:
+        pages: チャンク分割前のドキュメント一覧
+        embeddings: 埋め込みモデル
+
+    Returns:
+        FAISSのベクターストア
+    """
     # チャンク分割用のオブジェクトを作成
     text_splitter = CharacterTextSplitter(
 # 問題2修正 start--------------------------------------------
         chunk_size=ct.chunk_size_num,
         chunk_overlap=ct.chunk_overlap_num,
-        separator="\n"
+        separator=ct.CHUNK_SEPARATOR,
+        # 文脈の組み立て時に隣り合うチャンクをまとめられるよう、文書内の位置を記録
+        add_start_index=True
 #         chunk_size=500,
 #         chunk_overlap=50,
 #         separator="\n"
@@ -132,18 +282,17 @@ def initialize_retriever():
     )
 
     # チャンク分割を実施
-    splitted_docs = text_splitter.split_documents(docs_all)
+    splitted_docs = text_splitter.split_documents(pages)
+    # フォルダ単位の絞り込み検索ができるよう、同じフォルダのチャンクが連続したIDになるよう並び替え
+    splitted_docs = sort_docs_by_folder(splitted_docs)
 
-    # ベクターストアの作成
+    # ベクターストアの作成（OpenAIの埋め込みベクトルは正規化済みのため、内積 = コサイン類似度をスコアとする）
 #    db = Chroma.from_documents(splitted_docs, embedding=embeddings)
-    db = FAISS.from_documents(splitted_docs, embedding=embeddings) #TEST
-    
-    # ベクターストアを検索するRetrieverの作成
-# 問題2修正 start--------------------------------------------
-    st.session_state.retriever = db.as_retriever(search_kwargs={"k": ct.k_num}) 
-#    st.session_state.retriever = db.as_retriever(search_kwargs={"k": 5})    #問題1
-#    st.session_state.retriever = db.as_retriever(search_kwargs={"k": 3})    #問題1
-# 問題2修正 end----------------------------------------------
+    return FAISS.from_documents(
+        splitted_docs,
+        embedding=embeddings,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
 
 
 def initialize_session_state():
@@ -153,79 +302,58 @@ def initialize_session_state():
     if "messages" not in st.session_state:
         # 「表示用」の会話ログを順次格納するリストを用意
         st.session_state.messages = []
-        # 「LLMとのやりとり用」の会話ログを順次格納するリストを用意
-        st.session_state.chat_history = []
+        # 「LLMとのやりとり用」の会話ログ（直近のやりとりと、それより前の会話の要約）を用意
+        st.session_state.chat_history = ConversationMemory()
 
-def load_data_sources():
+def load_shard_pages(name, targets):
     """
-    RAGの参照先となるデータソースの読み込み（エンコーディング対応版）
+    シャードに含めるデータソースの読み込み（エンコーディング対応版）
+
+    Args:
+        name: シャード名
+        targets: シャードに含めるデータソースのリスト
+
+    Returns:
+        読み込んだドキュメント一覧
     """
-    import logging
-    from langchain_community.document_loaders import WebBaseLoader
-    import requests
-    from bs4 import BeautifulSoup
-    
     docs_all = []
     logger = logging.getLogger(ct.LOGGER_NAME) if hasattr(ct, 'LOGGER_NAME') else None
-    
-    try:
-        print("DEBUG: ファイル読み込み開始")
-        
-        # データフォルダの存在確認
-        if not os.path.exists(ct.RAG_TOP_FOLDER_PATH):
-            print(f"DEBUG: データフォルダが存在しません: {ct.RAG_TOP_FOLDER_PATH}")
-            os.makedirs(ct.RAG_TOP_FOLDER_PATH, exist_ok=True)
-            print(f"DEBUG: データフォルダを作成しました")
-            return docs_all
-            
-        print(f"DEBUG: データフォルダ確認完了: {ct.RAG_TOP_FOLDER_PATH}")
-        
-        # ファイル読み込み処理
-        try:
-            recursive_file_check(ct.RAG_TOP_FOLDER_PATH, docs_all)
-            print(f"DEBUG: ファイル読み込み完了: {len(docs_all)}件")
-        except Exception as e:
-            print(f"DEBUG: ファイル読み込みエラー: {type(e).__name__}: {str(e)}")
-            if logger:
-                logger.error(f"ファイル読み込みエラー: {e}")
-        
-    except Exception as e:
-        print(f"DEBUG: データフォルダ処理エラー: {type(e).__name__}: {str(e)}")
-        if logger:
-            logger.error(f"データフォルダ処理エラー: {e}")
 
-    # Web読み込み処理（エンコーディング対応版）
-    try:
+    if name == ct.WEB_FOLDER_LABEL:
+        # Web読み込み処理（エンコーディング対応版）
         print("DEBUG: Web読み込み開始")
-        web_docs_all = []
-        
-        if hasattr(ct, 'WEB_URL_LOAD_TARGETS') and ct.WEB_URL_LOAD_TARGETS:
-            for web_url in ct.WEB_URL_LOAD_TARGETS:
-                try:
-                    print(f"DEBUG: Web読み込み中: {web_url}")
-                    
-                    # 安全なWeb読み込み処理
-                    web_docs = safe_web_load(web_url)
-                    web_docs_all.extend(web_docs)
-                    
-                    print(f"DEBUG: Web読み込み成功: {web_url} ({len(web_docs)}件)")
-                    
-                except Exception as e:
-                    print(f"DEBUG: Web読み込みエラー {web_url}: {type(e).__name__}: {str(e)}")
-                    if logger:
-                        logger.warning(f"Web読み込みエラー {web_url}: {e}")
-        else:
-            print("DEBUG: WEB_URL_LOAD_TARGETSが未定義または空です")
-        
-        docs_all.extend(web_docs_all)
-        print(f"DEBUG: Web読み込み完了: {len(web_docs_all)}件")
-        
-    except Exception as e:
-        print(f"DEBUG: Web読み込み処理エラー: {type(e).__name__}: {str(e)}")
-        if logger:
-            logger.error(f"Web読み込み処理エラー: {e}")
-    
-    print(f"DEBUG: 総データソース数: {len(docs_all)}件")
+        for web_url in targets:
+            try:
+                print(f"DEBUG: Web読み込み中: {web_url}")
+
+                # 安全なWeb読み込み処理
+                web_docs = safe_web_load(web_url)
+                docs_all.extend(web_docs)
+
+                print(f"DEBUG: Web読み込み成功: {web_url} ({len(web_docs)}件)")
+
+            except Exception as e:
+                print(f"DEBUG: Web読み込みエラー {web_url}: {type(e).__name__}: {str(e)}")
+                if logger:
+                    logger.warning(f"Web読み込みエラー {web_url}: {e}")
+    else:
+        # ファイル読み込み処理
+        print(f"DEBUG: ファイル読み込み開始: {name}")
+        for path in targets:
+            try:
+                recursive_file_check(path, docs_all)
+            except Exception as e:
+                print(f"DEBUG: ファイル読み込みエラー: {type(e).__name__}: {str(e)}")
+                if logger:
+                    logger.error(f"ファイル読み込みエラー: {e}")
+
+    # OSがWindowsの場合、Unicode正規化と、cp932（Windows用の文字コード）で表現できない文字を除去
+    for doc in docs_all:
+        doc.page_content = adjust_string(doc.page_content)
+        for key in doc.metadata:
+            doc.metadata[key] = adjust_string(doc.metadata[key])
+
+    print(f"DEBUG: データソース数: {name} {len(docs_all)}件")
     return docs_all
 
 def safe_web_load(url):
@@ -19,6 +19,8 @@ from initialize import initialize
 import components as cn
 # （自作）変数（定数）がまとめて定義・管理されているモジュール
 import constants as ct
+# （自作）LLM呼び出しの流量制御で、呼び出し回数の上限を超えた場合に送出される例外
+from scheduler import LLMRateLimitError
 
 
 ############################################################
@@ -114,8 +116,22 @@ if chat_message:
     # LLMによる回答生成（回答生成が完了するまでグルグル回す）
     with st.spinner(ct.SPINNER_TEXT):
         try:
-            # 画面読み込み時に作成したRetrieverを使い、Chainを実行
-            llm_response = utils.get_llm_response(chat_message)
+            # 画面読み込み時に作成したインデックスを使い、Chainを実行
+            # （ストリーミングの場合、検索が完了した時点で戻り、回答は「7-3」で順次表示する）
+            # LLMの実行枠を待っている間は、待機順と待ち時間の目安を表示
+            llm_response = utils.get_llm_response(
+                chat_message,
+                stream=ct.ANSWER_STREAMING_ENABLED,
+                on_queue=lambda position, eta: res_box.info(ct.QUEUE_STATUS_TEXT.format(position=position, eta=eta))
+            )
+            res_box.empty()
+        except LLMRateLimitError as e:
+            # 呼び出し回数の上限を超えた場合は、エラーではなく待ち時間を案内
+            logger.warning(f"{ct.RATE_LIMIT_MESSAGE}\n{e}")
+            res_box.empty()
+            st.warning(ct.RATE_LIMIT_MESSAGE.format(retry_after=e.retry_after), icon=ct.WARNING_ICON)
+            # 後続の処理を中断
+            st.stop()
         except Exception as e:
             # エラーログの出力
             logger.error(f"{ct.GET_LLM_RESPONSE_ERROR_MESSAGE}\n{e}")
@@ -159,4 +175,6 @@ if chat_message:
     # 表示用の会話ログにユーザーメッセージを追加
     st.session_state.messages.append({"role": "user", "content": chat_message})
     # 表示用の会話ログにAIメッセージを追加
-    st.session_state.messages.append({"role": "assistant", "content": content})
\ No newline at end of file
+    st.session_state.messages.append({"role": "assistant", "content": content})
+    # LLMとのやりとり用の会話履歴に、質問と回答を追加（次回以降の質問の言い換えに使用）
+    st.session_state.chat_history.add_turn(chat_message, utils.get_history_answer(llm_response))
\ No newline at end of file
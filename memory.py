@@ -0,0 +1,99 @@
+"""
+このファイルは、LLMとのやりとり用の会話履歴（直近のやりとりと、それより前の会話の要約）が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import threading
+from collections import deque
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def is_follow_up(message):
+    """
+    入力が、直前までの会話を前提とした質問（指示語・省略を含む質問）に見えるかどうかを判定
+
+    Args:
+        message: ユーザー入力値
+
+    Returns:
+        会話履歴を踏まえた言い換えが必要そうな場合はTrue
+    """
+    return re.search(ct.FOLLOW_UP_PATTERN, message.strip()) is not None
+
+
+############################################################
+# クラス定義
+############################################################
+
+class ConversationMemory:
+    """
+    セッションごとの、LLMとのやりとり用の会話履歴
+
+    直近のやりとりは原文のまま保持し、件数の上限を超えて押し出されたやりとりは、
+    次に質問の言い換えが必要になった時点で要約に畳み込む（要約のトークン数は上限以内に保つ）
+    画面の操作を行うスレッドと、回答処理を行うイベントループのスレッドの両方から参照される
+    """
+
+    def __init__(self, max_turns=ct.CHAT_HISTORY_MAX_TURNS):
+        self._lock = threading.Lock()
+        # 原文のまま保持する直近のやりとり（(質問, 回答) のタプル）
+        self._turns = deque()
+        self.max_turns = max_turns
+        # 要約に畳み込む前の、押し出されたやりとり
+        self._pending = []
+        # 押し出されたやりとりの要約
+        self.summary = ""
+
+    def __bool__(self):
+        with self._lock:
+            return bool(self._turns or self._pending or self.summary)
+
+    def add_turn(self, question, answer):
+        """
+        1回分のやりとりを追加（件数の上限を超えた古いやりとりは、要約待ちに移す）
+        """
+        with self._lock:
+            self._turns.append((question, answer))
+            while len(self._turns) > self.max_turns:
+                self._pending.append(self._turns.popleft())
+
+    def pending_turns(self):
+        """
+        要約に畳み込む前の、押し出されたやりとりを取得
+        """
+        with self._lock:
+            return list(self._pending)
+
+    def fold(self, summary, count):
+        """
+        要約を更新し、要約に畳み込んだやりとり（要約待ちの先頭から「count」件）を取り除く
+        """
+        with self._lock:
+            self.summary = summary
+            del self._pending[:count]
+
+    def to_messages(self, include_recent=True):
+        """
+        要約と会話履歴を、チェーンに渡すメッセージのリストに変換
+
+        Args:
+            include_recent: 直近のやりとりを含めるかどうか（Falseの場合は、要約と要約待ちのやりとりのみ）
+        """
+        with self._lock:
+            messages = []
+            if self.summary:
+                messages.append(SystemMessage(content=f"これまでの会話の要約：\n{self.summary}"))
+            # 要約に畳み込む前のやりとりも、原文のまま含める
+            turns = [*self._pending, *self._turns] if include_recent else self._pending
+            for question, answer in turns:
+                messages.append(HumanMessage(content=question))
+                messages.append(AIMessage(content=answer))
+            return messages
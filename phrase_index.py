@@ -0,0 +1,170 @@
+"""
+このファイルは、社内文書の完全一致（フレーズ）検索用のインデックスが記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import unicodedata
+from array import array
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def normalize_text(s):
+    """
+    フレーズ検索用にテキストを正規化
+
+    Args:
+        s: 正規化対象の文字列
+
+    Returns:
+        NFKC正規化・小文字化・空白除去を行った文字列
+    """
+    if not isinstance(s, str):
+        return ""
+    # 全角/半角の揺れを吸収し、英字は小文字に統一
+    s = unicodedata.normalize("NFKC", s).lower()
+    # PDFなどでは任意の位置に改行・空白が入るため、空白類はすべて除去
+    return re.sub(r"\s+", "", s)
+
+
+def extract_quoted_phrase(message):
+    """
+    ユーザー入力から、かぎ括弧・引用符で囲まれたフレーズを取り出す
+
+    Args:
+        message: ユーザー入力値
+
+    Returns:
+        囲まれたフレーズ（存在しない場合はNone）
+    """
+    match = re.search(ct.PHRASE_QUERY_PATTERN, message)
+    if not match:
+        return None
+    phrase = match.group(1).strip()
+    return phrase or None
+
+
+def build_phrase_index(docs):
+    """
+    読み込んだドキュメント（ページ単位）からフレーズ検索用のインデックスを作成
+
+    Args:
+        docs: データソースのドキュメント一覧
+
+    Returns:
+        作成したPhraseIndex
+    """
+    index = PhraseIndex()
+    for doc in docs:
+        index.add(doc.metadata.get("source", ""), doc.metadata.get("page"), doc.page_content)
+    return index
+
+
+############################################################
+# クラス定義
+############################################################
+
+class PhraseIndex:
+    """
+    n-gramの転置インデックス（出現位置付き）による完全一致検索
+
+    n-gramで候補ページを絞り込んだ後、出現位置から照合位置を特定して
+    正規化済みテキストと突き合わせるため、ベクトル検索と異なり取りこぼし・誤検出がない
+    """
+
+    def __init__(self, n=ct.PHRASE_INDEX_NGRAM):
+        self.n = n
+        # 「ファイルパス」と「ページ番号」の組を、ページIDの順に格納
+        self._entries = []
+        # 正規化済みのページテキストを、ページIDの順に格納
+        self._texts = []
+        # n-gram → {ページID: 出現位置の配列} の転置インデックス
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, source, page, text):
+        """
+        ページを1件インデックスに追加
+
+        Args:
+            source: ファイルパス
+            page: ページ番号（存在しない場合はNone）
+            text: ページのテキスト
+        """
+        doc_id = len(self._entries)
+        normalized = normalize_text(text)
+        self._entries.append((source, page))
+        self._texts.append(normalized)
+
+        for pos in range(len(normalized) - self.n + 1):
+            gram = normalized[pos:pos + self.n]
+            positions = self._postings.setdefault(gram, {}).get(doc_id)
+            if positions is None:
+                # 出現位置は符号なし整数の配列で保持し、メモリ使用量を抑える
+                positions = self._postings[gram][doc_id] = array("I")
+            positions.append(pos)
+
+    def search(self, phrase):
+        """
+        フレーズを含むすべてのファイル・ページを検索
+
+        Args:
+            phrase: 検索するフレーズ
+
+        Returns:
+            「source」「page」を持つ辞書のリスト（ファイルパス・ページ番号順）
+        """
+        query = normalize_text(phrase)
+        if not query:
+            return []
+
+        # n文字未満のフレーズはn-gramを作れないため、全ページを直接照合
+        if len(query) < self.n:
+            hit_ids = [doc_id for doc_id, text in enumerate(self._texts) if query in text]
+            return self._to_results(hit_ids)
+
+        grams = [(offset, query[offset:offset + self.n]) for offset in range(len(query) - self.n + 1)]
+        # いずれかのn-gramが一度も出現しない場合、該当ページは存在しない
+        if any(gram not in self._postings for _, gram in grams):
+            return []
+
+        # 出現ページ数が少ないn-gramから順に積集合を取り、候補ページを絞り込む
+        grams.sort(key=lambda item: len(self._postings[item[1]]))
+        candidate_ids = set(self._postings[grams[0][1]])
+        for _, gram in grams[1:]:
+            candidate_ids &= self._postings[gram].keys()
+            if not candidate_ids:
+                return []
+
+        # 最も出現の少ないn-gramの出現位置を起点に、フレーズ全体が一致するかを照合
+        anchor_offset, anchor_gram = grams[0]
+        hit_ids = []
+        for doc_id in candidate_ids:
+            text = self._texts[doc_id]
+            for pos in self._postings[anchor_gram][doc_id]:
+                start = pos - anchor_offset
+                if start >= 0 and text.startswith(query, start):
+                    hit_ids.append(doc_id)
+                    break
+
+        return self._to_results(hit_ids)
+
+    def _to_results(self, doc_ids):
+        results = [{"source": self._entries[doc_id][0], "page": self._entries[doc_id][1]} for doc_id in doc_ids]
+        results.sort(key=lambda r: (r["source"], _page_sort_key(r["page"])))
+        return results
+
+
+def _page_sort_key(page):
+    try:
+        return int(page)
+    except (TypeError, ValueError):
+        return -1
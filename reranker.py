@@ -0,0 +1,184 @@
+"""
+このファイルは、検索結果の候補を質問との関連性で並べ替える処理（再ランキング）が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+import numpy as np
+import constants as ct
+from context import lexical_scores
+
+
+############################################################
+# クラス定義
+############################################################
+
+class Reranker(ABC):
+    """
+    再ランキングの共通の処理
+
+    派生クラスは「score」で、候補をまとめて（1回の呼び出しで）採点する
+    （「score」を実装していない派生クラスは、オブジェクトの作成時にエラーとなる）
+    """
+
+    name = ""
+
+    @abstractmethod
+    def score(self, query, results):
+        """
+        候補をまとめて採点
+
+        Args:
+            query: ユーザー入力値
+            results: (Document, 類似度スコア) のリスト（候補）
+
+        Returns:
+            候補ごとのスコアの配列（高いほど関連性が高い）
+        """
+
+    def rerank(self, query, results, top_n):
+        """
+        候補を採点し、スコアの高い順に上位「top_n」件を残す（所要時間をログ出力）
+
+        Args:
+            query: ユーザー入力値
+            results: (Document, 類似度スコア) のリスト（候補）
+            top_n: 残す件数
+
+        Returns:
+            (Document, 再ランキングのスコア) のリスト（スコアの高い順）
+            （文脈の組み立ては類似度の高い順に詰めるため、類似度の代わりに再ランキングのスコアを持たせる）
+        """
+        if not results:
+            return []
+
+        started_at = time.perf_counter()
+        scores = np.asarray(self.score(query, results), dtype=np.float32)
+        order = np.argsort(-scores, kind="stable")[:top_n]
+        reranked = [(results[i][0], float(scores[i])) for i in order]
+
+        logging.getLogger(ct.LOGGER_NAME).info({"rerank": {
+            "reranker": self.name,
+            "candidates": len(results),
+            "kept": len(reranked),
+            "latency_ms": round((time.perf_counter() - started_at) * 1000, 1)
+        }})
+        return reranked
+
+    async def arerank(self, query, results, top_n):
+        """
+        「rerank」の非同期版（採点はスレッドで実行し、その間イベントループをブロックしない）
+        """
+        return await asyncio.to_thread(self.rerank, query, results, top_n)
+
+
+class LexicalReranker(Reranker):
+    """
+    外部のモデルを使わない、特徴量の重み付き和による再ランキング（オフラインでも動作する）
+
+    - "vector": 埋め込みベクトルの類似度（候補内で0〜1に正規化）
+    - "lexical": 本文と質問の、文字バイグラムの重なり
+    - "source": ファイル名と質問の、文字バイグラムの重なり
+    """
+
+    name = "lexical"
+
+    def __init__(self, weights=None):
+        self.weights = weights or ct.RERANK_LEXICAL_WEIGHTS
+
+    def score(self, query, results):
+        vector_scores = np.array([score for _, score in results], dtype=np.float32)
+        spread = vector_scores.max() - vector_scores.min()
+        vector_scores = (vector_scores - vector_scores.min()) / spread if spread > 0 else np.ones_like(vector_scores)
+
+        texts = [doc.page_content for doc, _ in results]
+        names = [str(doc.metadata.get("source", "")).replace("\\", "/").split("/")[-1] for doc, _ in results]
+
+        return (
+            self.weights["vector"] * vector_scores
+            + self.weights["lexical"] * lexical_scores(texts, query)
+            + self.weights["source"] * lexical_scores(names, query)
+        )
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    Cross-Encoderのモデルで、質問と候補の組をまとめて採点する再ランキング
+
+    モデル（sentence-transformers）を読み込めない環境では、「LexicalReranker」で採点する
+    """
+
+    name = "cross_encoder"
+
+    def __init__(self, model_name=ct.RERANK_CROSS_ENCODER_MODEL):
+        self.model_name = model_name
+        self._model = None
+        self._fallback = LexicalReranker()
+
+    def score(self, query, results):
+        model = self._load_model()
+        if model is False:
+            return self._fallback.score(query, results)
+        return model.predict([(query, doc.page_content) for doc, _ in results], batch_size=ct.RERANK_BATCH_SIZE)
+
+    def _load_model(self):
+        if self._model is None:
+            try:
+                from sentence_transformers import CrossEncoder
+                self._model = CrossEncoder(self.model_name)
+            except Exception as e:
+                logging.getLogger(ct.LOGGER_NAME).warning({
+                    "rerank_model_unavailable": self.model_name,
+                    "fallback": LexicalReranker.name,
+                    "error": f"{type(e).__name__}: {str(e)}"
+                })
+                self._model = False
+        return self._model
+
+
+############################################################
+# 関数定義
+############################################################
+
+# 「RERANKER」で指定できる再ランキングの方法（独自の方法は「register_reranker」で追加する）
+_RERANKER_FACTORIES = {
+    LexicalReranker.name: LexicalReranker,
+    CrossEncoderReranker.name: CrossEncoderReranker
+}
+# 作成済みの再ランキングのオブジェクト（モデルの読み込みは1度だけ行い、プロセス全体で使い回す）
+_rerankers = {}
+
+
+def register_reranker(name, factory):
+    """
+    再ランキングの方法を追加
+
+    Args:
+        name: 「RERANKER」に指定する名前
+        factory: 引数なしで「Reranker」の派生クラスのオブジェクトを作成する関数（クラス）
+    """
+    _RERANKER_FACTORIES[name] = factory
+    _rerankers.pop(name, None)
+
+
+def get_reranker(name=None):
+    """
+    再ランキングのオブジェクトを取得
+
+    Args:
+        name: 再ランキングの方法（未指定の場合は「RERANKER」）
+
+    Returns:
+        「Reranker」の派生クラスのオブジェクト
+    """
+    name = name or ct.RERANKER
+    if name not in _rerankers:
+        if name not in _RERANKER_FACTORIES:
+            raise ValueError(f"未対応の再ランキングの方法です: {name}")
+        _rerankers[name] = _RERANKER_FACTORIES[name]()
+    return _rerankers[name]
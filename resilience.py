@@ -0,0 +1,275 @@
+"""
+このファイルは、埋め込み・LLMの呼び出しを安定させる仕組み（リトライ・ヘッジ・サーキットブレーカー）が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+import numpy as np
+import openai
+import constants as ct
+
+
+############################################################
+# 設定関連
+############################################################
+# リトライ・サーキットブレーカーの対象とする、一時的な障害を表す例外
+# （接続エラー・タイムアウト・429・5xx。400等のリクエスト自体の誤りはリトライしても結果が変わらないため対象外）
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+# 空のストリームを表す目印
+_END = object()
+
+
+############################################################
+# 関数定義
+############################################################
+
+async def _aclose(iterator):
+    aclose = getattr(iterator, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+async def _discard(result):
+    # ヘッジで採用しなかったストリームの結果（最初の要素, イテレーター）を閉じる
+    if isinstance(result, tuple) and len(result) == 2 and hasattr(result[1], "__anext__"):
+        await _aclose(result[1])
+
+
+############################################################
+# クラス定義
+############################################################
+
+class CircuitOpenError(Exception):
+    """
+    サーキットブレーカーが開いている（呼び出しを即座に失敗させている）場合に送出する例外
+    """
+
+
+class CircuitBreaker:
+    """
+    連続して失敗した呼び出し先への呼び出しを、一定時間止めるサーキットブレーカー
+
+    - closed: 通常どおり呼び出す（連続失敗数がしきい値に達するとopenへ）
+    - open: 呼び出さずに即座に失敗させる（一定時間が経過するとhalf_openへ）
+    - half_open: 1件だけ試しに呼び出し、成功すればclosed、失敗すれば再びopenへ
+    """
+
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+                return "half_open"
+            return self._state
+
+    def allow(self):
+        """
+        呼び出してよいかどうかを判定（half_openの間は、試しの1件のみ許可）
+        """
+        with self._lock:
+            if self._state == "closed":
+                return True
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._state = "half_open"
+            if self._state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._probing = False
+
+    def record_cancel(self):
+        # 試しの呼び出しが、成功・失敗のいずれでもなく終わった場合（中断・リクエスト自体の誤り等）
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    logging.getLogger(ct.LOGGER_NAME).warning({"circuit_open": self.name, "failures": self._failures})
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+
+class ResilientCaller:
+    """
+    非同期の呼び出しに、リトライ・ヘッジ・サーキットブレーカーを適用する呼び出し窓口
+
+    - 一時的な障害は、ジッター付きの指数バックオフで再試行する
+    - 応答が直近の所要時間のp95を超えた場合、同じ呼び出しをもう1件だけ送り、先に完了した方を使う（ヘッジ）
+    - 連続して失敗した場合はサーキットブレーカーを開き、一定時間は呼び出さずに即座に失敗させる
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(name, ct.CIRCUIT_FAILURE_THRESHOLD, ct.CIRCUIT_RESET_SECONDS)
+        # 直近の成功した呼び出しの所要時間（ストリーミングは最初の要素までの時間）
+        self._latencies = deque(maxlen=ct.HEDGE_LATENCY_WINDOW)
+        self._hedges = 0
+        self._hedge_wins = 0
+        self._retries = 0
+
+    def is_open(self):
+        """
+        サーキットブレーカーが開いているかどうか
+        """
+        return self.breaker.state == "open"
+
+    def hedge_delay(self):
+        """
+        ヘッジを送るまでの待ち時間（直近の所要時間のp95、件数が少ない間はヘッジしないためNone）
+        """
+        if len(self._latencies) < ct.HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(self._latencies, ct.HEDGE_PERCENTILE))
+
+    def expected_latency(self):
+        """
+        呼び出しにかかる時間の見込み（直近の所要時間の中央値、記録がない間はNone）
+        """
+        if not self._latencies:
+            return None
+        return float(np.median(self._latencies))
+
+    async def call(self, factory):
+        """
+        呼び出しを実行
+
+        Args:
+            factory: 呼び出しのたびに新しいコルーチンを作成する関数（リトライ・ヘッジで複数回呼ばれる）
+
+        Returns:
+            呼び出しの戻り値
+        """
+        return await self._with_retries(lambda: self._hedged(factory))
+
+    async def stream(self, factory):
+        """
+        ストリーミングの呼び出しを実行し、要素を順次返す非同期ジェネレーター
+
+        リトライ・ヘッジは最初の要素を受け取るまでに限って行う（受け取った要素は取り消せないため）
+
+        Args:
+            factory: 呼び出しのたびに新しい非同期イテレーターを作成する関数
+        """
+        first, iterator = await self._with_retries(lambda: self._hedged(lambda: self._open_stream(factory)))
+        try:
+            if first is not _END:
+                yield first
+                async for item in iterator:
+                    yield item
+        finally:
+            await _aclose(iterator)
+
+    def stats(self):
+        return {
+            "state": self.breaker.state,
+            "p95": self.hedge_delay(),
+            "retries": self._retries,
+            "hedges": self._hedges,
+            "hedge_wins": self._hedge_wins
+        }
+
+    async def _with_retries(self, attempt):
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        for retry in range(ct.RETRY_MAX_ATTEMPTS):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"{self.name}への呼び出しを一時的に停止しています")
+            try:
+                result = await attempt()
+            except TRANSIENT_ERRORS as e:
+                self.breaker.record_failure()
+                if retry == ct.RETRY_MAX_ATTEMPTS - 1:
+                    raise
+                # 同時に失敗した呼び出しが一斉に再試行しないよう、待ち時間を0〜上限の間でランダムにばらつかせる
+                delay = random.uniform(0, min(ct.RETRY_MAX_DELAY_SECONDS, ct.RETRY_BASE_DELAY_SECONDS * 2 ** retry))
+                self._retries += 1
+                logger.warning({"retry": self.name, "attempt": retry + 1, "delay": round(delay, 3), "error": type(e).__name__})
+                await asyncio.sleep(delay)
+            except BaseException:
+                self.breaker.record_cancel()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def _hedged(self, factory):
+        started_at = time.perf_counter()
+        primary = asyncio.ensure_future(factory())
+        tasks = [primary]
+
+        delay = self.hedge_delay()
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # p95を超えても応答がないため、同じ呼び出しをもう1件送る
+                self._hedges += 1
+                tasks.append(asyncio.ensure_future(factory()))
+
+        winner = None
+        try:
+            # 先に成功した方を採用（片方が失敗した場合は、もう片方の完了を待つ）
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not primary:
+                            self._hedge_wins += 1
+                        self._latencies.append(time.perf_counter() - started_at)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    # 採用しなかった方のストリームは閉じる
+                    await _discard(task.result())
+
+    async def _open_stream(self, factory):
+        # ストリームを開始し、最初の要素とイテレーターを返す（要素がない場合は「_END」）
+        iterator = factory().__aiter__()
+        try:
+            return await iterator.__anext__(), iterator
+        except StopAsyncIteration:
+            return _END, iterator
+        except BaseException:
+            await _aclose(iterator)
+            raise
+
+
+############################################################
+# プロセス全体で共有する呼び出し窓口
+############################################################
+embedding_caller = ResilientCaller("embeddings")
+llm_caller = ResilientCaller("llm")
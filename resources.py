@@ -0,0 +1,276 @@
+"""
+このファイルは、リクエストをまたいで再利用するリソース（APIキー・LLMクライアント・チェーン等）を管理するファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import threading
+import httpx
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+import constants as ct
+import utils
+
+
+############################################################
+# クラス定義
+############################################################
+
+class ResourceRegistry:
+    """
+    プロセス全体で共有するリソースの登録簿
+
+    APIキーは初回のみ取得し、LLMクライアントは共通のHTTPコネクションプールを使って使い回す
+    Streamlitの複数のスクリプトスレッドから同時に呼ばれても、各リソースは1度だけ作成される
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._api_key = None
+        self._http_client = None
+        self._http_async_client = None
+        self._embeddings = None
+        # (モデル名, temperature) → ChatOpenAI
+        self._llms = {}
+        # (モード, モデル名, temperature) → チェーン（会話履歴用は (システムプロンプト, モデル名, temperature) → チェーン）
+        self._chains = {}
+        self._event_loop = None
+
+    def get_api_key(self):
+        """
+        OpenAI APIキーを取得（2回目以降は取得済みの値を返す）
+        """
+        if self._api_key is None:
+            with self._lock:
+                if self._api_key is None:
+                    self._api_key = utils.get_openai_api_key()
+        return self._api_key
+
+    def get_http_clients(self):
+        """
+        OpenAI APIへの接続に使う、コネクションプール付きのHTTPクライアント（同期・非同期）を取得
+        """
+        if self._http_client is None:
+            with self._lock:
+                if self._http_client is None:
+                    limits = httpx.Limits(
+                        max_connections=ct.HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=ct.HTTP_MAX_KEEPALIVE_CONNECTIONS
+                    )
+                    self._http_async_client = httpx.AsyncClient(limits=limits, timeout=ct.HTTP_TIMEOUT_SECONDS)
+                    self._http_client = httpx.Client(limits=limits, timeout=ct.HTTP_TIMEOUT_SECONDS)
+        return self._http_client, self._http_async_client
+
+    def get_event_loop(self):
+        """
+        非同期の回答処理を実行する、バックグラウンドスレッド上のイベントループを取得
+
+        全セッションのリクエストを1つのイベントループで処理するため、
+        LLMの応答待ちの間もスレッドを占有せず、少数のスレッドで多数のリクエストを同時に処理できる
+        """
+        if self._event_loop is None:
+            with self._lock:
+                if self._event_loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="answer-event-loop", daemon=True).start()
+                    self._event_loop = loop
+        return self._event_loop
+
+    def get_embeddings(self):
+        """
+        埋め込みモデルを取得
+        """
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    http_client, http_async_client = self.get_http_clients()
+                    # リトライは「resilience.py」で行うため、クライアント側のリトライは無効化
+                    self._embeddings = OpenAIEmbeddings(
+                        openai_api_key=self.get_api_key(),
+                        http_client=http_client,
+                        http_async_client=http_async_client,
+                        max_retries=0
+                    )
+        return self._embeddings
+
+    def get_llm(self, model, temperature):
+        """
+        LLMクライアントを取得（モデル名・temperatureの組ごとに1つ作成）
+        """
+        key = (model, temperature)
+        if key not in self._llms:
+            with self._lock:
+                if key not in self._llms:
+                    http_client, http_async_client = self.get_http_clients()
+                    self._llms[key] = ChatOpenAI(
+                        model_name=model,
+                        temperature=temperature,
+                        openai_api_key=self.get_api_key(),
+                        http_client=http_client,
+                        http_async_client=http_async_client,
+                        max_retries=0
+                    )
+        return self._llms[key]
+
+    def get_chain(self, mode, model, temperature):
+        """
+        検索済みのドキュメントを文脈として回答を生成するチェーンを取得（モードごとのプロンプトで1つ作成）
+
+        チェーンの入力は「input」（ユーザー入力値）と「context」（ドキュメントのリスト）
+        """
+        key = (mode, model, temperature)
+        if key not in self._chains:
+            with self._lock:
+                if key not in self._chains:
+                    system_prompt = ct.SYSTEM_PROMPT_INQUIRY if mode == ct.ANSWER_MODE_2 else ct.SYSTEM_PROMPT_DOC_SEARCH
+                    prompt = ChatPromptTemplate.from_messages([
+                        ("system", system_prompt),
+                        ("human", "{input}")
+                    ])
+                    self._chains[key] = create_stuff_documents_chain(self.get_llm(model, temperature), prompt)
+        return self._chains[key]
+
+    def get_prompt_chain(self, system_prompt, model, temperature):
+        """
+        検索済みのドキュメントを文脈として文章を作成するチェーンを取得（システムプロンプトごとに1つ作成）
+
+        チェーンの入力は「get_chain」と同じく「input」と「context」で、システムプロンプトには「{context}」を含める
+        """
+        key = (system_prompt, model, temperature)
+        if key not in self._chains:
+            with self._lock:
+                if key not in self._chains:
+                    prompt = ChatPromptTemplate.from_messages([
+                        ("system", system_prompt),
+                        ("human", "{input}")
+                    ])
+                    self._chains[key] = create_stuff_documents_chain(self.get_llm(model, temperature), prompt)
+        return self._chains[key]
+
+    def get_history_chain(self, system_prompt, model, temperature):
+        """
+        会話履歴をもとに文章を作成するチェーンを取得（システムプロンプトごとに1つ作成）
+
+        チェーンの入力は「chat_history」（メッセージのリスト）と「input」（最新の入力）で、作成した文章を返す
+        """
+        key = (system_prompt, model, temperature)
+        if key not in self._chains:
+            with self._lock:
+                if key not in self._chains:
+                    prompt = ChatPromptTemplate.from_messages([
+                        ("system", system_prompt),
+                        MessagesPlaceholder("chat_history"),
+                        ("human", "{input}")
+                    ])
+                    self._chains[key] = prompt | self.get_llm(model, temperature) | StrOutputParser()
+        return self._chains[key]
+
+
+class GuardedStream:
+    """
+    非同期ジェネレーターを包み、一度も開始されないまま閉じられた・破棄された場合に後処理を実行する非同期イテレーター
+
+    非同期ジェネレーターは、開始前に閉じられた・破棄された場合に「finally」が実行されないため、
+    ジェネレーターの作成前に確保したもの（LLMの実行枠・処理中の回答の登録等）は、この後処理で解放する
+    （開始後は、ジェネレーター自身の「finally」で解放する）
+    """
+
+    def __init__(self, agen, cleanup):
+        """
+        Args:
+            agen: 非同期ジェネレーター
+            cleanup: 開始前に閉じられた・破棄された場合に1度だけ実行するコルーチン関数（引数なし）
+        """
+        self._agen = agen
+        self._cleanup = cleanup
+        self._started = False
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        self._started = True
+        return await self._agen.__anext__()
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        await self._agen.aclose()
+        if not self._started:
+            await self._cleanup()
+
+    def __del__(self):
+        # 表示が始まる前に画面が再実行された場合等、閉じられずに破棄された場合は、共有のイベントループで後処理を実行
+        if self._closed or self._started:
+            return
+        self._closed = True
+        try:
+            submit_async(self._cleanup())
+        except Exception:
+            # プロセスの終了中など、イベントループを利用できない場合は何もしない
+            pass
+
+
+############################################################
+# 関数定義
+############################################################
+
+def submit_async(coro):
+    """
+    コルーチンを共有のイベントループで実行開始し、完了を待たずに返す
+
+    Args:
+        coro: 実行するコルーチン
+
+    Returns:
+        実行結果を受け取るための「concurrent.futures.Future」
+    """
+    return asyncio.run_coroutine_threadsafe(coro, registry.get_event_loop())
+
+
+def run_async(coro):
+    """
+    コルーチンを共有のイベントループで実行し、完了を待って結果を返す（同期処理から呼び出すための窓口）
+
+    Args:
+        coro: 実行するコルーチン
+
+    Returns:
+        コルーチンの戻り値（例外が発生した場合はそのまま送出）
+    """
+    return submit_async(coro).result()
+
+
+def iterate_async(agen):
+    """
+    非同期ジェネレーターを、共有のイベントループ上で1要素ずつ進める同期ジェネレーターに変換
+
+    Args:
+        agen: 非同期ジェネレーター
+
+    Yields:
+        非同期ジェネレーターが返す要素
+    """
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        # 途中で表示が中断された場合も、非同期ジェネレーター側の後処理（LLMの実行枠の解放等）を実行
+        run_async(agen.aclose())
+
+
+############################################################
+# プロセス全体で共有する登録簿
+############################################################
+registry = ResourceRegistry()
@@ -0,0 +1,624 @@
+"""
+このファイルは、ベクターストアの検索処理（フォルダ・メタデータによる絞り込み等）が記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import asyncio
+import heapq
+import hashlib
+import itertools
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+import constants as ct
+from cache import query_embedding_cache, sentence_embedding_cache
+from resilience import embedding_caller
+
+
+############################################################
+# 設定関連
+############################################################
+# シャードへの検索を並列実行するためのスレッドプール（FAISSの検索中はGILが解放されるため並列化が有効）
+_SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=ct.SHARD_SEARCH_MAX_WORKERS, thread_name_prefix="shard-search")
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_folder_parts(source):
+    """
+    ファイルパスから、データフォルダ直下からの階層（フォルダ名のタプル）を取得
+
+    Args:
+        source: ドキュメントの「source」メタデータ
+
+    Returns:
+        フォルダ名のタプル（Webページの場合は「Web」のみ）
+    """
+    if source.startswith(('http://', 'https://')):
+        return (ct.WEB_FOLDER_LABEL,)
+
+    folder = os.path.relpath(os.path.dirname(source), ct.RAG_TOP_FOLDER_PATH)
+    if folder in (".", ""):
+        return ()
+    # macOSで作成されたフォルダ名は濁点が分解されている場合があるため、NFCで統一
+    folder = unicodedata.normalize("NFC", folder)
+    return tuple(part for part in folder.replace("\\", "/").split("/") if part)
+
+
+def sort_docs_by_folder(docs):
+    """
+    同一フォルダ配下のチャンクが連続したIDになるよう、フォルダ階層順に並び替え
+
+    Args:
+        docs: チャンク分割済みのドキュメント一覧
+
+    Returns:
+        並び替えたドキュメント一覧
+    """
+    return sorted(docs, key=lambda doc: (get_folder_parts(doc.metadata.get("source", "")), doc.metadata.get("source", "")))
+
+
+def assign_parent_ids(name, pages):
+    """
+    チャンクから分割前のページ（親）を参照できるよう、ページにIDを振る（チャンクはページのメタデータを引き継ぐ）
+
+    Args:
+        name: シャード名
+        pages: チャンク分割前のドキュメント一覧
+    """
+    for position, page in enumerate(pages):
+        page.metadata["parent_id"] = f"{name}:{position}"
+
+
+def get_shard_dir(name):
+    """
+    シャードの保存先フォルダのパスを取得
+
+    Args:
+        name: シャード名
+
+    Returns:
+        保存先フォルダのパス（日本語のフォルダ名をFAISSが扱えない環境があるため、ハッシュ値を使用）
+    """
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(ct.INDEX_DIR_PATH, f"shard_{digest}")
+
+
+def save_shard(name, fingerprint, db, pages):
+    """
+    シャードのベクターストアと、チャンク分割前のページをファイルに保存
+
+    Args:
+        name: シャード名
+        fingerprint: シャードの元ファイルから算出したフィンガープリント
+        db: FAISSのベクターストア
+        pages: チャンク分割前のドキュメント一覧
+    """
+    shard_dir = get_shard_dir(name)
+    os.makedirs(shard_dir, exist_ok=True)
+    db.save_local(shard_dir)
+
+    with open(os.path.join(shard_dir, ct.SHARD_PAGES_FILE), "w", encoding="utf-8") as f:
+        json.dump([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in pages], f, ensure_ascii=False)
+
+    # マニフェストは最後に書き込み、保存途中のシャードが読み込まれないようにする
+    with open(os.path.join(shard_dir, ct.SHARD_MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({"name": name, "fingerprint": fingerprint}, f, ensure_ascii=False)
+
+
+def load_shard(name, fingerprint, embeddings):
+    """
+    保存済みのシャードを読み込み
+
+    Args:
+        name: シャード名
+        fingerprint: 現在の元ファイルから算出したフィンガープリント
+        embeddings: 埋め込みモデル
+
+    Returns:
+        (FAISSのベクターストア, チャンク分割前のドキュメント一覧)（保存済みのシャードが存在しない・古い場合はNone）
+    """
+    shard_dir = get_shard_dir(name)
+    manifest_path = os.path.join(shard_dir, ct.SHARD_MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    # 元ファイルが更新されている場合は、保存済みのシャードを使わず再作成させる
+    if manifest.get("fingerprint") != fingerprint:
+        return None
+
+    db = FAISS.load_local(
+        shard_dir,
+        embeddings,
+        allow_dangerous_deserialization=True,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+    with open(os.path.join(shard_dir, ct.SHARD_PAGES_FILE), encoding="utf-8") as f:
+        pages = [Document(page_content=p["page_content"], metadata=p["metadata"]) for p in json.load(f)]
+    return db, pages
+
+
+async def aretrieve(index, query_vector, k, folders=None, extensions=None, score_threshold=None,
+                    search_type=ct.DEFAULT_SEARCH_TYPE, route=ct.ROUTING_ENABLED):
+    """
+    リクエストごとの検索条件で、共有のインデックスを検索
+
+    検索条件はすべて引数で受け取り、インデックス側には保持しないため、
+    異なる条件のリクエストが同時に同じインデックスを検索しても互いに影響しない
+
+    Args:
+        index: 検索対象のインデックス（ShardedIndex）
+        query_vector: 正規化済みのクエリベクトル
+        k: 取得件数
+        folders: 対象フォルダの一覧（未指定の場合は全件）
+        extensions: 対象ファイル形式の一覧（未指定の場合は全件）
+        score_threshold: 類似度の下限（未指定の場合は除外しない）
+        search_type: 検索方法（「SEARCH_TYPES」のいずれか）
+        route: フォルダの重心によるルーティングを行うかどうか
+
+    Returns:
+        (Document, 類似度スコア) のリスト（スコアの高い順）
+    """
+    if search_type not in ct.SEARCH_TYPES:
+        raise ValueError(f"未対応の検索方法です: {search_type}")
+
+    fetch_k = _fetch_k(k, search_type)
+    results = await index.asearch_by_vector(query_vector, fetch_k, folders, extensions, route, search_type == "mmr")
+    return _postprocess(query_vector, results, k, search_type, score_threshold)
+
+
+def reciprocal_rank_fusion(result_lists, k):
+    """
+    複数の質問での検索結果を、Reciprocal Rank Fusionで1つの順位に統合
+
+    各質問での順位 r（1始まり）に対し 1 / (RRF_K + r) を合計した値の高い順に並べる
+    （類似度の値は質問ごとに分布が異なるため、順位のみを使って統合する）
+
+    Args:
+        result_lists: 質問ごとの (Document, 類似度スコア) のリスト（スコアの高い順）のリスト
+        k: 統合後の件数
+
+    Returns:
+        (Document, 類似度スコア) のリスト（統合後の順位の順、スコアは各質問での類似度の最大値）
+    """
+    fused = {}
+    for results in result_lists:
+        for rank, (doc, score) in enumerate(results, start=1):
+            key = (doc.metadata.get("source"), doc.metadata.get("page"), doc.metadata.get("start_index"), doc.page_content)
+            entry = fused.setdefault(key, [doc, 0.0, score])
+            entry[1] += 1 / (ct.RRF_K + rank)
+            entry[2] = max(entry[2], score)
+    ranked = sorted(fused.values(), key=lambda entry: entry[1], reverse=True)
+    return [(doc, score) for doc, _, score in ranked[:k]]
+
+
+def cut_adaptive_k(results, min_k=ct.ADAPTIVE_K_MIN, method=ct.ADAPTIVE_K_METHOD):
+    """
+    類似度の落ち込み方に応じて、検索結果の件数を決めて打ち切る
+
+    関連する文書がはっきりしている質問では少ない件数に、関連する文書が多い質問では多めの件数になる
+    （RRFで統合した結果など、スコアの高い順に並んでいない場合は、スコアの高い順で打ち切る位置を決め、元の順番のまま残す）
+
+    Args:
+        results: (Document, 類似度スコア) のリスト（件数は上限以内）
+        min_k: 残す件数の下限
+        method: 打ち切り方（"gap" / "relative"）
+
+    Returns:
+        打ち切った (Document, 類似度スコア) のリスト
+    """
+    if len(results) <= min_k:
+        return results
+
+    order = np.argsort(-np.array([score for _, score in results], dtype=np.float32), kind="stable")
+    scores = np.array([results[i][1] for i in order], dtype=np.float32)
+    if method == "relative":
+        # 最も高い類似度に対する比率がしきい値以上の候補のみを残す
+        cut = int(np.count_nonzero(scores >= scores[0] * ct.ADAPTIVE_K_RELATIVE_THRESHOLD))
+    else:
+        # 下限以降の位置で、直前の候補との類似度の差が最も大きい位置を探す（gaps[i]は i 件目と i+1 件目の差）
+        gaps = scores[:-1] - scores[1:]
+        position = min_k - 1 + int(np.argmax(gaps[min_k - 1:]))
+        cut = position + 1 if gaps[position] >= ct.ADAPTIVE_K_MIN_GAP else len(results)
+
+    kept = set(order[:max(cut, min_k)].tolist())
+    return [item for i, item in enumerate(results) if i in kept]
+
+
+def maximal_marginal_relevance(query_vector, results, k, lambda_mult=ct.MMR_LAMBDA,
+                               max_per_source=ct.MMR_MAX_PER_SOURCE):
+    """
+    Maximal Marginal Relevance（MMR）で、クエリとの関連性が高く、互いに重複の少ない候補を選ぶ
+
+    候補どうしの類似度は1回の行列積でまとめて算出し、選択済みの候補との最大の類似度を
+    ベクトル演算で更新しながら、「λ × 関連性 - (1 - λ) × 選択済みとの最大の類似度」が最大の候補を順に選ぶ
+
+    Args:
+        query_vector: 正規化済みのクエリベクトル（1行の2次元配列）
+        results: (Document, 類似度スコア, 正規化済みのベクトル) のリスト（候補）
+        k: 選ぶ件数
+        lambda_mult: 関連性と多様性の重み（1に近いほど関連性を重視）
+        max_per_source: 同じファイルから選ぶ件数の上限（Noneの場合は制限なし）
+
+    Returns:
+        (Document, 類似度スコア) のリスト（選んだ順）
+    """
+    if not results:
+        return []
+
+    vectors = np.vstack([vector for _, _, vector in results])
+    relevance = vectors @ query_vector[0]
+    similarity = vectors @ vectors.T
+
+    sources = [doc.metadata.get("source") for doc, _, _ in results]
+    source_counts = {}
+    available = np.ones(len(results), dtype=bool)
+    max_similarity = np.full(len(results), -np.inf, dtype=np.float32)
+
+    selected = []
+    while len(selected) < k and available.any():
+        # 1件目は選択済みの候補がないため、関連性のみで選ぶ
+        redundancy = max_similarity if selected else np.zeros_like(max_similarity)
+        mmr_scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        i = int(np.argmax(mmr_scores))
+        selected.append(i)
+        available[i] = False
+        max_similarity = np.maximum(max_similarity, similarity[:, i])
+
+        # 同じファイルから上限の件数を選んだ場合、そのファイルの残りの候補は除外
+        source_counts[sources[i]] = source_counts.get(sources[i], 0) + 1
+        if max_per_source and source_counts[sources[i]] >= max_per_source:
+            available &= np.array([source != sources[i] for source in sources])
+
+    return [(results[i][0], results[i][1]) for i in selected]
+
+
+def _fetch_k(k, search_type):
+    # 検索方法に応じて、インデックスから取得する候補の件数を決定
+    if search_type == "adaptive":
+        return ct.ADAPTIVE_K_MAX
+    if search_type == "mmr":
+        return max(k, ct.MMR_FETCH_K)
+    return k
+
+
+def _postprocess(query_vector, results, k, search_type, score_threshold):
+    # 検索方法に応じた件数の調整・候補の選択と、類似度の下限による除外
+    if search_type == "adaptive":
+        results = cut_adaptive_k(results)[:k]
+    elif search_type == "mmr":
+        results = maximal_marginal_relevance(query_vector, results, k)
+    return _filter_by_score(results, score_threshold)
+
+
+def _filter_by_score(results, score_threshold):
+    # 類似度がしきい値に満たないドキュメントは、関連性が低いものとして除外（スコアの高い順は維持）
+    if score_threshold is None:
+        return results
+    return [(doc, score) for doc, score in results if score >= score_threshold]
+
+
+############################################################
+# クラス定義
+############################################################
+
+class IndexScope:
+    """
+    チャンクIDとフォルダ・ファイル形式の対応表
+
+    チャンクはフォルダ階層順にIDを振っているため、各フォルダは連続したID範囲になる
+    絞り込み検索時は、ID範囲から作成したビットマップをFAISSに渡して該当範囲だけを探索する
+    """
+
+    def __init__(self, docs):
+        self.size = len(docs)
+        # フォルダ（「MTG議事録/顧客」など、上位階層も含む） → (開始ID, 終了ID)
+        self.folder_ranges = {}
+        # フォルダ → (開始ID, 終了ID)（配下のフォルダを含まず、フォルダ直下のファイルのみ）
+        self.direct_ranges = {}
+        # ファイル拡張子 → チャンクIDの配列
+        self.extension_ids = {}
+
+        extension_lists = {}
+        for i, doc in enumerate(docs):
+            source = doc.metadata.get("source", "")
+            parts = get_folder_parts(source)
+            for depth in range(1, len(parts) + 1):
+                folder = "/".join(parts[:depth])
+                start, _ = self.folder_ranges.get(folder, (i, i))
+                self.folder_ranges[folder] = (start, i + 1)
+            # フォルダ直下のファイルは、配下のフォルダより先に並ぶため連続したID範囲になる
+            if parts:
+                folder = "/".join(parts)
+                start, _ = self.direct_ranges.get(folder, (i, i))
+                self.direct_ranges[folder] = (start, i + 1)
+
+            if source.startswith(('http://', 'https://')):
+                extension = ct.WEB_FOLDER_LABEL
+            else:
+                extension = os.path.splitext(source)[1].lower()
+            extension_lists.setdefault(extension, []).append(i)
+
+        self.extension_ids = {
+            extension: np.array(ids, dtype=np.int64) for extension, ids in extension_lists.items()
+        }
+
+    def folders(self):
+        return sorted(self.folder_ranges)
+
+    def extensions(self):
+        return sorted(self.extension_ids)
+
+    def build_bitmap(self, folders=None, extensions=None, direct_folders=None):
+        """
+        絞り込み条件に該当するチャンクIDのビットマップを作成
+
+        Args:
+            folders: 対象フォルダの一覧（配下のフォルダを含む）
+            extensions: 対象ファイル形式の一覧
+            direct_folders: 対象フォルダの一覧（配下のフォルダを含まない）
+
+        Returns:
+            FAISSのIDSelectorBitmap用のビット列（該当なしの場合はNone）
+        """
+        mask = np.ones(self.size, dtype=bool)
+
+        for selected, ranges in ((folders, self.folder_ranges), (direct_folders, self.direct_ranges)):
+            if not selected:
+                continue
+            folder_mask = np.zeros(self.size, dtype=bool)
+            for folder in selected:
+                if folder in ranges:
+                    start, end = ranges[folder]
+                    folder_mask[start:end] = True
+            mask &= folder_mask
+
+        if extensions:
+            extension_mask = np.zeros(self.size, dtype=bool)
+            for extension in extensions:
+                if extension in self.extension_ids:
+                    extension_mask[self.extension_ids[extension]] = True
+            mask &= extension_mask
+
+        if not mask.any():
+            return None
+        return np.packbits(mask, bitorder="little")
+
+
+class IndexShard:
+    """
+    データフォルダ直下のフォルダ単位で作成したベクターストア
+
+    シャードごとに作成・保存・読み込みができるため、一部のフォルダの文書が更新された場合も
+    他のシャードには影響を与えずに再作成できる
+    """
+
+    def __init__(self, name, db, fingerprint="", pages=None):
+        self.name = name
+        self.db = db
+        self.fingerprint = fingerprint
+        # チャンク分割前のページ（「pages.json」に保存済み）、チャンクの「parent_id」から親のページを参照する
+        # （起動時のフレーズインデックスの作成にも全ページを使うため、読み込み時にすべてメモリ上に保持する）
+        self.pages = pages or []
+        # 絞り込み用の対応表は、ベクターストア内のチャンクの並び順から作成
+        docs = [db.docstore.search(db.index_to_docstore_id[i]) for i in range(db.index.ntotal)]
+        self.scope = IndexScope(docs)
+
+        # ルーティング用に、フォルダ直下のチャンクのベクトルの重心（正規化済み）をフォルダごとに算出
+        vectors = db.index.reconstruct_n(0, db.index.ntotal)
+        self.centroid_folders = list(self.scope.direct_ranges)
+        self.centroids = np.array(
+            [vectors[start:end].mean(axis=0) for start, end in self.scope.direct_ranges.values()],
+            dtype=np.float32
+        ).reshape(len(self.centroid_folders), db.index.d)
+        faiss.normalize_L2(self.centroids)
+
+    def search(self, vector, k, folders=None, extensions=None, direct_folders=None, with_vectors=False):
+        """
+        埋め込み済みのクエリベクトルで、絞り込み条件に該当するチャンクを検索
+
+        Args:
+            vector: 正規化済みのクエリベクトル（1行の2次元配列）
+            k: 取得件数
+            folders: 対象フォルダの一覧（未指定の場合は全件）
+            extensions: 対象ファイル形式の一覧（未指定の場合は全件）
+            direct_folders: ルーティングで選ばれたフォルダの一覧（配下のフォルダを含まない）
+            with_vectors: チャンクのベクトルも返すかどうか（再度の埋め込みは行わず、インデックスから復元する）
+
+        Returns:
+            (Document, 類似度スコア) のリスト（スコアの高い順）
+            「with_vectors」がTrueの場合は、(Document, 類似度スコア, 正規化済みのベクトル) のリスト
+        """
+        search_params = None
+        if folders or extensions or direct_folders:
+            bitmap = self.scope.build_bitmap(folders, extensions, direct_folders)
+            if bitmap is None:
+                return []
+            # FAISSの検索時に、ビットマップで指定したIDのみを探索させる（bitmapは検索完了まで参照を保持）
+            search_params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(self.scope.size, faiss.swig_ptr(bitmap)))
+
+        scores, ids = self.db.index.search(vector, k, params=search_params)
+
+        results = []
+        for score, i in zip(scores[0], ids[0]):
+            # 該当件数がkに満たない場合、FAISSは-1を返す
+            if i == -1:
+                continue
+            doc = self.db.docstore.search(self.db.index_to_docstore_id[i])
+            results.append((doc, float(score)))
+
+        if with_vectors and results:
+            vectors = self.db.index.reconstruct_batch(ids[0][ids[0] != -1].astype(np.int64))
+            faiss.normalize_L2(vectors)
+            results = [(doc, score, v) for (doc, score), v in zip(results, vectors)]
+        return results
+
+
+class ShardedIndex:
+    """
+    複数のシャードをまとめて検索するインデックス
+
+    クエリは1度だけ埋め込み、各シャードへの検索をスレッドで並列実行した後、
+    シャードごとの上位k件をヒープでマージする
+    作成後は読み取り専用で、プロセス全体（複数のセッション・スレッド）から同時に検索できる
+    """
+
+    def __init__(self, shards, embeddings):
+        self.shards = {shard.name: shard for shard in shards}
+        self.embeddings = embeddings
+        # いずれかのシャードが再作成されると変わる、インデックス全体のバージョン
+        self.version = hashlib.sha256(
+            json.dumps(sorted((shard.name, shard.fingerprint) for shard in shards), ensure_ascii=False).encode("utf-8")
+        ).hexdigest()[:16]
+
+        # 全シャードのフォルダの重心を1つの行列にまとめ、ルーティング時に1回の行列積で類似度を算出
+        self._routing_keys = [(shard.name, folder) for shard in shards for folder in shard.centroid_folders]
+        self._routing_centroids = (
+            np.vstack([shard.centroids for shard in shards])
+            if self._routing_keys else np.zeros((0, 0), dtype=np.float32)
+        )
+
+    def folders(self):
+        return sorted(itertools.chain.from_iterable(shard.scope.folder_ranges for shard in self.shards.values()))
+
+    def extensions(self):
+        return sorted(set(itertools.chain.from_iterable(shard.scope.extension_ids for shard in self.shards.values())))
+
+    def get_parent(self, doc):
+        """
+        チャンクの分割前のページ（親）を取得
+
+        Args:
+            doc: チャンク
+
+        Returns:
+            親のページ（ページのIDを記録する前に作成したシャードのチャンクの場合はNone）
+        """
+        parent_id = doc.metadata.get("parent_id")
+        if parent_id is None:
+            return None
+        name, _, position = parent_id.rpartition(":")
+        shard = self.shards.get(name)
+        if shard is None or not position.isdigit() or int(position) >= len(shard.pages):
+            return None
+        return shard.pages[int(position)]
+
+    def route(self, vector, folders=None):
+        """
+        クエリベクトルとフォルダの重心の類似度から、検索対象とするフォルダを選択
+
+        Args:
+            vector: 正規化済みのクエリベクトル（1行の2次元配列）
+            folders: 対象フォルダの一覧（指定された場合は、その配下のフォルダからのみ選択）
+
+        Returns:
+            シャード名 → 選択したフォルダのリスト の辞書（候補のフォルダ数が少なくルーティング不要の場合はNone）
+        """
+        candidates = [
+            i for i, (_, folder) in enumerate(self._routing_keys)
+            if not folders or any(folder == f or folder.startswith(f + "/") for f in folders)
+        ]
+        # フォルダ数が少ない場合は全件検索のほうが取りこぼしがなく、十分に速い
+        if len(candidates) <= ct.ROUTING_MIN_FOLDERS:
+            return None
+
+        scores = self._routing_centroids[candidates] @ vector[0]
+        routed = {}
+        for i in np.argsort(-scores)[:ct.ROUTING_TOP_FOLDERS]:
+            shard_name, folder = self._routing_keys[candidates[i]]
+            routed.setdefault(shard_name, []).append(folder)
+        return routed
+
+    async def aembed_query(self, query):
+        """
+        クエリを埋め込み、検索用に正規化したベクトルを返す（同じクエリはプロセス全体のキャッシュから取得）
+
+        埋め込みAPIの応答待ちの間、イベントループをブロックしない
+        """
+        # 埋め込みAPIの呼び出しには、リトライ・ヘッジ・サーキットブレーカーを適用
+        vector = await query_embedding_cache.aget_or_compute(
+            query,
+            lambda text: embedding_caller.call(lambda: self.embeddings.aembed_query(text)),
+            namespace=getattr(self.embeddings, "model", "")
+        )
+        vector = np.array([vector], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    async def aembed_documents(self, texts):
+        """
+        複数の文を埋め込み、正規化したベクトルの行列を返す（キャッシュにない文のみを、まとめて埋め込みAPIに送る）
+        """
+        namespace = getattr(self.embeddings, "model", "")
+        vectors = [sentence_embedding_cache.get(text, namespace) for text in texts]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            # 埋め込みAPIの呼び出しには、リトライ・ヘッジ・サーキットブレーカーを適用
+            computed = dict(zip(missing, await embedding_caller.call(lambda: self.embeddings.aembed_documents(missing))))
+            for text, vector in computed.items():
+                sentence_embedding_cache.put(text, vector, namespace)
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        matrix = np.array(vectors, dtype=np.float32)
+        faiss.normalize_L2(matrix)
+        return matrix
+
+    async def asearch_by_vector(self, vector, k, folders=None, extensions=None, route=False, with_vectors=False):
+        """
+        埋め込み済みのクエリベクトルで、絞り込み条件に該当するチャンクを全シャードから検索
+
+        各シャードへの検索はスレッドプールで実行し、その完了を待つ（引数は「IndexShard.search」と同じ）
+
+        Args:
+            route: フォルダの重心によるルーティングを行うかどうか
+
+        Returns:
+            (Document, 類似度スコア) のリスト（スコアの高い順）
+        """
+        plans = self._plan_search(vector, folders, route)
+        if not plans:
+            return []
+
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(
+                _SEARCH_EXECUTOR, shard.search, vector, k, shard_folders, extensions, direct_folders, with_vectors
+            )
+            for shard, shard_folders, direct_folders in plans
+        ])
+        return self._merge_results(k, results)
+
+    def _plan_search(self, vector, folders, route):
+        # 検索するシャードと、シャードごとの絞り込み条件（配下を含むフォルダ, フォルダ直下のみのフォルダ）を決定
+        routed = self.route(vector, folders) if route else None
+        if routed is not None:
+            # ルーティングで選ばれたフォルダに加え、フォルダに属さないデータフォルダ直下のファイルも検索
+            plans = [(self.shards[name], None, direct) for name, direct in routed.items()]
+            if ct.ROOT_SHARD_NAME in self.shards and not folders:
+                plans.append((self.shards[ct.ROOT_SHARD_NAME], None, None))
+        elif folders:
+            # フォルダが指定された場合、該当フォルダを含むシャードのみを検索
+            target_names = {folder.split("/")[0] for folder in folders}
+            plans = [(shard, folders, None) for name, shard in self.shards.items() if name in target_names]
+        else:
+            plans = [(shard, None, None) for shard in self.shards.values()]
+        return plans
+
+    def _merge_results(self, k, results_per_shard):
+        # シャードごとの上位k件を、スコアの高い順にk件までマージ
+        return heapq.nlargest(
+            k,
+            itertools.chain.from_iterable(results_per_shard),
+            key=lambda result: result[1]
+        )
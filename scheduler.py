@@ -0,0 +1,220 @@
+"""
+このファイルは、全セッションからのLLM呼び出しの流量を制御するスケジューラーが記述されたファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import time
+import asyncio
+import threading
+from collections import deque
+import constants as ct
+
+
+############################################################
+# クラス定義
+############################################################
+
+class LLMRateLimitError(Exception):
+    """
+    セッションごとのLLM呼び出し回数の上限を超えた場合に送出する例外
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLMの呼び出し回数の上限を超えました（{retry_after}秒後に再試行可能）")
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    """
+    実行枠の割り当てを待つ、1回分のLLM呼び出し
+    """
+
+    def __init__(self, session_id, tokens, future):
+        self.session_id = session_id
+        self.tokens = tokens
+        self.future = future
+        # 実行枠が割り当てられた時刻と、トークン使用量の記録（[時刻, トークン数]）
+        self.started_at = None
+        self.usage = None
+        # 実際に使用したトークン数（呼び出し元が設定した場合、解放時に使用量を補正）
+        self.used_tokens = None
+
+
+class LLMScheduler:
+    """
+    LLM呼び出しの実行枠を割り当てるスケジューラー
+
+    - 同時実行数の上限と、直近1分間のトークン使用量の上限（TPM）を超えないよう、呼び出しを待機させる
+    - 待機中の呼び出しはセッションごとに並べ、セッション間で順番に（ラウンドロビンで）実行枠を割り当てる
+    - セッションごとに、一定時間内の呼び出し回数を制限する
+    実行枠の割り当て・解放は共有のイベントループ上で行い、待機状況は画面表示用に他のスレッドからも参照できる
+    """
+
+    def __init__(self, max_concurrency, tokens_per_minute, session_rate_limit, session_rate_window):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.session_rate_limit = session_rate_limit
+        self.session_rate_window = session_rate_window
+        self._lock = threading.Lock()
+        self._active = 0
+        # セッションID → 待機中の呼び出しのキュー
+        self._queues = {}
+        # 待機中の呼び出しがあるセッションIDの、実行枠を割り当てる順番
+        self._rotation = deque()
+        # 直近1分間のトークン使用量（[時刻, トークン数] のリスト）
+        self._token_usage = deque()
+        # セッションID → 直近の呼び出し時刻
+        self._session_requests = {}
+        # 1回の呼び出しにかかる時間の移動平均（待ち時間の目安の算出に使用）
+        self._avg_service_seconds = ct.LLM_INITIAL_SERVICE_SECONDS
+        self._wakeup = None
+
+    async def acquire(self, session_id, tokens, check_rate=True):
+        """
+        実行枠が割り当てられるまで待機
+
+        Args:
+            session_id: 呼び出し元のセッションID
+            tokens: 呼び出しで使用するトークン数の見積もり
+            check_rate: セッションごとの呼び出し回数の上限の対象とするかどうか
+                        （1回の質問の中で行う補助的な呼び出し（質問の言い換え・map等）はFalse）
+
+        Returns:
+            割り当てられた実行枠（「release」に渡す）
+        """
+        if check_rate:
+            self._check_session_rate(session_id)
+
+        ticket = _Ticket(session_id, tokens, asyncio.get_running_loop().create_future())
+        with self._lock:
+            if session_id not in self._queues:
+                self._queues[session_id] = deque()
+                self._rotation.append(session_id)
+            self._queues[session_id].append(ticket)
+        self._dispatch()
+
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            # 待機中に中断された場合はキューから取り除き、割り当て済みの場合は実行枠を解放
+            if ticket.started_at is None:
+                self._remove(ticket)
+                self._dispatch()
+            else:
+                self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket):
+        """
+        実行枠を解放し、待機中の呼び出しに割り当て
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._active -= 1
+            if ticket.used_tokens is not None:
+                ticket.usage[1] = ticket.used_tokens
+            self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * (now - ticket.started_at)
+        self._dispatch()
+
+    def queue_status(self, session_id):
+        """
+        セッションの待機状況を取得（画面表示用）
+
+        Returns:
+            (待機順, 待ち時間の目安[秒]) のタプル（待機中の呼び出しがない場合はNone）
+        """
+        with self._lock:
+            if session_id not in self._queues:
+                return None
+            # 各セッションに1件ずつ順番に割り当てるため、先に割り当てられるのは自分より前のセッションの1件ずつ
+            position = self._rotation.index(session_id) + 1
+            eta = position * self._avg_service_seconds / self.max_concurrency
+            return position, round(eta)
+
+    def stats(self):
+        """
+        実行中・待機中の呼び出し数と、直近1分間のトークン使用量を取得
+        """
+        with self._lock:
+            self._purge_token_usage(time.monotonic())
+            return {
+                "active": self._active,
+                "waiting": sum(len(queue) for queue in self._queues.values()),
+                "tokens_last_minute": sum(tokens for _, tokens in self._token_usage)
+            }
+
+    def _check_session_rate(self, session_id):
+        # 直近の呼び出し回数が上限に達している場合、最も古い呼び出しが期間外になるまでの秒数を添えて拒否
+        now = time.monotonic()
+        with self._lock:
+            requests = self._session_requests.setdefault(session_id, deque())
+            while requests and now - requests[0] > self.session_rate_window:
+                requests.popleft()
+            if len(requests) >= self.session_rate_limit:
+                raise LLMRateLimitError(int(self.session_rate_window - (now - requests[0])) + 1)
+            requests.append(now)
+
+    def _dispatch(self):
+        # 同時実行数・トークン使用量の上限の範囲で、セッションを順番に巡って待機中の呼び出しに実行枠を割り当てる
+        now = time.monotonic()
+        with self._lock:
+            self._purge_token_usage(now)
+            used = sum(tokens for _, tokens in self._token_usage)
+
+            while self._active < self.max_concurrency and self._rotation:
+                session_id = self._rotation[0]
+                ticket = self._queues[session_id][0]
+
+                # トークン使用量の上限を超える場合は、最も古い使用量が期間外になった時点で再開
+                # （1回で上限を超える呼び出しも、使用量が0になれば実行する）
+                if used and used + ticket.tokens > self.tokens_per_minute:
+                    self._schedule_wakeup(60 - (now - self._token_usage[0][0]))
+                    break
+
+                self._queues[session_id].popleft()
+                self._rotation.popleft()
+                if self._queues[session_id]:
+                    self._rotation.append(session_id)
+                else:
+                    del self._queues[session_id]
+
+                if ticket.future.done():
+                    continue
+                ticket.started_at = now
+                ticket.usage = [now, ticket.tokens]
+                self._token_usage.append(ticket.usage)
+                used += ticket.tokens
+                self._active += 1
+                ticket.future.set_result(None)
+
+    def _schedule_wakeup(self, delay):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(max(delay, 0.05), self._dispatch)
+
+    def _remove(self, ticket):
+        with self._lock:
+            queue = self._queues.get(ticket.session_id)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.session_id]
+                    self._rotation.remove(ticket.session_id)
+
+    def _purge_token_usage(self, now):
+        while self._token_usage and now - self._token_usage[0][0] > 60:
+            self._token_usage.popleft()
+
+
+############################################################
+# プロセス全体で共有するスケジューラー
+############################################################
+llm_scheduler = LLMScheduler(
+    ct.LLM_MAX_CONCURRENCY,
+    ct.LLM_TOKENS_PER_MINUTE,
+    ct.SESSION_RATE_LIMIT_REQUESTS,
+    ct.SESSION_RATE_LIMIT_WINDOW_SECONDS
+)
@@ -0,0 +1,10 @@
+"""
+テスト共通の設定
+
+アプリのモジュールはリポジトリ直下に置かれているため、リポジトリ直下を読み込み先に追加する
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,98 @@
+"""
+map_reduce・refineでの回答の用意（utils.aprepare_answer）のテスト
+"""
+
+import asyncio
+import pytest
+from langchain_core.documents import Document
+import constants as ct
+from resilience import ResilientCaller
+from resources import registry, run_async
+import utils
+
+
+class RecordingChain:
+    """
+    呼び出しの入力値と同時実行数を記録し、「answer」で作成した文章を返すチェーン
+    """
+
+    def __init__(self, name, answer=None, delay=0.0):
+        self.name = name
+        self.answer = answer or (lambda inputs: f"{name}の出力")
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+
+    async def ainvoke(self, inputs):
+        self.calls.append(inputs)
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            return self.answer(inputs)
+        finally:
+            self.running -= 1
+
+
+@pytest.fixture
+def chains(monkeypatch):
+    chains = {
+        ct.SYSTEM_PROMPT_MAP: RecordingChain("map", delay=0.02),
+        ct.SYSTEM_PROMPT_REFINE: RecordingChain("refine"),
+        "answer": RecordingChain("answer"),
+    }
+    monkeypatch.setattr(utils, "llm_caller", ResilientCaller("llm"))
+    monkeypatch.setattr(registry, "get_chain", lambda *args: chains["answer"])
+    monkeypatch.setattr(registry, "get_prompt_chain", lambda system_prompt, *args: chains[system_prompt])
+    return chains
+
+
+def make_groups(count):
+    return [[Document(page_content=f"{i}番目のグループの文書", metadata={"source": f"{i}.txt"})] for i in range(count)]
+
+
+def prepare(strategy, groups):
+    return run_async(utils.aprepare_answer(strategy, groups, "有給休暇の申請方法", "strategy-test"))
+
+
+def test_map_reduce_runs_maps_concurrently_up_to_limit(chains, monkeypatch):
+    monkeypatch.setattr(ct, "MAP_MAX_CONCURRENCY", 2)
+    chains[ct.SYSTEM_PROMPT_MAP].answer = lambda inputs: f"{inputs['context'][0].metadata['source']}の要点"
+    groups = make_groups(5)
+
+    chain, inputs, system_prompt = prepare("map_reduce", groups)
+
+    map_chain = chains[ct.SYSTEM_PROMPT_MAP]
+    assert len(map_chain.calls) == 5
+    # 同時に行うmap呼び出しは、1回の質問ごとの上限まで
+    assert map_chain.peak == 2
+    # 最後の呼び出し（reduce）は回答用のチェーンで、mapの出力をグループの順に文脈とする
+    assert chain is chains["answer"] and system_prompt == ct.SYSTEM_PROMPT_INQUIRY
+    assert [doc.page_content for doc in inputs["context"]] == [f"{i}.txtの要点" for i in range(5)]
+    assert chains["answer"].calls == []
+
+
+def test_map_reduce_with_no_information_gives_empty_context(chains):
+    chains[ct.SYSTEM_PROMPT_MAP].answer = lambda inputs: f"{ct.MAP_NO_INFO_ANSWER}。"
+
+    chain, inputs, _ = prepare("map_reduce", make_groups(3))
+
+    assert chain is chains["answer"]
+    assert inputs["context"] == []
+
+
+def test_refine_with_two_groups_makes_two_calls(chains):
+    groups = make_groups(2)
+
+    chain, inputs, system_prompt = prepare("refine", groups)
+    # 最後の呼び出しは、呼び出し元で行う
+    run_async(chain.ainvoke(inputs))
+
+    assert len(chains["answer"].calls) == 1 and chains["answer"].calls[0]["context"] == groups[0]
+    assert len(chains[ct.SYSTEM_PROMPT_REFINE].calls) == 1
+    assert chain is chains[ct.SYSTEM_PROMPT_REFINE] and system_prompt == ct.SYSTEM_PROMPT_REFINE
+    # 最初のグループでの回答を、最後のグループで改善する
+    assert inputs["context"] == groups[1]
+    assert "answerの出力" in inputs["input"]
+    assert chains[ct.SYSTEM_PROMPT_MAP].calls == []
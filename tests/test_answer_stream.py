@@ -0,0 +1,80 @@
+"""
+回答のストリーム（utils.open_answer_stream）が、表示されずに破棄された場合もLLMの実行枠を解放することのテスト
+"""
+
+import gc
+import time
+from resources import run_async
+from scheduler import llm_scheduler
+import utils
+
+
+class FakeChain:
+    """
+    決まったトークンを返すチェーン
+    """
+
+    async def astream(self, inputs):
+        for token in ["社内", "文書"]:
+            yield token
+
+
+def open_stream(response):
+    async def open_():
+        ticket = await llm_scheduler.acquire("test-session", 10, check_rate=False)
+        return utils.open_answer_stream(FakeChain(), {}, response, time.perf_counter(), ticket, 10)
+    return run_async(open_())
+
+
+def wait_for_idle(timeout=2.0):
+    # 破棄時の後処理は共有のイベントループで非同期に実行されるため、完了を待つ
+    end = time.monotonic() + timeout
+    while llm_scheduler.stats()["active"] and time.monotonic() < end:
+        time.sleep(0.01)
+    return llm_scheduler.stats()["active"]
+
+
+def test_consumed_stream_releases_ticket():
+    response = {}
+    stream = open_stream(response)
+    assert llm_scheduler.stats()["active"] == 1
+
+    async def consume():
+        return [token async for token in stream]
+
+    assert run_async(consume()) == ["社内", "文書"]
+    assert response["result"] == "社内文書"
+    assert llm_scheduler.stats()["active"] == 0
+
+
+def test_unstarted_stream_releases_ticket_on_close():
+    tokens_before = llm_scheduler.stats()["tokens_last_minute"]
+    stream = open_stream({})
+    assert llm_scheduler.stats()["active"] == 1
+
+    run_async(stream.aclose())
+    assert llm_scheduler.stats()["active"] == 0
+    # 生成を開始していないため、トークン使用量の予約も取り消される
+    assert llm_scheduler.stats()["tokens_last_minute"] == tokens_before
+
+
+def test_unstarted_stream_releases_ticket_when_dropped():
+    stream = open_stream({})
+    assert llm_scheduler.stats()["active"] == 1
+
+    # 画面の表示が始まる前に画面が再実行された場合と同じく、閉じずに破棄
+    del stream
+    gc.collect()
+    assert wait_for_idle() == 0
+
+
+def test_unstarted_stream_releases_ticket_when_sync_wrapper_dropped():
+    from resources import iterate_async
+
+    tokens = iterate_async(open_stream({}))
+    assert llm_scheduler.stats()["active"] == 1
+
+    # 同期ジェネレーターも開始前に破棄されると「finally」が実行されないため、非同期側の破棄で解放される
+    del tokens
+    gc.collect()
+    assert wait_for_idle() == 0
@@ -0,0 +1,157 @@
+"""
+プロセス全体で共有するキャッシュ（cache）のテスト
+"""
+
+import time
+import asyncio
+import numpy as np
+import constants as ct
+from cache import AnswerCache, QueryEmbeddingCache, normalize_query
+
+
+def test_normalize_query():
+    assert normalize_query("　有給休暇の　　申請 ") == "有給休暇の 申請"
+    assert normalize_query("ＡＢＣ１２３") == "ABC123"
+
+
+def test_embedding_cache_hits_on_normalized_query():
+    cache = QueryEmbeddingCache(max_size=10)
+    calls = []
+
+    def compute(query):
+        calls.append(query)
+        return [1.0, 0.0]
+
+    cache.get_or_compute("有給休暇 の申請", compute)
+    vector = cache.get_or_compute("有給休暇　の申請", compute)
+
+    assert calls == ["有給休暇 の申請"]
+    assert vector.dtype == np.float32
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_embedding_cache_separates_namespaces():
+    cache = QueryEmbeddingCache(max_size=10)
+    cache.put("質問", [1.0], namespace="model-a")
+
+    assert cache.get("質問", namespace="model-b") is None
+    assert cache.get("質問", namespace="model-a") is not None
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = QueryEmbeddingCache(max_size=2)
+    cache.put("A", [1.0])
+    cache.put("B", [2.0])
+    # 参照したエントリは最近使用として扱われ、削除の対象外になる
+    cache.get("A")
+    cache.put("C", [3.0])
+
+    assert cache.get("B") is None
+    assert cache.get("A") is not None and cache.get("C") is not None
+
+
+def test_embedding_cache_save_and_load(tmp_path):
+    path = str(tmp_path / "query_embeddings.npz")
+    cache = QueryEmbeddingCache(max_size=10)
+    cache.put("有給休暇", [0.6, 0.8], namespace="model")
+    cache.save(path)
+
+    loaded = QueryEmbeddingCache(max_size=10, path=path)
+    assert np.allclose(loaded.get("有給休暇", namespace="model"), [0.6, 0.8])
+
+
+def test_embedding_cache_saves_vectors_of_different_dimensions(tmp_path, monkeypatch):
+    monkeypatch.setattr(ct, "QUERY_EMBEDDING_CACHE_SAVE_INTERVAL", 3)
+    path = str(tmp_path / "query_embeddings.npz")
+    cache = QueryEmbeddingCache(max_size=10, path=path)
+    # 埋め込みモデルを変更した後も、変更前のモデルのベクトルがキャッシュに残る
+    cache.put("質問1", np.ones(4), namespace="old-model")
+    cache.put("質問2", np.ones(8), namespace="new-model")
+    # 保存の間隔に達し、「put」の中で保存される
+    cache.put("質問3", np.ones(8), namespace="new-model")
+
+    loaded = QueryEmbeddingCache(max_size=10, path=path)
+    # 保存時のLRUの順を保つ
+    assert list(loaded._entries) == [("old-model", "質問1"), ("new-model", "質問2"), ("new-model", "質問3")]
+    assert loaded.get("質問1", namespace="old-model").shape == (4,)
+    assert loaded.get("質問3", namespace="new-model").shape == (8,)
+
+
+def test_embedding_cache_save_failure_is_not_raised(tmp_path):
+    cache = QueryEmbeddingCache(max_size=10)
+    cache.put("質問", [1.0])
+    # 保存先がディレクトリの場合など、保存できなくても例外を伝えない
+    cache.save(str(tmp_path))
+    assert cache.get("質問") is not None
+
+
+def test_async_compute_is_cached():
+    cache = QueryEmbeddingCache(max_size=10)
+    calls = 0
+
+    async def acompute(query):
+        nonlocal calls
+        calls += 1
+        return [1.0]
+
+    async def scenario():
+        await cache.aget_or_compute("質問", acompute)
+        await cache.aget_or_compute("質問", acompute)
+
+    asyncio.run(scenario())
+    assert calls == 1
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_answer_cache_exact_hit_requires_same_mode_and_params():
+    cache = AnswerCache(max_size=10, ttl_seconds=60, similarity_threshold=0.95)
+    cache.put("社内文書検索", "有給休暇", "v1", "回答", params=(5,))
+
+    assert cache.get("社内文書検索", "有給休暇　", "v1", params=(5,)) == ("回答", "exact")
+    assert cache.get("社内問い合わせ", "有給休暇", "v1", params=(5,)) is None
+    assert cache.get("社内文書検索", "有給休暇", "v1", params=(10,)) is None
+
+
+def test_answer_cache_semantic_hit_above_threshold():
+    cache = AnswerCache(max_size=10, ttl_seconds=60, similarity_threshold=0.95)
+    cache.put("社内問い合わせ", "有給休暇の日数は？", "v1", "回答", vector=unit(1.0, 0.0))
+
+    assert cache.get("社内問い合わせ", "有給は何日？", "v1", vector=unit(1.0, 0.1)) == ("回答", "semantic")
+    assert cache.get("社内問い合わせ", "経費の精算方法", "v1", vector=unit(0.0, 1.0)) is None
+    # 呼び出し側でしきい値を厳しくした場合は、類似する入力値でも再利用しない
+    assert cache.get("社内問い合わせ", "有給は何日？", "v1", vector=unit(1.0, 0.1), similarity_threshold=0.999) is None
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_answer_cache_expires_entries(monkeypatch):
+    cache = AnswerCache(max_size=10, ttl_seconds=60, similarity_threshold=0.95)
+    cache.put("社内文書検索", "有給休暇", "v1", "回答")
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert cache.get("社内文書検索", "有給休暇", "v1") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_answer_cache_is_cleared_when_index_version_changes():
+    cache = AnswerCache(max_size=10, ttl_seconds=60, similarity_threshold=0.95)
+    cache.put("社内文書検索", "有給休暇", "v1", "回答")
+
+    assert cache.get("社内文書検索", "有給休暇", "v2") is None
+    # 古いバージョンに戻しても、破棄した回答は返さない
+    assert cache.get("社内文書検索", "有給休暇", "v1") is None
+
+
+def test_answer_cache_evicts_least_recently_used():
+    cache = AnswerCache(max_size=2, ttl_seconds=60, similarity_threshold=0.95)
+    cache.put("社内文書検索", "A", "v1", "回答A")
+    cache.put("社内文書検索", "B", "v1", "回答B")
+    cache.get("社内文書検索", "A", "v1")
+    cache.put("社内文書検索", "C", "v1", "回答C")
+
+    assert cache.get("社内文書検索", "B", "v1") is None
+    assert cache.get("社内文書検索", "A", "v1") == ("回答A", "exact")
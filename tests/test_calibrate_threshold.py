@@ -0,0 +1,39 @@
+"""
+類似度のしきい値の算出（calibrate_threshold）のテスト
+"""
+
+import json
+from calibrate_threshold import choose_threshold, load_labelled_queries
+
+
+def test_threshold_separates_relevant_and_irrelevant():
+    scored = [(0.82, True), (0.75, True), (0.70, True), (0.55, False), (0.40, False)]
+    threshold, recall, rejection = choose_threshold(scored, min_recall=1.0)
+
+    # 関連ありの最小値と関連なしの最大値の中間で、両者を完全に分けられる
+    assert abs(threshold - 0.625) < 1e-9
+    assert (recall, rejection) == (1.0, 1.0)
+
+
+def test_threshold_keeps_min_recall():
+    scored = [(0.80, True), (0.60, True), (0.50, True), (0.50, False), (0.30, False)]
+
+    # 関連ありの質問を1件も落とせない場合、同点の関連なしの質問は除外できない
+    threshold, recall, rejection = choose_threshold(scored, min_recall=1.0)
+    assert threshold <= 0.50 and recall == 1.0 and rejection == 0.5
+
+    # 再現率の下限を下げると、より多くの関連なしの質問を除外できる
+    threshold, recall, rejection = choose_threshold(scored, min_recall=0.6)
+    assert threshold > 0.50 and recall >= 0.6 and rejection == 1.0
+
+
+def test_threshold_without_irrelevant_queries_is_zero():
+    assert choose_threshold([(0.8, True), (0.7, True)], min_recall=0.95) == (0.0, 1.0, 0.0)
+
+
+def test_load_labelled_queries(tmp_path):
+    path = tmp_path / "queries.jsonl"
+    lines = [{"query": "有給休暇の日数は？", "relevant": True}, {"query": "今日の天気は？", "relevant": False}]
+    path.write_text("\n".join(json.dumps(line, ensure_ascii=False) for line in lines) + "\n\n", encoding="utf-8")
+
+    assert load_labelled_queries(str(path)) == [("有給休暇の日数は？", True), ("今日の天気は？", False)]
@@ -0,0 +1,148 @@
+"""
+文脈の組み立て（context.py）のテスト
+"""
+
+import asyncio
+import numpy as np
+from langchain_core.documents import Document
+import constants as ct
+from context import (
+    acompress_context, choose_answer_strategy, expand_to_parents, group_documents, join_overlapping, lexical_scores,
+    pack_context, select_sentences, split_sentences
+)
+from utils import count_tokens
+
+
+PAGE = "".join(f"{i:03d}番目の文です。" for i in range(200))
+
+
+class FakeIndex:
+    """
+    すべてのチャンクの親として、同じページを返すインデックス
+    """
+
+    def get_parent(self, doc):
+        return Document(page_content=PAGE, metadata={"source": "a.txt"})
+
+
+def chunk(start, length=50):
+    return Document(page_content=PAGE[start:start + length], metadata={"source": "a.txt", "start_index": start})
+
+
+def test_window_contains_chunk_and_records_its_position():
+    doc = chunk(1000)
+    [(expanded, score)] = expand_to_parents(FakeIndex(), [(doc, 0.9)], "window")
+
+    start = expanded.metadata["start_index"]
+    assert score == 0.9
+    assert start == 1000 - ct.PARENT_WINDOW_CHUNKS * ct.chunk_size_num
+    assert PAGE[start:start + len(expanded.page_content)] == expanded.page_content
+    assert doc.page_content in expanded.page_content
+
+
+def test_chunk_with_unknown_position_is_not_expanded():
+    # チャンク分割時にページ内の位置を特定できなかったチャンク（start_index = -1）は、そのまま使う
+    doc = Document(page_content="位置が不明なチャンク", metadata={"source": "a.txt", "start_index": -1})
+    assert expand_to_parents(FakeIndex(), [(doc, 0.5)], "window") == [(doc, 0.5)]
+
+
+def test_mode_none_keeps_results():
+    results = [(chunk(0), 0.8)]
+    assert expand_to_parents(FakeIndex(), results, "none") is results
+
+
+def test_pack_context_merges_overlapping_chunks_of_same_page():
+    # 重なるチャンク2件は重複を除いて1つの文章にまとめ、離れたチャンクは別の文章として類似度の順に並べる
+    results = [(chunk(1000), 0.9), (chunk(0, 100), 0.7), (chunk(60, 100), 0.8)]
+    packed = pack_context(results, max_tokens=100000)
+
+    assert [doc.page_content for doc in packed] == [PAGE[1000:1050], PAGE[0:160]]
+
+
+def test_pack_context_stops_at_token_budget():
+    results = [(chunk(0), 0.9), (chunk(1000), 0.8), (chunk(1500), 0.7)]
+    budget = count_tokens(PAGE[0:50]) + count_tokens(PAGE[1000:1050])
+
+    assert [doc.page_content for doc in pack_context(results, max_tokens=budget)] == [PAGE[0:50], PAGE[1000:1050]]
+    # 最初の文章だけで上限を超える場合は、上限までに切り詰めて1件だけ残す
+    [truncated] = pack_context(results, max_tokens=5)
+    assert count_tokens(truncated.page_content) <= 5 and PAGE.startswith(truncated.page_content)
+
+
+def test_join_overlapping_by_position():
+    assert join_overlapping(chunk(0, 100), chunk(60, 100)) == PAGE[0:160]
+    # 区切り文字の分だけ離れたチャンクは、区切り文字で連結する
+    assert join_overlapping(chunk(0, 100), chunk(100 + len(ct.CHUNK_SEPARATOR))) == (
+        PAGE[0:100] + ct.CHUNK_SEPARATOR + PAGE[101:151]
+    )
+    assert join_overlapping(chunk(0, 100), chunk(500)) is None
+
+
+def test_join_overlapping_by_text_without_position():
+    prev_doc = Document(page_content=PAGE[0:100], metadata={"source": "a.txt"})
+    doc = Document(page_content=PAGE[70:170], metadata={"source": "a.txt"})
+    assert join_overlapping(prev_doc, doc) == PAGE[0:170]
+
+    # 重なりが「CONTEXT_MIN_OVERLAP_CHARS」未満の場合は、隣り合うとみなさない
+    short = Document(page_content=PAGE[100 - ct.CONTEXT_MIN_OVERLAP_CHARS + 1:200], metadata={"source": "a.txt"})
+    assert join_overlapping(prev_doc, short) is None
+
+
+COMPRESSIBLE = "有給休暇は入社6か月後に付与されます。社員食堂は11時から営業します。有給休暇の申請は3日前までです。駐車場は予約制です。"
+
+
+class SlowEmbeddingIndex:
+    """
+    文の埋め込みが時間内に完了しないインデックス
+    """
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(1.0)
+        return np.zeros((len(texts), 2), dtype=np.float32)
+
+
+def test_split_sentences():
+    assert split_sentences("最初の文。次の文！\n\n最後の文") == ["最初の文。", "次の文！", "最後の文"]
+
+
+def test_lexical_scores_rank_overlapping_sentences_higher():
+    scores = lexical_scores(["有給休暇の申請方法", "社員食堂の営業時間", ""], "有給休暇を申請したい")
+    assert scores[0] > scores[1] and scores[2] == 0.0
+
+
+def test_select_sentences_keeps_best_until_ratio_in_original_order():
+    sentences = ["あああああ", "いいいいい", "ううううう", "えええええ"]
+
+    assert select_sentences(sentences, [0.1, 0.9, 0.2, 0.8], 0.5) == ["いいいいい", "えええええ"]
+    # 比率が0でも、最低1文は残す
+    assert select_sentences(sentences, [0.1, 0.9, 0.2, 0.8], 0.0) == ["いいいいい"]
+
+
+def test_compression_falls_back_to_lexical_scores_on_timeout():
+    docs = [
+        Document(page_content=COMPRESSIBLE, metadata={"source": "a.txt"}),
+        Document(page_content="短い文書です。", metadata={"source": "b.txt"})
+    ]
+    compressed = asyncio.run(acompress_context(
+        SlowEmbeddingIndex(), docs, "有給休暇の申請", np.zeros((1, 2), dtype=np.float32), timeout=0.01
+    ))
+
+    # 質問と語句が重なる文のみを元の順に残し、文の数が少ない文書はそのまま使う
+    assert compressed[0].page_content == "有給休暇は入社6か月後に付与されます。\n有給休暇の申請は3日前までです。"
+    assert compressed[0].metadata == {"source": "a.txt"}
+    assert compressed[1] is docs[1]
+
+
+def test_group_documents_keeps_order_within_budget():
+    docs = [Document(page_content=PAGE[i:i + 50]) for i in (0, 50, 100)]
+    budget = count_tokens(docs[0].page_content) + count_tokens(docs[1].page_content)
+
+    assert group_documents(docs, max_tokens=budget) == [docs[:2], docs[2:]]
+    # 1件で上限を超えるドキュメントは、単独のグループとする
+    assert group_documents(docs, max_tokens=1) == [[doc] for doc in docs]
+
+
+def test_choose_answer_strategy():
+    assert choose_answer_strategy(ct.CONTEXT_MAX_TOKENS, 1) == "stuff"
+    assert choose_answer_strategy(ct.CONTEXT_MAX_TOKENS + 1, 2) == "refine"
+    assert choose_answer_strategy(ct.CONTEXT_MAX_TOKENS + 1, 3) == "map_reduce"
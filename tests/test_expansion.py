@@ -0,0 +1,21 @@
+"""
+クエリ拡張（expansion）のテスト
+"""
+
+from expansion import parse_paraphrases, rule_based_paraphrases
+
+
+def test_rule_based_paraphrases_strip_question_and_apply_synonyms():
+    assert rule_based_paraphrases("有給の取り方について教えてください") == ["有給の取り方", "年次有給休暇の取り方"]
+
+
+def test_rule_based_paraphrases_exclude_original_query():
+    assert rule_based_paraphrases("年次有給休暇") == []
+
+
+def test_parse_paraphrases_removes_bullets_and_duplicates():
+    text = "1. 年次有給休暇の申請方法\n- 有給休暇　の申請方法\n・有給休暇 の申請方法\n\n有給休暇の申請方法\n休暇の手続き"
+
+    # 正規化後に同じになる言い換えは、最初のものだけを残す
+    assert parse_paraphrases("有給休暇の申請方法", text, count=2) == ["年次有給休暇の申請方法", "有給休暇　の申請方法"]
+    assert parse_paraphrases("有給休暇の申請方法", text)[-1] == "休暇の手続き"
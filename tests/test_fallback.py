@@ -0,0 +1,50 @@
+"""
+締め切り・障害時の代わりの回答（utils.acompute_llm_response 等）のテスト
+"""
+
+import asyncio
+import httpx
+import openai
+import constants as ct
+from cache import answer_cache
+import utils
+
+
+SEARCH_KWARGS = {"k": 3, "search_type": "similarity", "folders": (), "extensions": ()}
+PARAMS = tuple(sorted(SEARCH_KWARGS.items()))
+
+
+class FailingEmbeddingIndex:
+    """
+    クエリの埋め込みが常に失敗する（埋め込みAPIに接続できない）インデックス
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.calls = 0
+
+    async def aembed_query(self, text):
+        self.calls += 1
+        raise openai.APIConnectionError(request=httpx.Request("POST", "http://127.0.0.1/v1/embeddings"))
+
+
+def test_embedding_failure_returns_exact_cached_answer():
+    index = FailingEmbeddingIndex("embedding-failure-cached")
+    cached = {"query": "有給の申請方法", "result": "キャッシュ済みの回答", "source_documents": []}
+    answer_cache.put(ct.ANSWER_MODE_2, "有給の申請方法", index.version, cached, PARAMS)
+
+    response = asyncio.run(utils.acompute_llm_response(index, ct.ANSWER_MODE_2, "有給の申請方法", SEARCH_KWARGS))
+
+    assert response["result"] == "キャッシュ済みの回答"
+    assert response["notice"] == ct.LLM_UNAVAILABLE_NOTICE.format(fallback=ct.FALLBACK_CACHED_ANSWER_LABEL)
+
+
+def test_embedding_failure_without_cache_returns_notice():
+    index = FailingEmbeddingIndex("embedding-failure-uncached")
+
+    response = asyncio.run(utils.acompute_llm_response(index, ct.ANSWER_MODE_2, "経費の精算方法", SEARCH_KWARGS))
+
+    assert index.calls == 1
+    assert response["result"] == ct.UNAVAILABLE_ANSWER
+    assert response["source_documents"] == []
+    assert response["notice"] == ct.LLM_UNAVAILABLE_NOTICE.format(fallback=ct.FALLBACK_SOURCES_LABEL)
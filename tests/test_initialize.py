@@ -0,0 +1,107 @@
+"""
+シャードの作成・読み込み（initialize.build_sharded_index 等）のテスト
+"""
+
+import os
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+import constants as ct
+import initialize
+from initialize import build_sharded_index, compute_shard_fingerprint
+
+
+class LengthEmbeddings(Embeddings):
+    """
+    文字数から正規化済みのベクトルを作成する埋め込みモデル（APIを呼ばない）
+    """
+
+    def embed_query(self, text):
+        vector = np.array([1.0, len(text) % 7 + 1.0, len(text) % 5 + 1.0], dtype=np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    data = tmp_path / "data"
+    (data / "人事").mkdir(parents=True)
+    (data / "人事" / "就業規則.txt").write_text("有給休暇は入社6か月後に付与されます。", encoding="utf-8")
+    (data / "営業").mkdir()
+    (data / "営業" / "顧客.txt").write_text("顧客との取引実績をまとめています。", encoding="utf-8")
+
+    monkeypatch.setattr(ct, "RAG_TOP_FOLDER_PATH", str(data))
+    monkeypatch.setattr(ct, "INDEX_DIR_PATH", str(tmp_path / "index"))
+    monkeypatch.setattr(ct, "WEB_URL_LOAD_TARGETS", [])
+    monkeypatch.setattr(initialize.registry, "get_embeddings", LengthEmbeddings)
+    return data
+
+
+@pytest.fixture
+def built_shards(monkeypatch):
+    # シャードを（読み込みではなく）作成した回数を、シャード名ごとに記録
+    built = []
+    build_shard_db = initialize.build_shard_db
+
+    def spy(pages, embeddings):
+        built.append(pages[0].metadata["parent_id"].rpartition(":")[0])
+        return build_shard_db(pages, embeddings)
+
+    monkeypatch.setattr(initialize, "build_shard_db", spy)
+    return built
+
+
+def test_fingerprint_changes_with_mtime_and_content(data_dir):
+    path = data_dir / "人事" / "就業規則.txt"
+    targets = [str(data_dir / "人事")]
+    embeddings = LengthEmbeddings()
+    original = compute_shard_fingerprint("人事", targets, embeddings)
+    assert compute_shard_fingerprint("人事", targets, embeddings) == original
+
+    # 内容が同じでも、更新日時が変われば再作成する
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    touched = compute_shard_fingerprint("人事", targets, embeddings)
+    assert touched != original
+
+    # 内容が変われば、更新日時を元に戻しても再作成する
+    path.write_text("有給休暇は入社6か月後に10日付与されます。", encoding="utf-8")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert compute_shard_fingerprint("人事", targets, embeddings) not in (original, touched)
+
+
+def test_unchanged_shards_are_reused(data_dir, built_shards):
+    first, _ = build_sharded_index(force_rebuild=set())
+    assert sorted(built_shards) == ["人事", "営業"]
+
+    built_shards.clear()
+    second, pages = build_sharded_index(force_rebuild=set())
+    # 元ファイルが変わらないシャードは、保存済みのものを読み込む
+    assert built_shards == []
+    assert second.version == first.version
+    assert len(pages) == 2
+
+
+def test_only_changed_shard_is_rebuilt(data_dir, built_shards):
+    first, _ = build_sharded_index(force_rebuild=set())
+    built_shards.clear()
+
+    path = data_dir / "営業" / "顧客.txt"
+    path.write_text("顧客との取引実績と、今後の提案予定をまとめています。", encoding="utf-8")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    second, _ = build_sharded_index(force_rebuild=set())
+
+    assert built_shards == ["営業"]
+    assert second.version != first.version
+
+
+def test_force_rebuild_from_environment(data_dir, built_shards, monkeypatch):
+    build_sharded_index(force_rebuild=set())
+    built_shards.clear()
+
+    monkeypatch.setenv(ct.FORCE_REBUILD_SHARDS_ENV, " 人事 ")
+    build_sharded_index()
+    assert built_shards == ["人事"]
@@ -0,0 +1,216 @@
+"""
+「社内問い合わせ」モードの回答処理（utils.aget_inquiry_response・acompute_llm_response）のテスト
+"""
+
+import time
+import asyncio
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+import constants as ct
+from cache import answer_cache
+from resilience import ResilientCaller
+from resources import registry, run_async
+import utils
+
+
+QUESTION = "有給の申請方法について教えてください"
+SEARCH_KWARGS = {"k": 3, "search_type": "similarity", "folders": (), "extensions": ()}
+
+
+def unit(*values):
+    vector = np.array([values], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class FakeIndex:
+    """
+    どのクエリベクトルに対しても、指定したスコアの候補を返すインデックス
+    """
+
+    def __init__(self, scores, version="inquiry-test", vectors=None):
+        self.scores = scores
+        self.version = version
+        # 入力値 → クエリベクトル（指定がない入力値は共通のベクトル）
+        self.vectors = vectors or {}
+        self.searches = []
+
+    async def aembed_query(self, text):
+        return self.vectors.get(text, unit(1, 1, 1, 1))
+
+    async def asearch_by_vector(self, vector, k, folders=None, extensions=None, route=False, with_vectors=False):
+        self.searches.append(k)
+        return [
+            (Document(page_content=f"{i}番目の候補です。", metadata={"source": f"data/{i}.txt"}), score)
+            for i, score in enumerate(self.scores[:k])
+        ]
+
+    def get_parent(self, doc):
+        return None
+
+
+class FakeChain:
+    """
+    「delay」秒ごとに決まったトークンを返すチェーン（呼び出しの入力値を記録する）
+    """
+
+    def __init__(self, tokens=("社内", "文書", "の", "回答"), delay=0.0):
+        self.tokens = tokens
+        self.delay = delay
+        self.calls = []
+
+    async def ainvoke(self, inputs):
+        self.calls.append(inputs)
+        await asyncio.sleep(self.delay * len(self.tokens))
+        return "".join(self.tokens)
+
+    async def astream(self, inputs):
+        self.calls.append(inputs)
+        for token in self.tokens:
+            await asyncio.sleep(self.delay)
+            yield token
+
+
+def sources_fallback(source_documents, notice):
+    # 生成の代わりに、文脈に詰めたドキュメントと注意書きをそのまま返す
+    return {"query": "", "result": "", "source_documents": source_documents, "notice": notice}
+
+
+@pytest.fixture(autouse=True)
+def test_settings(monkeypatch):
+    # テストごとに、所要時間の記録・サーキットブレーカーの状態を持たないLLMの呼び出しを使う
+    monkeypatch.setattr(utils, "llm_caller", ResilientCaller("llm"))
+    # 言い換えは規則に基づいて行い、文の埋め込みによる文脈の圧縮は行わない
+    monkeypatch.setattr(ct, "QUERY_EXPANSION_METHOD", "rule")
+    monkeypatch.setattr(ct, "CONTEXT_COMPRESSION_ENABLED", False)
+
+
+@pytest.fixture
+def llm_unavailable(monkeypatch):
+    # 生成の直前で、検索結果のみを返す
+    monkeypatch.setattr(utils.llm_caller, "is_open", lambda: True)
+
+
+@pytest.fixture
+def chain(monkeypatch):
+    chain = FakeChain()
+    monkeypatch.setattr(registry, "get_chain", lambda *args: chain)
+    monkeypatch.setattr(registry, "get_prompt_chain", lambda *args: chain)
+    return chain
+
+
+def inquire(index, search_kwargs, deadline=None):
+    return asyncio.run(utils.aget_inquiry_response(
+        index, QUESTION, unit(1, 1, 1, 1), search_kwargs, deadline=deadline, fallback=sources_fallback
+    ))
+
+
+@pytest.mark.usefixtures("llm_unavailable")
+def test_adaptive_cut_applies_with_expansion_only(monkeypatch):
+    monkeypatch.setattr(ct, "RERANK_ENABLED", False)
+    monkeypatch.setattr(ct, "QUERY_EXPANSION_ENABLED", True)
+    index = FakeIndex([0.90, 0.89, 0.88, 0.70, 0.69, 0.68, 0.67, 0.66])
+
+    response = inquire(index, {"k": 6, "search_type": "adaptive", "folders": (), "extensions": ()})
+
+    # 統合の候補は件数を減らさずに取得し、統合後の類似度の落ち込みで打ち切る
+    assert set(index.searches) == {6}
+    assert [doc.metadata["source"] for doc in response["source_documents"]] == [
+        "data/0.txt", "data/1.txt", "data/2.txt"
+    ]
+
+
+@pytest.mark.usefixtures("llm_unavailable")
+def test_irrelevant_question_skips_query_expansion(monkeypatch):
+    monkeypatch.setattr(ct, "QUERY_EXPANSION_ENABLED", True)
+    expanded = []
+
+    async def fake_expand(user_message, session_id="", deadline=None):
+        expanded.append(user_message)
+        return ["有給休暇の申請"]
+
+    monkeypatch.setattr(utils, "aexpand_query", fake_expand)
+    search_kwargs = {"k": 4, "search_type": "similarity", "folders": (), "extensions": ()}
+
+    # 元の質問での類似度がしきい値を下回る場合は、言い換え（LLM呼び出し）を行わずに「情報なし」と回答
+    response = inquire(FakeIndex([ct.INQUIRY_SCORE_THRESHOLD - 0.1]), search_kwargs)
+    assert response["result"] == ct.INQUIRY_NO_MATCH_ANSWER
+    assert expanded == []
+
+    # しきい値以上の場合は言い換え、元の質問では再度検索せずに、言い換えた質問での検索結果と統合する
+    index = FakeIndex([0.90, 0.85, 0.80])
+    response = inquire(index, search_kwargs)
+    assert len(expanded) == 1
+    assert len(index.searches) == 2
+    assert len(response["source_documents"]) == 3
+
+
+def compute(index, user_message=QUESTION, stream=False, deadline_seconds=None, session_id="inquiry-test"):
+    deadline = None if deadline_seconds is None else time.perf_counter() + deadline_seconds
+    return run_async(utils.acompute_llm_response(
+        index, ct.ANSWER_MODE_2, user_message, SEARCH_KWARGS, stream, session_id=session_id, deadline=deadline
+    ))
+
+
+def test_expected_generation_time_over_deadline_returns_sources(chain):
+    index = FakeIndex([0.90, 0.85, 0.80], version="deadline-sources")
+    # 直近の生成時間から見て、締め切りまでに生成が完了しない見込みの状態にする
+    utils.llm_caller._latencies.append(5.0)
+
+    response = compute(index, deadline_seconds=1.0)
+
+    assert chain.calls == []
+    assert response["result"] == ""
+    assert len(response["source_documents"]) == 3
+    assert response["notice"] == ct.DEADLINE_EXCEEDED_NOTICE.format(fallback=ct.FALLBACK_SOURCES_LABEL)
+
+
+def test_generation_timeout_returns_similar_cached_answer(chain):
+    similar = "有給休暇の申請方法は？"
+    index = FakeIndex([0.90, 0.85, 0.80], version="deadline-cached", vectors={
+        similar: unit(1, 0, 0, 0),
+        # 通常のキャッシュのしきい値には届かないが、代わりの回答としては十分に類似した質問
+        QUESTION: unit(0.9, 0.436, 0, 0)
+    })
+    cached = {"query": similar, "result": "キャッシュ済みの回答", "source_documents": []}
+    answer_cache.put(ct.ANSWER_MODE_2, similar, index.version, cached, tuple(sorted(SEARCH_KWARGS.items())),
+                     unit(1, 0, 0, 0))
+    chain.delay = 1.0
+
+    response = compute(index, deadline_seconds=0.3)
+
+    assert len(chain.calls) == 1
+    assert response["result"] == "キャッシュ済みの回答"
+    assert response["notice"] == ct.DEADLINE_EXCEEDED_NOTICE.format(fallback=ct.FALLBACK_CACHED_ANSWER_LABEL)
+
+
+def test_stream_cut_at_deadline_is_not_cached(chain):
+    index = FakeIndex([0.90, 0.85, 0.80], version="deadline-stream")
+    chain.tokens = tuple(f"{i}番目" for i in range(20))
+    chain.delay = 0.05
+
+    response = compute(index, stream=True, deadline_seconds=0.3, session_id="deadline-stream")
+
+    async def consume():
+        return [token async for token in response["result_stream"]]
+
+    tokens = run_async(consume())
+    # 締め切りの時点までのトークンで打ち切り、注意書きを付ける
+    assert 0 < len(tokens) < len(chain.tokens)
+    assert response["result"] == "".join(tokens)
+    assert response["notice"] == ct.DEADLINE_TRUNCATED_NOTICE
+    # 途中で打ち切った回答は、回答キャッシュに保存しない
+    assert answer_cache.get(ct.ANSWER_MODE_2, QUESTION, index.version, tuple(sorted(SEARCH_KWARGS.items()))) is None
+
+
+def test_completed_stream_is_cached(chain):
+    index = FakeIndex([0.90, 0.85, 0.80], version="completed-stream")
+
+    response = compute(index, stream=True, session_id="completed-stream")
+
+    async def consume():
+        return [token async for token in response["result_stream"]]
+
+    assert "".join(run_async(consume())) == "社内文書の回答"
+    cached = answer_cache.get(ct.ANSWER_MODE_2, QUESTION, index.version, tuple(sorted(SEARCH_KWARGS.items())))
+    assert cached[0]["result"] == "社内文書の回答" and "notice" not in cached[0]
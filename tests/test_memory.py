@@ -0,0 +1,48 @@
+"""
+LLMとのやりとり用の会話履歴（memory）のテスト
+"""
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from memory import ConversationMemory, is_follow_up
+
+
+def test_is_follow_up():
+    assert is_follow_up("それの申請期限は？")
+    assert is_follow_up("上記の内容をもう少し詳しく")
+    assert is_follow_up("夏季休暇は？")
+    assert not is_follow_up("人事部に所属している従業員情報を一覧化して")
+    assert not is_follow_up("有給休暇の申請方法を教えてください")
+
+
+def test_memory_keeps_recent_turns_and_pushes_out_old_ones():
+    memory = ConversationMemory(max_turns=2)
+    assert not memory
+
+    for i in range(1, 4):
+        memory.add_turn(f"質問{i}", f"回答{i}")
+
+    assert memory
+    assert memory.pending_turns() == [("質問1", "回答1")]
+    # 要約に畳み込む前のやりとりも、原文のままメッセージに含める
+    assert [m.content for m in memory.to_messages()] == ["質問1", "回答1", "質問2", "回答2", "質問3", "回答3"]
+
+
+def test_fold_replaces_pending_turns_with_summary():
+    memory = ConversationMemory(max_turns=1)
+    for i in range(1, 4):
+        memory.add_turn(f"質問{i}", f"回答{i}")
+    # 要約の作成中に押し出されたやりとりは、要約待ちに残る
+    memory.fold("質問1と質問2の要約", 1)
+
+    assert memory.pending_turns() == [("質問2", "回答2")]
+    messages = memory.to_messages()
+    assert isinstance(messages[0], SystemMessage) and "質問1と質問2の要約" in messages[0].content
+    assert [type(m) for m in messages[1:]] == [HumanMessage, AIMessage, HumanMessage, AIMessage]
+
+
+def test_to_messages_without_recent_turns():
+    memory = ConversationMemory(max_turns=1)
+    memory.add_turn("質問1", "回答1")
+    memory.add_turn("質問2", "回答2")
+
+    assert [m.content for m in memory.to_messages(include_recent=False)] == ["質問1", "回答1"]
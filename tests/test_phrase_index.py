@@ -0,0 +1,56 @@
+"""
+完全一致（フレーズ）検索用のインデックス（phrase_index）のテスト
+"""
+
+from langchain_core.documents import Document
+from phrase_index import PhraseIndex, build_phrase_index, extract_quoted_phrase, normalize_text
+
+
+def make_index():
+    return build_phrase_index([
+        Document(page_content="有給休暇は\n入社6か月後に付与されます。", metadata={"source": "data/就業規則.pdf", "page": 10}),
+        Document(page_content="有給休暇の申請方法", metadata={"source": "data/就業規則.pdf", "page": 2}),
+        Document(page_content="ＡＢＣ株式会社との取引実績", metadata={"source": "data/顧客.txt"}),
+        Document(page_content="休暇と有給の違い", metadata={"source": "data/FAQ.txt"}),
+    ])
+
+
+def test_normalize_text_absorbs_width_case_and_whitespace():
+    assert normalize_text("ＡＢＣ　株式\n会社") == "abc株式会社"
+    assert normalize_text(None) == ""
+
+
+def test_postings_keep_every_position():
+    index = PhraseIndex(n=2)
+    index.add("a.txt", None, "あいあいあ")
+
+    assert len(index) == 1
+    assert list(index._postings["あい"][0]) == [0, 2]
+    assert list(index._postings["いあ"][0]) == [1, 3]
+
+
+def test_search_returns_all_pages_in_order():
+    # 改行をまたぐフレーズも一致し、結果はファイルパス・ページ番号順に並ぶ
+    assert make_index().search("有給休暇") == [
+        {"source": "data/就業規則.pdf", "page": 2},
+        {"source": "data/就業規則.pdf", "page": 10},
+    ]
+    assert make_index().search("休暇は入社") == [{"source": "data/就業規則.pdf", "page": 10}]
+
+
+def test_search_requires_contiguous_match():
+    # すべてのn-gramを含んでいても、連続して出現しないページは一致しない
+    assert make_index().search("有給と休暇") == []
+    assert make_index().search("存在しない語句") == []
+
+
+def test_search_normalizes_query_and_short_phrases():
+    assert make_index().search("abc株式会社") == [{"source": "data/顧客.txt", "page": None}]
+    # n文字未満のフレーズは、全ページを直接照合する
+    assert len(make_index().search("休")) == 3
+    assert make_index().search("  ") == []
+
+
+def test_extract_quoted_phrase():
+    assert extract_quoted_phrase("「有給休暇」が載っている資料は？") == "有給休暇"
+    assert extract_quoted_phrase("有給休暇について教えて") is None
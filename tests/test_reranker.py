@@ -0,0 +1,81 @@
+"""
+再ランキング（reranker）のテスト
+"""
+
+import sys
+import logging
+import pytest
+from langchain_core.documents import Document
+import constants as ct
+import reranker
+from reranker import CrossEncoderReranker, LexicalReranker, Reranker, get_reranker, register_reranker
+
+
+def candidates():
+    return [
+        (Document(page_content="社員食堂の営業時間は11時から14時です。", metadata={"source": "data/食堂.txt"}), 0.801),
+        (Document(page_content="有給休暇の申請は、取得日の3日前までに行ってください。", metadata={"source": "data/就業規則.pdf"}), 0.800),
+        (Document(page_content="出張旅費の精算は、翌月末までに行ってください。", metadata={"source": "data/経費.pdf"}), 0.500),
+    ]
+
+
+@pytest.fixture(autouse=True)
+def restore_registry():
+    factories = dict(reranker._RERANKER_FACTORIES)
+    yield
+    reranker._RERANKER_FACTORIES.clear()
+    reranker._RERANKER_FACTORIES.update(factories)
+    reranker._rerankers.clear()
+
+
+def test_lexical_reranker_prefers_matching_text():
+    reranked = LexicalReranker().rerank("有給休暇の申請期限", candidates(), top_n=3)
+
+    # 類似度がほぼ同じ候補の間では、質問と語句が重なる候補が先頭になる
+    assert reranked[0][0].metadata["source"] == "data/就業規則.pdf"
+    assert [score for _, score in reranked] == sorted([score for _, score in reranked], reverse=True)
+
+
+def test_rerank_keeps_top_n():
+    assert len(LexicalReranker().rerank("有給休暇", candidates(), top_n=2)) == 2
+    assert LexicalReranker().rerank("有給休暇", [], top_n=2) == []
+
+
+def test_incomplete_reranker_fails_on_instantiation():
+    class Incomplete(Reranker):
+        name = "incomplete"
+
+    register_reranker(Incomplete.name, Incomplete)
+    with pytest.raises(TypeError):
+        get_reranker(Incomplete.name)
+
+
+def test_registered_reranker_is_created_once():
+    class Reverse(Reranker):
+        name = "reverse"
+
+        def score(self, query, results):
+            return [-score for _, score in results]
+
+    register_reranker(Reverse.name, Reverse)
+    first = get_reranker(Reverse.name)
+
+    assert get_reranker(Reverse.name) is first
+    assert first.rerank("", candidates(), top_n=1)[0][0].metadata["source"] == "data/経費.pdf"
+    with pytest.raises(ValueError):
+        get_reranker("unknown")
+
+
+def test_cross_encoder_falls_back_when_model_is_unavailable(monkeypatch, caplog):
+    # モデルのライブラリを読み込めない環境を再現する
+    monkeypatch.setitem(sys.modules, "sentence_transformers", None)
+    cross_encoder = CrossEncoderReranker()
+
+    with caplog.at_level(logging.WARNING, logger=ct.LOGGER_NAME):
+        reranked = cross_encoder.rerank("有給休暇の申請期限", candidates(), top_n=3)
+
+    assert [doc for doc, _ in reranked] == [doc for doc, _ in LexicalReranker().rerank("有給休暇の申請期限", candidates(), top_n=3)]
+    assert any(
+        isinstance(record.msg, dict) and "rerank_model_unavailable" in record.msg
+        for record in caplog.records
+    )
@@ -0,0 +1,184 @@
+"""
+リトライ・ヘッジ・サーキットブレーカー（resilience.ResilientCaller）のテスト
+"""
+
+import time
+import asyncio
+import httpx
+import openai
+import pytest
+import constants as ct
+from resilience import CircuitOpenError, ResilientCaller
+
+
+def transient_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://127.0.0.1/v1/chat/completions"))
+
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    # 待ち時間を短くして、テストをすぐに終わらせる
+    monkeypatch.setattr(ct, "RETRY_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(ct, "RETRY_BASE_DELAY_SECONDS", 0.001)
+    monkeypatch.setattr(ct, "RETRY_MAX_DELAY_SECONDS", 0.005)
+    monkeypatch.setattr(ct, "HEDGE_MIN_SAMPLES", 5)
+    monkeypatch.setattr(ct, "CIRCUIT_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(ct, "CIRCUIT_RESET_SECONDS", 0.05)
+
+
+class FlakyCall:
+    """
+    最初の「failures」回は一時的な障害で失敗し、その後は「result」を返す呼び出し
+    """
+
+    def __init__(self, failures, result="回答", error=transient_error):
+        self.failures = failures
+        self.result = result
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error()
+        return self.result
+
+
+def test_transient_errors_are_retried():
+    caller = ResilientCaller("test")
+    call = FlakyCall(failures=2)
+
+    assert asyncio.run(caller.call(call)) == "回答"
+    assert call.calls == 3
+    assert caller.stats()["retries"] == 2
+    assert caller.stats()["state"] == "closed"
+
+
+def test_gives_up_after_max_attempts():
+    caller = ResilientCaller("test")
+    call = FlakyCall(failures=10)
+
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(caller.call(call))
+    assert call.calls == ct.RETRY_MAX_ATTEMPTS
+
+
+def test_non_transient_errors_are_not_retried():
+    caller = ResilientCaller("test")
+    call = FlakyCall(failures=1, error=lambda: ValueError("リクエストの誤り"))
+
+    with pytest.raises(ValueError):
+        asyncio.run(caller.call(call))
+    assert call.calls == 1
+    assert caller.stats()["state"] == "closed"
+
+
+def test_no_hedge_until_enough_samples():
+    caller = ResilientCaller("test")
+    for _ in range(ct.HEDGE_MIN_SAMPLES - 1):
+        asyncio.run(caller.call(FlakyCall(failures=0)))
+    assert caller.hedge_delay() is None
+
+
+def test_slow_call_is_hedged_and_faster_copy_wins():
+    caller = ResilientCaller("test")
+    caller._latencies.extend([0.01] * ct.HEDGE_MIN_SAMPLES)
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        # 1件目は応答が遅く、ヘッジで送った2件目は速く応答する
+        await asyncio.sleep(2.0 if calls == 1 else 0.0)
+        return f"{calls}件目"
+
+    started_at = time.perf_counter()
+    result = asyncio.run(caller.call(factory))
+
+    assert result == "2件目"
+    assert time.perf_counter() - started_at < 1.0
+    assert caller.stats()["hedges"] == 1
+    assert caller.stats()["hedge_wins"] == 1
+
+
+def test_circuit_opens_after_consecutive_failures():
+    caller = ResilientCaller("test")
+    call = FlakyCall(failures=100)
+
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(caller.call(call))
+    assert caller.is_open()
+
+    # 開いている間は、呼び出さずに即座に失敗させる
+    calls = call.calls
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(caller.call(call))
+    assert call.calls == calls
+
+
+def test_half_open_probe_success_closes_circuit():
+    caller = ResilientCaller("test")
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(caller.call(FlakyCall(failures=100)))
+    assert caller.is_open()
+
+    time.sleep(ct.CIRCUIT_RESET_SECONDS + 0.01)
+    assert caller.breaker.state == "half_open"
+
+    assert asyncio.run(caller.call(FlakyCall(failures=0))) == "回答"
+    assert caller.breaker.state == "closed"
+
+
+def test_half_open_probe_failure_reopens_circuit():
+    caller = ResilientCaller("test")
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(caller.call(FlakyCall(failures=100)))
+
+    time.sleep(ct.CIRCUIT_RESET_SECONDS + 0.01)
+    call = FlakyCall(failures=100)
+    # 試しの1件が失敗すると再び開き、以降の再試行は行わない
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(caller.call(call))
+    assert call.calls == 1
+    assert caller.is_open()
+
+
+def test_half_open_allows_only_one_probe():
+    async def scenario():
+        caller = ResilientCaller("test")
+        with pytest.raises(openai.APIConnectionError):
+            await caller.call(FlakyCall(failures=100))
+        await asyncio.sleep(ct.CIRCUIT_RESET_SECONDS + 0.01)
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "回答"
+
+        probe = asyncio.create_task(caller.call(slow))
+        await asyncio.sleep(0)
+        # 試しの呼び出しの完了前に来た呼び出しは、即座に失敗させる
+        with pytest.raises(CircuitOpenError):
+            await caller.call(slow)
+        return await probe, caller.breaker.state
+
+    assert asyncio.run(scenario()) == ("回答", "closed")
+
+
+def test_stream_retries_before_first_item():
+    caller = ResilientCaller("test")
+    calls = 0
+
+    async def tokens():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise transient_error()
+        for token in ["社内", "文書"]:
+            yield token
+
+    async def consume():
+        return [token async for token in caller.stream(tokens)]
+
+    assert asyncio.run(consume()) == ["社内", "文書"]
+    assert calls == 2
+    assert caller.stats()["retries"] == 1
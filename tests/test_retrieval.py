@@ -0,0 +1,296 @@
+"""
+検索処理（retrieval.py）のテスト
+"""
+
+import asyncio
+import hashlib
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+import constants as ct
+from retrieval import (
+    IndexShard, ShardedIndex, aretrieve, cut_adaptive_k, maximal_marginal_relevance, reciprocal_rank_fusion, sort_docs_by_folder
+)
+
+
+def scored(scores):
+    return [(Document(page_content=str(i), metadata={"source": f"{i}.txt"}), score) for i, score in enumerate(scores)]
+
+
+class FakeIndex:
+    """
+    指定したスコアの候補を返し、要求された取得件数を記録するインデックス
+    """
+
+    def __init__(self, scores):
+        self.scores = scores
+        self.requested_k = None
+
+    async def asearch_by_vector(self, vector, k, folders=None, extensions=None, route=False, with_vectors=False):
+        self.requested_k = k
+        return scored(self.scores[:k])
+
+
+def test_cut_at_largest_gap():
+    assert len(cut_adaptive_k(scored([0.90, 0.88, 0.60, 0.59, 0.58]))) == 2
+    assert len(cut_adaptive_k(scored([0.90, 0.89, 0.88, 0.87, 0.50]))) == 4
+
+
+def test_no_cut_when_scores_decline_smoothly():
+    results = scored([0.900, 0.895, 0.890, 0.885])
+    assert cut_adaptive_k(results) == results
+
+
+def test_cut_keeps_minimum():
+    # 1件目と2件目の差が最も大きくても、下限より前では打ち切らない
+    assert len(cut_adaptive_k(scored([0.90, 0.50, 0.49, 0.30]), min_k=3)) == 3
+
+
+def test_relative_cut():
+    results = scored([0.90, 0.85, 0.80, 0.70])
+    assert len(cut_adaptive_k(results, method="relative")) == 2
+
+
+def test_cut_keeps_order_of_unsorted_results():
+    # RRFで統合した結果のように類似度の順に並んでいない場合も、落ち込みより後の候補のみを除き、順番は保つ
+    results = scored([0.88, 0.60, 0.90, 0.59, 0.89])
+    assert [doc.page_content for doc, _ in cut_adaptive_k(results)] == ["0", "2", "4"]
+
+
+def test_adaptive_fetches_pool_then_applies_k():
+    scores = [0.9 - 0.001 * i for i in range(ct.ADAPTIVE_K_MAX)]
+    index = FakeIndex(scores)
+    results = asyncio.run(aretrieve(index, None, k=5, search_type="adaptive", route=False))
+
+    # 取得件数より多い候補を取得してから打ち切り、取得件数を超える分を除く
+    assert index.requested_k == ct.ADAPTIVE_K_MAX
+    assert len(results) == 5
+
+
+def test_rrf_prefers_documents_ranked_high_by_several_queries():
+    a, b, c = [doc for doc, _ in scored([0, 0, 0])]
+    fused = reciprocal_rank_fusion([[(a, 0.90), (b, 0.80)], [(b, 0.70), (c, 0.60)], [(b, 0.75), (a, 0.50)]], k=3)
+
+    # 複数の質問で上位に現れる文書が先頭になり、スコアは各質問での類似度の最大値を持つ
+    assert fused == [(b, 0.80), (a, 0.90), (c, 0.60)]
+    assert reciprocal_rank_fusion([[(a, 0.9), (b, 0.8)]], k=1) == [(a, 0.9)]
+
+
+def test_rrf_merges_equal_chunks_from_different_queries():
+    first = Document(page_content="本文", metadata={"source": "a.txt", "page": 1, "start_index": 0})
+    second = Document(page_content="本文", metadata={"source": "a.txt", "page": 1, "start_index": 0})
+
+    assert reciprocal_rank_fusion([[(first, 0.6)], [(second, 0.8)]], k=5) == [(first, 0.8)]
+
+
+def candidate(name, source, *values):
+    vector = np.array(values, dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    return (Document(page_content=name, metadata={"source": source}), float(vector[0]), vector)
+
+
+QUERY = np.array([[1.0, 0.0, 0.0]], dtype=np.float32)
+
+
+def test_mmr_skips_near_duplicates():
+    results = [
+        candidate("A", "a.txt", 0.9, 0.436, 0.0),
+        candidate("Aの重複", "b.txt", 0.88, 0.44, 0.07),
+        candidate("B", "c.txt", 0.8, 0.0, 0.6),
+    ]
+
+    assert [doc.page_content for doc, _ in maximal_marginal_relevance(QUERY, results, k=2, lambda_mult=0.5)] == ["A", "B"]
+    # 関連性のみを重視する場合は、類似度の順になる
+    assert [doc.page_content for doc, _ in maximal_marginal_relevance(QUERY, results, k=2, lambda_mult=1.0)] == ["A", "Aの重複"]
+
+
+def test_mmr_limits_candidates_per_source():
+    results = [
+        candidate("1", "a.txt", 0.95, 0.31, 0.0),
+        candidate("2", "a.txt", 0.94, 0.0, 0.34),
+        candidate("3", "a.txt", 0.93, -0.37, 0.0),
+        candidate("4", "b.txt", 0.5, 0.0, -0.87),
+    ]
+
+    selected = maximal_marginal_relevance(QUERY, results, k=4, lambda_mult=1.0, max_per_source=2)
+    assert [doc.page_content for doc, _ in selected] == ["1", "2", "4"]
+    assert len(maximal_marginal_relevance(QUERY, results, k=4, lambda_mult=1.0, max_per_source=None)) == 4
+    assert maximal_marginal_relevance(QUERY, [], k=4) == []
+
+
+class HashEmbeddings(Embeddings):
+    """
+    文字バイグラムのハッシュから、正規化済みのベクトルを作成する埋め込みモデル（APIを呼ばない）
+    """
+
+    def __init__(self, dim=32):
+        self.dim = dim
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for i in range(max(len(text) - 1, 1)):
+            vector[int(hashlib.md5(text[i:i + 2].encode("utf-8")).hexdigest(), 16) % self.dim] += 1.0
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def build_db(docs, embeddings=None):
+    # 本番と同じく、フォルダ階層順に並べてから内積で検索するFAISSのベクターストアを作成
+    return FAISS.from_documents(
+        sort_docs_by_folder(docs), embedding=embeddings or HashEmbeddings(),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+
+
+def data_doc(path, text):
+    return Document(page_content=text, metadata={"source": f"{ct.RAG_TOP_FOLDER_PATH}/{path}"})
+
+
+def make_shard():
+    docs = [
+        data_doc("営業/提案.pdf", "新規顧客への提案資料"),
+        data_doc("人事/規程/就業規則.pdf", "有給休暇の付与日数"),
+        data_doc("readme.txt", "データフォルダの説明"),
+        data_doc("人事/評価.txt", "人事評価の実施時期"),
+        data_doc("人事/規程/就業規則.pdf", "始業と終業の時刻"),
+        data_doc("営業/顧客.txt", "顧客との取引実績"),
+    ]
+    return IndexShard("test", build_db(docs))
+
+
+def search_sources(shard, **filters):
+    vector = np.array([HashEmbeddings().embed_query("有給休暇")], dtype=np.float32)
+    results = shard.search(vector, shard.scope.size, **filters)
+    return sorted(doc.metadata["source"].split("/", 2)[2] for doc, _ in results)
+
+
+def test_folder_filter_includes_subfolders():
+    assert search_sources(make_shard(), folders=["人事"]) == [
+        "人事/規程/就業規則.pdf", "人事/規程/就業規則.pdf", "人事/評価.txt"
+    ]
+    assert search_sources(make_shard(), folders=["人事/規程"]) == ["人事/規程/就業規則.pdf", "人事/規程/就業規則.pdf"]
+
+
+def test_extension_filter():
+    assert search_sources(make_shard(), extensions=[".pdf"]) == [
+        "人事/規程/就業規則.pdf", "人事/規程/就業規則.pdf", "営業/提案.pdf"
+    ]
+
+
+def test_folder_and_extension_filters_combined():
+    assert search_sources(make_shard(), folders=["営業"], extensions=[".pdf"]) == ["営業/提案.pdf"]
+    assert search_sources(make_shard(), folders=["人事", "営業"], extensions=[".txt"]) == ["人事/評価.txt", "営業/顧客.txt"]
+
+
+def test_direct_folder_filter_excludes_subfolders():
+    assert search_sources(make_shard(), direct_folders=["人事"]) == ["人事/評価.txt"]
+
+
+def test_empty_selection_returns_nothing():
+    shard = make_shard()
+    assert search_sources(shard, folders=["営業"], extensions=[".docx"]) == []
+    assert search_sources(shard, folders=["存在しないフォルダ"]) == []
+    assert shard.scope.build_bitmap(folders=["存在しないフォルダ"]) is None
+
+
+def test_no_result_outside_selected_folders():
+    shard = make_shard()
+    # 取得件数を全件より多くしても、対象フォルダ外のチャンクは返さない
+    vector = np.array([HashEmbeddings().embed_query("顧客")], dtype=np.float32)
+    results = shard.search(vector, shard.scope.size * 2, folders=["人事/規程"])
+    assert results
+    assert all(doc.metadata["source"].startswith(f"{ct.RAG_TOP_FOLDER_PATH}/人事/規程/") for doc, _ in results)
+
+
+def make_sharded_index():
+    texts = {
+        "人事": ["有給休暇の付与日数", "有給休暇の申請方法", "人事評価の実施時期"],
+        "営業": ["顧客との取引実績", "有給休暇中の顧客対応", "新規顧客への提案資料"],
+    }
+    shards = [
+        IndexShard(name, build_db([data_doc(f"{name}/{i}.txt", text) for i, text in enumerate(shard_texts)]))
+        for name, shard_texts in texts.items()
+    ]
+    return ShardedIndex(shards, HashEmbeddings()), [text for shard_texts in texts.values() for text in shard_texts]
+
+
+def test_merge_returns_global_top_k_in_score_order():
+    index, texts = make_sharded_index()
+    vector = np.array([HashEmbeddings().embed_query("有給休暇の申請")], dtype=np.float32)
+
+    results = asyncio.run(index.asearch_by_vector(vector, 3))
+
+    # 全シャードのチャンクとの内積を直接計算した上位3件と一致する
+    expected = sorted(texts, key=lambda text: -float(np.dot(HashEmbeddings().embed_query(text), vector[0])))[:3]
+    assert [doc.page_content for doc, _ in results] == expected
+    assert [score for _, score in results] == sorted([score for _, score in results], reverse=True)
+    assert {doc.metadata["source"].split("/")[-2] for doc, _ in results} == {"人事", "営業"}
+
+
+class KeywordEmbeddings(Embeddings):
+    """
+    含まれるキーワードごとに、決まった軸のベクトルを返す埋め込みモデル（APIを呼ばない）
+    """
+
+    KEYWORDS = ["休暇", "顧客", "評価"]
+
+    def embed_query(self, text):
+        vector = [0.1] * (len(self.KEYWORDS) + 1)
+        hits = [i for i, keyword in enumerate(self.KEYWORDS) if keyword in text] or [len(self.KEYWORDS)]
+        for i in hits:
+            vector[i] = 1.0
+        norm = float(np.linalg.norm(vector))
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def make_routed_index():
+    embeddings = KeywordEmbeddings()
+    shards = [
+        IndexShard("人事", build_db([
+            data_doc("人事/評価.txt", "人事評価の実施時期"),
+            data_doc("人事/規程/就業規則.txt", "有給休暇の付与日数"),
+            data_doc("人事/規程/休暇規程.txt", "特別休暇の種類"),
+        ], embeddings)),
+        IndexShard("営業", build_db([data_doc("営業/顧客.txt", "顧客との取引実績")], embeddings)),
+        IndexShard(ct.ROOT_SHARD_NAME, build_db([data_doc("readme.txt", "データフォルダの説明")], embeddings)),
+    ]
+    return ShardedIndex(shards, embeddings)
+
+
+def test_routing_picks_nearest_folders_and_keeps_root_shard(monkeypatch):
+    monkeypatch.setattr(ct, "ROUTING_MIN_FOLDERS", 2)
+    monkeypatch.setattr(ct, "ROUTING_TOP_FOLDERS", 1)
+    index = make_routed_index()
+    vector = np.array([KeywordEmbeddings().embed_query("休暇の申請")], dtype=np.float32)
+
+    # 重心が最も近いフォルダ（配下のフォルダを含まない）のみを選ぶ
+    assert index.route(vector) == {"人事": ["人事/規程"]}
+    plans = index._plan_search(vector, None, True)
+    assert [(shard.name, folders, direct) for shard, folders, direct in plans] == [
+        ("人事", None, ["人事/規程"]), (ct.ROOT_SHARD_NAME, None, None)
+    ]
+
+    # データフォルダ直下のファイル（フォルダに属さないシャード）は、ルーティングに関わらず検索する
+    results = asyncio.run(index.asearch_by_vector(vector, 10, route=True))
+    assert sorted(doc.metadata["source"].split("/", 2)[2] for doc, _ in results) == [
+        "readme.txt", "人事/規程/休暇規程.txt", "人事/規程/就業規則.txt"
+    ]
+
+
+def test_routing_is_skipped_below_min_folders(monkeypatch):
+    monkeypatch.setattr(ct, "ROUTING_MIN_FOLDERS", 2)
+    index = make_routed_index()
+    vector = np.array([KeywordEmbeddings().embed_query("顧客")], dtype=np.float32)
+
+    # 対象フォルダで絞り込んだ後の候補が少ない場合は、ルーティングせずに全件を検索する
+    assert index.route(vector, folders=["人事"]) is None
+    monkeypatch.setattr(ct, "ROUTING_MIN_FOLDERS", 20)
+    assert index.route(vector) is None
+    assert len(asyncio.run(index.asearch_by_vector(vector, 10, route=True))) == 5
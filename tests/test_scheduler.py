@@ -0,0 +1,134 @@
+"""
+LLM呼び出しのスケジューラー（scheduler.LLMScheduler）のテスト
+"""
+
+import asyncio
+import pytest
+from scheduler import LLMRateLimitError, LLMScheduler
+
+
+def make_scheduler(max_concurrency=1, tokens_per_minute=100000, session_rate_limit=100):
+    return LLMScheduler(max_concurrency, tokens_per_minute, session_rate_limit, 60)
+
+
+def test_sessions_are_served_round_robin():
+    async def scenario():
+        scheduler = make_scheduler(max_concurrency=1)
+        order = []
+
+        async def call(session_id, name):
+            ticket = await scheduler.acquire(session_id, 1)
+            order.append(name)
+            await asyncio.sleep(0)
+            scheduler.release(ticket)
+
+        # 実行枠を埋めた状態で、セッションAが3件、セッションBが1件を待機させる
+        running = await scheduler.acquire("A", 1)
+        tasks = [asyncio.create_task(call("A", f"A{i}")) for i in range(1, 4)]
+        tasks.append(asyncio.create_task(call("B", "B1")))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["waiting"] == 4
+
+        scheduler.release(running)
+        await asyncio.gather(*tasks)
+        return order
+
+    # 先に多く待機させたセッションAが続けて割り当てられず、セッションBにも順番が回る
+    assert asyncio.run(scenario()) == ["A1", "B1", "A2", "A3"]
+
+
+def test_concurrency_limit_is_respected():
+    async def scenario():
+        scheduler = make_scheduler(max_concurrency=2)
+        peak = 0
+
+        async def call(i):
+            nonlocal peak
+            ticket = await scheduler.acquire(f"s{i}", 1)
+            peak = max(peak, scheduler.stats()["active"])
+            await asyncio.sleep(0.01)
+            scheduler.release(ticket)
+
+        await asyncio.gather(*[call(i) for i in range(6)])
+        return peak, scheduler.stats()
+
+    peak, stats = asyncio.run(scenario())
+    assert peak == 2
+    assert stats["active"] == 0 and stats["waiting"] == 0
+
+
+def test_waiter_wakes_up_when_token_usage_expires():
+    async def scenario():
+        scheduler = make_scheduler(max_concurrency=4, tokens_per_minute=100)
+        first = await scheduler.acquire("A", 80)
+        scheduler.release(first)
+        # 最初の呼び出しの使用量が、まもなく直近1分間の範囲外になる状態にする
+        first.usage[0] -= 59.9
+
+        waiter = asyncio.create_task(scheduler.acquire("B", 50))
+        await asyncio.sleep(0.01)
+        blocked = not waiter.done()
+
+        ticket = await asyncio.wait_for(waiter, 2.0)
+        scheduler.release(ticket)
+        return blocked, scheduler.stats()
+
+    blocked, stats = asyncio.run(scenario())
+    # 上限を超える間は待機し、最も古い使用量が期間外になった時点で割り当てられる
+    assert blocked
+    assert stats["tokens_last_minute"] == 50
+
+
+def test_single_call_over_token_limit_runs_when_usage_is_empty():
+    async def scenario():
+        scheduler = make_scheduler(tokens_per_minute=100)
+        ticket = await asyncio.wait_for(scheduler.acquire("A", 500), 1.0)
+        scheduler.release(ticket)
+
+    asyncio.run(scenario())
+
+
+def test_session_rate_limit():
+    async def scenario():
+        scheduler = make_scheduler(max_concurrency=10, session_rate_limit=2)
+        for _ in range(2):
+            scheduler.release(await scheduler.acquire("A", 1))
+        # 補助的な呼び出しは、呼び出し回数の上限の対象外
+        scheduler.release(await scheduler.acquire("A", 1, check_rate=False))
+        # 他のセッションは制限されない
+        scheduler.release(await scheduler.acquire("B", 1))
+        with pytest.raises(LLMRateLimitError) as error:
+            await scheduler.acquire("A", 1)
+        return error.value
+
+    error = asyncio.run(scenario())
+    assert 0 < error.retry_after <= 61
+
+
+def test_cancelled_waiter_is_removed_from_queue():
+    async def scenario():
+        scheduler = make_scheduler(max_concurrency=1)
+        running = await scheduler.acquire("A", 1)
+        waiter = asyncio.create_task(scheduler.acquire("B", 1))
+        await asyncio.sleep(0)
+        assert scheduler.queue_status("B") is not None
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        waiting = scheduler.stats()["waiting"]
+        scheduler.release(running)
+        return waiting, scheduler.queue_status("B"), scheduler.stats()["active"]
+
+    assert asyncio.run(scenario()) == (0, None, 0)
+
+
+def test_used_tokens_correct_the_reservation():
+    async def scenario():
+        scheduler = make_scheduler()
+        ticket = await scheduler.acquire("A", 1000)
+        ticket.used_tokens = 120
+        scheduler.release(ticket)
+        return scheduler.stats()["tokens_last_minute"]
+
+    assert asyncio.run(scenario()) == 120
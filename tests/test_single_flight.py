@@ -0,0 +1,83 @@
+"""
+同じ質問の同時実行の集約（cache.SingleFlight・utils.aget_llm_response）のテスト
+"""
+
+import gc
+import time
+import asyncio
+from types import SimpleNamespace
+import constants as ct
+from cache import SingleFlight, answer_cache, answer_flights, normalize_query
+from resources import run_async
+import utils
+
+
+def test_followers_receive_leader_result():
+    async def scenario():
+        flights = SingleFlight()
+        future = flights.start("key")
+        shared = flights.join("key")
+        flights.finish("key", "回答", future)
+        return await shared, flights.stats()
+
+    result, stats = asyncio.run(scenario())
+    assert result == "回答"
+    assert stats == {"in_flight": 0, "leaders": 1, "followers": 1}
+
+
+def test_late_finish_does_not_remove_newer_flight():
+    async def scenario():
+        flights = SingleFlight()
+        first = flights.start("key")
+        flights.finish("key", "1回目", first)
+        second = flights.start("key")
+        # 先行の処理の2回目の「finish」は、後から開始された同じキーの処理に影響しない
+        flights.finish("key", None, first)
+        return flights.join("key") is second, second.done()
+
+    assert asyncio.run(scenario()) == (True, False)
+
+
+def test_unstarted_stream_finishes_flight_when_dropped():
+    async def token_stream():
+        yield "回答"
+
+    async def open_():
+        future = answer_flights.start("stream-key")
+        stream = utils.cache_on_complete(
+            token_stream(), {}, lambda final: answer_flights.finish("stream-key", final, future)
+        )
+        return stream, future
+
+    stream, future = run_async(open_())
+    assert answer_flights.join("stream-key") is future
+
+    # 画面の表示が始まる前に画面が再実行された場合と同じく、閉じずに破棄
+    del stream
+    gc.collect()
+    end = time.monotonic() + 2.0
+    while not future.done() and time.monotonic() < end:
+        time.sleep(0.01)
+    assert future.done() and future.result() is None
+    assert answer_flights.join("stream-key") is None
+
+
+def test_follower_returns_cached_answer_without_waiting_for_flight():
+    index = SimpleNamespace(version="test-version")
+    search_kwargs = {"k": 3, "search_type": "similarity", "folders": (), "extensions": ()}
+    params = tuple(sorted(search_kwargs.items()))
+    cached = {"query": "有給の申請方法", "result": "キャッシュ済みの回答", "source_documents": []}
+
+    async def scenario():
+        answer_cache.put(ct.ANSWER_MODE_2, "有給の申請方法", index.version, cached, params)
+        key = (ct.ANSWER_MODE_2, normalize_query("有給の申請方法"), index.version, params)
+        future = answer_flights.start(key)
+        try:
+            # 先行の処理は完了しないが、完全一致のキャッシュがあるため待たずに返る
+            return await asyncio.wait_for(
+                utils.aget_llm_response(index, ct.ANSWER_MODE_2, "有給の申請方法", search_kwargs), 1.0
+            )
+        finally:
+            answer_flights.finish(key, None, future)
+
+    assert run_async(scenario())["result"] == "キャッシュ済みの回答"
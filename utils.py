@@ -1,14 +1,31 @@
 # utils.py 
 import constants as ct
+from phrase_index import extract_quoted_phrase
+from cache import answer_cache, answer_flights, normalize_query, query_embedding_cache
+from retrieval import aretrieve, cut_adaptive_k, reciprocal_rank_fusion
+from expansion import parse_paraphrases, rule_based_paraphrases
+from scheduler import LLMRateLimitError, llm_scheduler
+from resilience import TRANSIENT_ERRORS, CircuitOpenError, embedding_caller, llm_caller
+from memory import is_follow_up
+from reranker import get_reranker
+from langchain_core.documents import Document
+from context import acompress_context, choose_answer_strategy, expand_to_parents, group_documents, pack_context
 
 #追加
 # 以下を追加
 import os
+import time
+import asyncio
+import logging
+import concurrent.futures
 from dotenv import load_dotenv
 
 # 環境変数を読み込み
 load_dotenv()
 
+# トークン数の算出に使うエンコーディング（初回の「get_token_encoding」呼び出し時に読み込み、読み込めない場合はFalse）
+_token_encoding = None
+
 def get_openai_api_key():
     """
     OpenAI APIキーを環境変数から取得（Streamlit Cloud対応版）
@@ -70,61 +87,981 @@ def build_error_message(error_type="初期化処理", additional_info=""):
     base_message += " このエラーが繰り返し発生する場合は、管理者にお問い合わせください。"
     return base_message
 
-def get_llm_response(user_message):
+def get_llm_response(user_message, stream=False, on_queue=None):
     """
     LLMからの回答を取得する関数（サイドバー設定対応版）
+
+    「main.py」から呼び出す同期版の窓口で、セッションの設定を読み取った後、
+    回答処理（「aget_llm_response」）を共有のイベントループで実行して完了を待つ
+
+    「stream」がTrueの場合、「社内問い合わせ」モードでは検索の完了時点で回答を返し、
+    LLMの回答は「result_stream」（トークン単位のジェネレーター）から順次取得する
+    「on_queue」を指定した場合、LLMの実行枠を待っている間、待機順と待ち時間の目安[秒]を引数に定期的に呼び出す
     """
     import streamlit as st
-    from langchain.chains import RetrievalQA
-    from langchain_openai import ChatOpenAI
-    
+    from resources import iterate_async, submit_async
+
+    started_at = time.perf_counter()
+
     try:
-        # Retrieverが初期化されているかチェック
-        if 'retriever' not in st.session_state:
-            raise Exception("Retrieverが初期化されていません")
+        # 「社内文書検索」モードでフレーズが指定された場合、ベクトル検索・LLMを使わず完全一致検索で回答
+        mode = getattr(st.session_state, 'mode', '社内文書検索')
+        if mode == ct.ANSWER_MODE_1 and 'phrase_index' in st.session_state:
+            phrase = extract_quoted_phrase(user_message)
+            if phrase:
+                return get_phrase_search_response(st.session_state.phrase_index, user_message, phrase)
+
+        # インデックスが初期化されているかチェック
+        if 'index' not in st.session_state:
+            raise Exception("インデックスが初期化されていません")
         
         # サイドバーの設定を取得
         search_k = getattr(st.session_state, 'search_k', 15)
-#        search_type = getattr(st.session_state, 'search_type', 'similarity')
+        search_type = getattr(st.session_state, 'search_type', ct.DEFAULT_SEARCH_TYPE)
         
-        # Retrieverの設定を更新
-        retriever = st.session_state.retriever
-        retriever.search_kwargs = {
+        # 検索条件はリクエストごとに作成し、共有のインデックスには保持しない
+        # （セッションの値はイベントループのスレッドから参照できないため、ここで読み取って引数で渡す）
+        search_kwargs = {
             "k": search_k,
-#            "search_type": search_type
+            "search_type": search_type,
+            # サイドバーで選択したフォルダ・ファイル形式に絞り込んで検索
+            "folders": tuple(sorted(getattr(st.session_state, 'search_folders', []))),
+            "extensions": tuple(sorted(getattr(st.session_state, 'search_extensions', [])))
         }
 
-        # APIキーを取得
-        api_key = get_openai_api_key()
+        session_id = getattr(st.session_state, 'session_id', '')
+        # LLMとのやりとり用の会話履歴（直前までの会話を前提とした質問の言い換えに使用）
+        memory = getattr(st.session_state, 'chat_history', None)
+        # 回答モードごとの制限時間から、検索・生成・表示までを含めたリクエストの締め切りを決定
+        deadline = started_at + ct.REQUEST_DEADLINE_SECONDS[mode]
+        future = submit_async(aget_llm_response(
+            st.session_state.index, mode, user_message, search_kwargs, stream, started_at, session_id, deadline, memory
+        ))
+        # 回答処理の完了を待つ間、LLMの実行枠の待機状況を画面に反映
+        while not concurrent.futures.wait([future], timeout=ct.QUEUE_STATUS_POLL_SECONDS).done:
+            status = llm_scheduler.queue_status(session_id)
+            if on_queue and status:
+                on_queue(*status)
+        response = future.result()
 
-        # LLMの設定
-        llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
-            temperature=0,
-            openai_api_key=api_key
-            )
-        
-        # RAGチェーンの作成
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",
-            retriever=retriever,
-            return_source_documents=True
-        )
-        
-        # 選択されたモードに応じたプロンプト調整
-        mode = getattr(st.session_state, 'mode', '社内文書検索')
-        if mode == '社内問い合わせ':
-            user_message = f"以下の質問に、社内文書の情報を参考に丁寧に回答してください：\n{user_message}"
-        
-        # 質問を実行
-        response = qa_chain({"query": user_message})
+        if "result_stream" in response:
+            # トークンは、画面表示のループから1つずつイベントループ上で取得する
+            response["result_stream"] = iterate_async(response["result_stream"])
         return response
         
+    except LLMRateLimitError:
+        # 呼び出し回数の上限超過は、画面で待ち時間を案内するためそのまま送出
+        raise
     except Exception as e:
         raise Exception(f"LLM回答取得エラー: {str(e)}")
-    
-    # utils.py に以下の関数を追加
+
+async def aget_llm_response(index, mode, user_message, search_kwargs, stream=False, started_at=None, session_id="",
+                            deadline=None, memory=None):
+    """
+    LLMからの回答を取得する関数（非同期版）
+
+    埋め込み・LLMの応答待ちの間はイベントループを手放すため、1つのスレッドで多数のリクエストを同時に処理できる
+    同じ質問（モード・正規化した入力値・インデックスのバージョン・検索条件が同じもの）が処理中の場合は、
+    新たに検索・生成を行わず、処理中の回答を待って共有する
+
+    Args:
+        index: 共有のインデックス
+        mode: 回答モード
+        user_message: ユーザー入力値
+        search_kwargs: リクエストごとの検索条件（k, search_type, folders, extensions）
+        stream: 回答をトークン単位で返すかどうか
+        started_at: リクエストの開始時刻（「time.perf_counter」の値）
+        session_id: 呼び出し元のセッションID（LLMの実行枠の割り当てに使用）
+        deadline: リクエストの締め切り（「time.perf_counter」の値、Noneの場合は制限なし）
+        memory: LLMとのやりとり用の会話履歴（「memory.ConversationMemory」、Noneの場合は会話履歴を使わない）
+
+    Returns:
+        dict: 「query」「result」「source_documents」を持つ辞書
+              （「query」は、会話履歴をもとに言い換えた場合は言い換え後の質問）
+              （ストリーミングの場合、トークンは「result_stream」（非同期ジェネレーター）から取得する）
+              （締め切りに間に合わない等で回答を簡略化した場合は、注意書きを「notice」に格納する）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    # 直前までの会話を前提とした質問は、会話履歴なしでも理解できる質問に言い換えてから検索・回答する
+    # （言い換え後の質問で同時実行の集約・キャッシュを行うため、同じ意味の質問は会話の流れによらず共有される）
+    if memory:
+        user_message = await acondense_question(user_message, memory, session_id, deadline)
+
+    cache_params = tuple(sorted(search_kwargs.items()))
+    flight_key = (mode, normalize_query(user_message), index.version, cache_params)
+    shared = answer_flights.join(flight_key)
+    if shared is not None:
+        # 処理中の回答を待つ前に、完全一致の回答キャッシュを確認（先行の処理が長引いていても待たずに返す）
+        cached = answer_cache.get(mode, user_message, index.version, cache_params)
+        if cached:
+            logger.info({"answer_cache": cached[1], "single_flight": "skipped"})
+            return dict(cached[0])
+
+        # 処理中の回答を待つ間に自分が中断されても、処理中の回答側は中断しない
+        try:
+            response = await asyncio.wait_for(asyncio.shield(shared), remaining_seconds(deadline))
+        except TimeoutError:
+            response = None
+        if response is not None:
+            logger.info({"single_flight": "shared", "stats": answer_flights.stats()})
+            return dict(response)
+        # 処理中の回答が失敗・中断された（または締め切りまでに完了しない）場合は、個別に回答を取得
+        return await acompute_llm_response(
+            index, mode, user_message, search_kwargs, stream, started_at, session_id, deadline
+        )
+
+    flight = answer_flights.start(flight_key)
+    try:
+        response = await acompute_llm_response(
+            index, mode, user_message, search_kwargs, stream, started_at, session_id, deadline
+        )
+    except BaseException:
+        answer_flights.finish(flight_key, None, flight)
+        raise
+
+    if "result_stream" in response:
+        # ストリーミングの場合、回答の生成が完了（または中断）した時点で、待っているリクエストに共有
+        # （表示が始まる前にストリームが破棄された場合も、中断として登録を取り除く）
+        response["result_stream"] = cache_on_complete(
+            response["result_stream"],
+            response,
+            lambda final: answer_flights.finish(flight_key, final, flight)
+        )
+    else:
+        answer_flights.finish(flight_key, response, flight)
+    return response
+
+async def acompute_llm_response(index, mode, user_message, search_kwargs, stream=False, started_at=None, session_id="",
+                                deadline=None):
+    """
+    回答キャッシュを確認し、キャッシュにない場合は検索・生成を行って回答を取得する関数
+
+    引数・戻り値は「aget_llm_response」と同じ
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    started_at = started_at or time.perf_counter()
+
+    index_version = index.version
+    cache_params = tuple(sorted(search_kwargs.items()))
+
+    try:
+        query_vector = await asyncio.wait_for(index.aembed_query(user_message), remaining_seconds(deadline))
+    except TimeoutError:
+        # 締め切りまでにクエリを埋め込めない場合は、検索もできないため、キャッシュ済みの回答のみを探す
+        logger.warning({"deadline_exceeded": "embedding", "mode": mode})
+        return build_degraded_response(
+            mode, user_message, index_version, cache_params, None, [], ct.DEADLINE_EXCEEDED_NOTICE
+        )
+    except (CircuitOpenError, *TRANSIENT_ERRORS) as e:
+        # 埋め込みAPIに接続できない場合も同様に、完全一致のキャッシュ済みの回答のみを探す
+        logger.warning({"embedding_unavailable": type(e).__name__, "embedding": embedding_caller.stats()})
+        return build_degraded_response(
+            mode, user_message, index_version, cache_params, None, [], ct.LLM_UNAVAILABLE_NOTICE
+        )
+
+    # 同じ（または十分に類似した）質問への回答がキャッシュにあれば、検索・LLM呼び出しを行わずに返す
+    # （回答キャッシュの参照はメモリ上で完結するため、イベントループ上でそのまま実行する）
+    cached = answer_cache.get(mode, user_message, index_version, cache_params, query_vector)
+    if cached:
+        response, hit_type = cached
+        logger.info({"answer_cache": hit_type, "stats": answer_cache.stats()})
+        return response
+
+    # 締め切りに間に合わない・LLMに接続できない場合に、生成の代わりに返す回答を作成する関数
+    def fallback(source_documents, notice):
+        return build_degraded_response(
+            mode, user_message, index_version, cache_params, query_vector, source_documents, notice
+        )
+
+    if mode == ct.ANSWER_MODE_1:
+        # 「社内文書検索」モードは参照元のありかを表示するだけのため、LLMを使わず検索結果をそのまま返す
+        response = await aget_search_only_response(index, user_message, query_vector, search_kwargs, deadline, fallback)
+    else:
+        # 「社内問い合わせ」モードは、検索結果の類似度を確認してからLLMで回答を生成
+        response = await aget_inquiry_response(
+            index, user_message, query_vector, search_kwargs, stream, started_at, session_id, deadline, fallback
+        )
+
+    if "result_stream" in response:
+        # ストリーミングの場合、回答の生成が完了した時点でキャッシュに保存（途中で打ち切った回答は保存しない）
+        def put_answer_cache(final):
+            if final is not None and "notice" not in final:
+                answer_cache.put(mode, user_message, index_version, final, cache_params, query_vector)
+
+        response["result_stream"] = cache_on_complete(response["result_stream"], response, put_answer_cache)
+        return response
+
+    # 画面表示に必要な参照元ドキュメントも含めて、回答をキャッシュに保存（簡略化した回答は保存しない）
+    if "notice" not in response:
+        answer_cache.put(mode, user_message, index_version, response, cache_params, query_vector)
+
+    # キャッシュのヒット率をログ出力
+    logger.info({"query_embedding_cache": query_embedding_cache.stats(), "answer_cache": answer_cache.stats()})
+
+    return response
+
+async def acondense_question(user_message, memory, session_id="", deadline=None):
+    """
+    会話履歴をもとに、最新の入力を会話履歴なしでも理解できる質問に言い換える関数
+
+    直前までの会話を前提としない入力の場合は、LLMを呼ばずにそのまま返す
+    直近のやりとりは原文のまま使い、それより前のやりとりは、言い換えの前に要約に畳み込む
+    言い換えに失敗した場合（締め切りに間に合わない・LLMに接続できない等）も、入力をそのまま返す
+
+    Args:
+        user_message: ユーザー入力値
+        memory: LLMとのやりとり用の会話履歴
+        session_id: 呼び出し元のセッションID（LLMの実行枠の割り当てに使用）
+        deadline: リクエストの締め切り（「time.perf_counter」の値、Noneの場合は制限なし）
+
+    Returns:
+        言い換え後の質問
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    if not is_follow_up(user_message):
+        logger.info({"condense_question": "skipped"})
+        return user_message
+
+    async def condense():
+        # 押し出されたやりとりがあれば、これまでの要約と合わせて要約し直す（トークン数の上限以内）
+        pending = memory.pending_turns()
+        if pending:
+            summary = await arun_history_chain(
+                ct.SYSTEM_PROMPT_SUMMARIZE_HISTORY,
+                memory.to_messages(include_recent=False),
+                f"会話全体の要約を、{ct.CHAT_SUMMARY_MAX_TOKENS}トークン以内で作成してください。",
+                session_id
+            )
+            memory.fold(truncate_tokens(summary.strip(), ct.CHAT_SUMMARY_MAX_TOKENS), len(pending))
+        return await arun_history_chain(
+            ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT, memory.to_messages(), user_message, session_id
+        )
+
+    try:
+        condensed = await asyncio.wait_for(condense(), remaining_seconds(deadline))
+    except (TimeoutError, CircuitOpenError, *TRANSIENT_ERRORS) as e:
+        logger.warning({"condense_question": "failed", "error": type(e).__name__})
+        return user_message
+
+    condensed = condensed.strip() or user_message
+    logger.info({"condense_question": condensed, "summary_tokens": count_tokens(memory.summary)})
+    return condensed
+
+async def arun_history_chain(system_prompt, messages, text, session_id=""):
+    """
+    会話履歴をもとに文章を作成するチェーンを、LLMの実行枠を割り当てられてから実行する関数
+
+    Args:
+        system_prompt: システムプロンプト
+        messages: 会話履歴（メッセージのリスト、会話履歴を使わない場合は空のリスト）
+        text: 最新の入力
+        session_id: 呼び出し元のセッションID（LLMの実行枠の割り当てに使用）
+
+    Returns:
+        作成した文章
+    """
+    from resources import registry
+
+    chain = registry.get_history_chain(system_prompt, ct.ANSWER_MODEL, ct.ANSWER_TEMPERATURE)
+    return await ainvoke_with_slot(chain, {"chat_history": messages, "input": text}, system_prompt, session_id)
+
+async def ainvoke_with_slot(chain, inputs, system_prompt, session_id=""):
+    """
+    1回の質問の中で行う補助的なLLM呼び出しを、LLMの実行枠を割り当てられてから実行する関数
+
+    補助的な呼び出しは、セッションごとの呼び出し回数の上限の対象としない
+
+    Args:
+        chain: 実行するチェーン
+        inputs: チェーンの入力値
+        system_prompt: チェーンのシステムプロンプト（トークン数の見積もりに使用）
+        session_id: 呼び出し元のセッションID（LLMの実行枠の割り当てに使用）
+
+    Returns:
+        チェーンの出力（文章）
+    """
+    prompt_tokens = estimate_prompt_tokens(system_prompt, inputs)
+    ticket = await llm_scheduler.acquire(session_id, prompt_tokens + ct.LLM_ESTIMATED_OUTPUT_TOKENS, check_rate=False)
+    try:
+        # LLMの呼び出しには、リトライ・ヘッジ・サーキットブレーカーを適用
+        result = await llm_caller.call(lambda: chain.ainvoke(inputs))
+        ticket.used_tokens = prompt_tokens + count_tokens(result)
+    finally:
+        llm_scheduler.release(ticket)
+    return result
+
+def estimate_prompt_tokens(system_prompt, inputs):
+    """
+    チェーンのプロンプトのトークン数を見積もる
+
+    Args:
+        system_prompt: チェーンのシステムプロンプト
+        inputs: チェーンの入力値（「input」と、「context」（ドキュメントのリスト）または「chat_history」（メッセージのリスト））
+
+    Returns:
+        トークン数
+    """
+    return (
+        count_tokens(system_prompt + inputs["input"])
+        + sum(count_tokens(doc.page_content) for doc in inputs.get("context", []))
+        + sum(count_tokens(message.content) for message in inputs.get("chat_history", []))
+    )
+
+async def aprepare_answer(strategy, groups, question, session_id=""):
+    """
+    回答の生成方法に応じて、回答を生成する最後の呼び出しのチェーンと入力を用意する関数
+
+    - stuff: 文脈全体をそのまま使う
+    - map_reduce: 文脈のグループごとに、回答に必要な情報を並列に抜き出し（map）、抜き出した情報を文脈とする
+    - refine: 最初のグループで回答し、最後の1つを除くグループで順に回答を改善（最後のグループでの改善を最後の呼び出しとする）
+
+    Args:
+        strategy: 回答の生成方法
+        groups: 文脈のグループ（ドキュメントのリストのリスト）
+        question: チェーンの「input」
+        session_id: 呼び出し元のセッションID（LLMの実行枠の割り当てに使用）
+
+    Returns:
+        (チェーン, 入力値, システムプロンプト) のタプル
+    """
+    from resources import registry
+
+    answer_chain = registry.get_chain(ct.ANSWER_MODE_2, ct.ANSWER_MODEL, ct.ANSWER_TEMPERATURE)
+
+    if strategy == "map_reduce":
+        map_chain = registry.get_prompt_chain(ct.SYSTEM_PROMPT_MAP, ct.ANSWER_MODEL, ct.ANSWER_TEMPERATURE)
+        # 全セッション共通の実行枠とは別に、1回の質問で同時に行うmap呼び出しの数を制限
+        semaphore = asyncio.Semaphore(ct.MAP_MAX_CONCURRENCY)
+
+        async def map_group(group):
+            async with semaphore:
+                return await ainvoke_with_slot(
+                    map_chain, {"input": question, "context": group}, ct.SYSTEM_PROMPT_MAP, session_id
+                )
+
+        tasks = [asyncio.ensure_future(map_group(group)) for group in groups]
+        try:
+            notes = await asyncio.gather(*tasks)
+        finally:
+            # いずれかのmap呼び出しが失敗した場合は、残りの呼び出しも中断
+            for task in tasks:
+                task.cancel()
+
+        # 関連する情報がなかったグループは、reduceの文脈に含めない
+        context = [
+            Document(page_content=note.strip(), metadata=group[0].metadata)
+            for group, note in zip(groups, notes)
+            if note.strip().rstrip("。") != ct.MAP_NO_INFO_ANSWER
+        ]
+        logging.getLogger(ct.LOGGER_NAME).info({"map_reduce": {"groups": len(groups), "notes": len(context)}})
+        return answer_chain, {"input": question, "context": context}, ct.SYSTEM_PROMPT_INQUIRY
+
+    if strategy == "refine" and len(groups) > 1:
+        refine_chain = registry.get_prompt_chain(ct.SYSTEM_PROMPT_REFINE, ct.ANSWER_MODEL, ct.ANSWER_TEMPERATURE)
+        answer = await ainvoke_with_slot(
+            answer_chain, {"input": question, "context": groups[0]}, ct.SYSTEM_PROMPT_INQUIRY, session_id
+        )
+        for group in groups[1:-1]:
+            answer = await ainvoke_with_slot(
+                refine_chain, build_refine_inputs(question, answer, group), ct.SYSTEM_PROMPT_REFINE, session_id
+            )
+        return refine_chain, build_refine_inputs(question, answer, groups[-1]), ct.SYSTEM_PROMPT_REFINE
+
+    return answer_chain, {"input": question, "context": [doc for group in groups for doc in group]}, ct.SYSTEM_PROMPT_INQUIRY
+
+def build_refine_inputs(question, answer, group):
+    """
+    refineの呼び出しの入力値を作成
+    """
+    return {"input": f"{question}\n\n【既存の回答】\n{answer}", "context": group}
+
+def build_degraded_response(mode, user_message, index_version, cache_params, query_vector, source_documents, notice):
+    """
+    回答を生成できない場合に、キャッシュ済みの類似した質問への回答、または検索結果のみを注意書き付きで返す関数
+
+    Args:
+        mode: 回答モード
+        user_message: ユーザー入力値
+        index_version: 現在のインデックスのバージョン
+        cache_params: 回答キャッシュの検索条件
+        query_vector: 正規化済みのクエリベクトル（埋め込めなかった場合はNone）
+        source_documents: 検索済みのドキュメント（関連度の高い順）
+        notice: 注意書き（「{fallback}」の部分に、代わりに表示する内容が入る）
+
+    Returns:
+        dict: 「query」「result」「source_documents」「notice」を持つ辞書
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    # 類似度の下限を緩めて、キャッシュ済みの回答を探す
+    cached = answer_cache.get(
+        mode, user_message, index_version, cache_params, query_vector,
+        similarity_threshold=ct.FALLBACK_ANSWER_SIMILARITY_THRESHOLD
+    )
+    if cached:
+        logger.warning({"degraded": "answer_cache", "hit_type": cached[1], "llm": llm_caller.stats()})
+        return {**cached[0], "notice": notice.format(fallback=ct.FALLBACK_CACHED_ANSWER_LABEL)}
+
+    logger.warning({"degraded": "sources_only", "sources": len(source_documents), "llm": llm_caller.stats()})
+    if source_documents:
+        result = ""
+    elif mode == ct.ANSWER_MODE_1:
+        result = ct.NO_DOC_MATCH_ANSWER
+    else:
+        result = ct.UNAVAILABLE_ANSWER
+    return {
+        "query": user_message,
+        "result": result,
+        "source_documents": source_documents,
+        "notice": notice.format(fallback=ct.FALLBACK_SOURCES_LABEL)
+    }
+
+def remaining_seconds(deadline):
+    """
+    締め切りまでの残り秒数を算出
+
+    Args:
+        deadline: 締め切り（「time.perf_counter」の値、Noneの場合は制限なし）
+
+    Returns:
+        残り秒数（0未満にはならない、締め切りがない場合はNone）
+    """
+    if deadline is None:
+        return None
+    return max(deadline - time.perf_counter(), 0)
+
+async def aget_search_only_response(index, user_message, query_vector, search_kwargs, deadline=None, fallback=None):
+    """
+    「社内文書検索」モードで、LLMを使わずに検索結果のみをLLMレスポンスと同じ形式で返す関数
+
+    Args:
+        index: 共有のインデックス
+        user_message: ユーザー入力値
+        query_vector: 正規化済みのクエリベクトル
+        search_kwargs: リクエストごとの検索条件（k, search_type, folders, extensions）
+        deadline: リクエストの締め切り（「time.perf_counter」の値、Noneの場合は制限なし）
+        fallback: 締め切りに間に合わない場合に、代わりの回答を作成する関数（引数は検索済みのドキュメント・注意書き）
+
+    Returns:
+        dict: 「query」「result」「source_documents」を持つ辞書
+    """
+    # 類似度がしきい値に満たないドキュメントは、関連性が低いものとして除外
+    try:
+        results = await asyncio.wait_for(
+            aretrieve(index, query_vector, score_threshold=ct.DOC_SEARCH_SCORE_THRESHOLD, **search_kwargs),
+            remaining_seconds(deadline)
+        )
+    except TimeoutError:
+        logging.getLogger(ct.LOGGER_NAME).warning({"deadline_exceeded": "retrieval", "mode": ct.ANSWER_MODE_1})
+        return fallback([], ct.DEADLINE_EXCEEDED_NOTICE)
+    source_documents = [doc for doc, _ in results]
+
+    return {
+        "query": user_message,
+        "result": "" if source_documents else ct.NO_DOC_MATCH_ANSWER,
+        "source_documents": source_documents
+    }
+
+async def aget_inquiry_response(index, user_message, query_vector, search_kwargs, stream=False, started_at=None,
+                                session_id="", deadline=None, fallback=None):
+    """
+    「社内問い合わせ」モードで、検索結果をもとにLLMで回答を生成する関数
+
+    検索結果の最大の類似度がしきい値を下回る場合、LLMを呼ばずに「回答に必要な情報が見つかりませんでした。」を返す
+    文脈全体のトークン数が1回の呼び出しに収まらない場合は、map_reduce・refineで回答を生成する
+    締め切りまでに生成が完了しない見込みの場合やLLMに接続できない場合は、「fallback」で作成した回答を返す
+
+    Args:
+        index: 共有のインデックス
+        user_message: ユーザー入力値
+        query_vector: 正規化済みのクエリベクトル
+        search_kwargs: リクエストごとの検索条件（k, search_type, folders, extensions）
+        stream: 回答をトークン単位で返すかどうか
+        started_at: リクエストの開始時刻（「time.perf_counter」の値、最初のトークンまでの時間の計測に使用）
+        session_id: 呼び出し元のセッションID（LLMの実行枠の割り当てに使用）
+        deadline: リクエストの締め切り（「time.perf_counter」の値、Noneの場合は制限なし）
+        fallback: 生成の代わりの回答を作成する関数（引数は検索済みのドキュメント・注意書き）
+
+    Returns:
+        dict: 「query」「result」「source_documents」を持つ辞書
+              （ストリーミングの場合、「result」は生成完了後に設定され、トークンは「result_stream」から取得する）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    try:
+        results = await asyncio.wait_for(
+            aretrieve_inquiry_candidates(index, query_vector, search_kwargs), remaining_seconds(deadline)
+        )
+    except TimeoutError:
+        logger.warning({"deadline_exceeded": "retrieval", "mode": ct.ANSWER_MODE_2})
+        return fallback([], ct.DEADLINE_EXCEEDED_NOTICE)
+    # 生成を省略するかどうかは、元の質問での（言い換え・再ランキング前の）ベクトルの類似度で判定
+    best_score = max((score for _, score in results), default=0.0)
+
+    # 関連性の高いドキュメントがない場合、LLMの回答も「情報なし」になるため、生成を省略
+    # （言い換えのLLM呼び出しも行わずに返す）
+    if best_score < ct.INQUIRY_SCORE_THRESHOLD:
+        logger.info({"inquiry_short_circuit": True, "best_score": round(best_score, 4)})
+        return {
+            "query": user_message,
+            "result": ct.INQUIRY_NO_MATCH_ANSWER,
+            "source_documents": []
+        }
+
+    if ct.QUERY_EXPANSION_ENABLED:
+        # 言い換えた質問でも並列に検索し、元の質問での候補と統合（少ない件数で取りこぼしを減らす）
+        try:
+            results = await asyncio.wait_for(
+                aretrieve_expanded(
+                    index, user_message, query_vector, inquiry_retrieval_kwargs(search_kwargs), session_id, deadline,
+                    inquiry_final_k(), results
+                ),
+                remaining_seconds(deadline)
+            )
+        except TimeoutError:
+            # 時間内に統合できない場合は、元の質問での候補を使う
+            logger.warning({"deadline_exceeded": "query_expansion", "mode": ct.ANSWER_MODE_2})
+
+    if ct.RERANK_ENABLED:
+        top_n = min(search_kwargs["k"], ct.RERANK_TOP_N)
+        try:
+            results = await asyncio.wait_for(
+                get_reranker().arerank(user_message, results, top_n), remaining_seconds(deadline)
+            )
+        except TimeoutError:
+            # 時間内に再ランキングできない場合は、検索時の順位の上位を使う
+            logger.warning({"deadline_exceeded": "rerank", "mode": ct.ANSWER_MODE_2})
+            results = results[:top_n]
+
+    # 再ランキング・統合の候補は件数を減らさずに取得しているため、「adaptive」の場合はここで
+    # 再ランキング後（または統合後）のスコアの落ち込み方に応じた件数で打ち切る
+    if search_kwargs["search_type"] == "adaptive" and (ct.RERANK_ENABLED or ct.QUERY_EXPANSION_ENABLED):
+        results = cut_adaptive_k(results)
+
+    # 隣り合うチャンクをまとめて重複部分を除き、類似度の高い順にトークン数の上限まで文脈に詰める
+    # （1回の呼び出しに収まらない場合はmap_reduce・refineで回答するため、文脈全体の上限まで詰めてから生成方法を選ぶ）
+    # （検索した小さなチャンクは、回答に使う前に親のページの前後の範囲に広げる）
+    strategy = ct.ANSWER_STRATEGY
+    source_documents = pack_context(
+        expand_to_parents(index, results), ct.CONTEXT_MAX_TOKENS if strategy == "stuff" else ct.CONTEXT_MAX_TOTAL_TOKENS
+    )
+    # 文脈のドキュメントごとに、質問との類似度が高い文のみを残して、プロンプトのトークン数を削減
+    if ct.CONTEXT_COMPRESSION_ENABLED:
+        source_documents = await acompress_context(
+            index, source_documents, user_message, query_vector, remaining_seconds(deadline)
+        )
+
+    # 文脈全体のトークン数から、回答の生成方法を選ぶ
+    context_tokens = sum(count_tokens(doc.page_content) for doc in source_documents)
+    groups = group_documents(source_documents)
+    if strategy == "auto":
+        strategy = choose_answer_strategy(context_tokens, len(groups))
+    logger.info({"answer_strategy": strategy, "context_tokens": context_tokens, "groups": len(groups)})
+
+    # 障害が続いてサーキットブレーカーが開いている間は、実行枠を待たずに検索結果のみを返す
+    if llm_caller.is_open():
+        return fallback(source_documents, ct.LLM_UNAVAILABLE_NOTICE)
+
+    # 直近の生成時間から見て、締め切りまでに生成が完了しない見込みの場合は、生成せずに検索結果のみを返す
+    expected_seconds = llm_caller.expected_latency() or 0.0
+    remaining = remaining_seconds(deadline)
+    if remaining is not None and remaining < expected_seconds:
+        logger.warning({"deadline_exceeded": "before_generation", "remaining": round(remaining, 3)})
+        return fallback(source_documents, ct.DEADLINE_EXCEEDED_NOTICE)
+
+    try:
+        # map_reduce・refineの場合は、回答を生成する最後の呼び出しの前に、文脈のグループごとの呼び出しを行う
+        # （APIキー・LLMクライアント・チェーンはプロセス全体で使い回す）
+        chain, inputs, system_prompt = await asyncio.wait_for(
+            aprepare_answer(
+                strategy,
+                groups,
+                f"以下の質問に、社内文書の情報を参考に丁寧に回答してください：\n{user_message}",
+                session_id
+            ),
+            remaining_seconds(deadline)
+        )
+
+        # 全セッション共通のスケジューラーから、LLMの実行枠を割り当てられるまで待機
+        # （トークン使用量は、プロンプトと回答の見積もりで予約し、生成完了後に実際の値で補正）
+        # （実行枠を待てるのは、残り時間から生成にかかる見込みの時間を除いた分まで）
+        remaining = remaining_seconds(deadline)
+        queue_budget = None if remaining is None else remaining - expected_seconds
+        prompt_tokens = estimate_prompt_tokens(system_prompt, inputs)
+        ticket = await asyncio.wait_for(
+            llm_scheduler.acquire(session_id, prompt_tokens + ct.LLM_ESTIMATED_OUTPUT_TOKENS), queue_budget
+        )
+
+        if stream:
+            response = {
+                "query": user_message,
+                "result": None,
+                "source_documents": source_documents
+            }
+            response["result_stream"] = open_answer_stream(
+                chain, inputs, response, started_at or time.perf_counter(), ticket, prompt_tokens, deadline
+            )
+            return response
+
+        try:
+            # LLMの呼び出しには、リトライ・ヘッジ・サーキットブレーカーを適用
+            answer = await asyncio.wait_for(
+                llm_caller.call(lambda: chain.ainvoke(inputs)), remaining_seconds(deadline)
+            )
+            ticket.used_tokens = prompt_tokens + count_tokens(answer)
+        finally:
+            llm_scheduler.release(ticket)
+    except TimeoutError:
+        logger.warning({"deadline_exceeded": "generation", "scheduler": llm_scheduler.stats()})
+        return fallback(source_documents, ct.DEADLINE_EXCEEDED_NOTICE)
+    except (CircuitOpenError, *TRANSIENT_ERRORS) as e:
+        logger.warning({"llm_unavailable": type(e).__name__})
+        return fallback(source_documents, ct.LLM_UNAVAILABLE_NOTICE)
+
+    return {
+        "query": user_message,
+        "result": answer,
+        "source_documents": source_documents
+    }
+
+async def aretrieve_inquiry_candidates(index, query_vector, search_kwargs):
+    """
+    「社内問い合わせ」モードで、元の質問での（言い換え・再ランキング・文脈の組み立ての前の）候補を検索する関数
+
+    生成を省略するかどうかの判定（「INQUIRY_SCORE_THRESHOLD」）はこの候補の最大の類似度で行うため、
+    しきい値の算出（calibrate_threshold.py）でも同じ関数を使う
+
+    Args:
+        index: 共有のインデックス
+        query_vector: 正規化済みのクエリベクトル
+        search_kwargs: リクエストごとの検索条件（k, search_type, folders, extensions）
+
+    Returns:
+        (Document, 類似度スコア) のリスト
+    """
+    return await aretrieve(index, query_vector, **inquiry_retrieval_kwargs(search_kwargs))
+
+def inquiry_retrieval_kwargs(search_kwargs):
+    """
+    「社内問い合わせ」モードで、再ランキング・統合の候補を検索する条件を取得する関数
+
+    Args:
+        search_kwargs: リクエストごとの検索条件（k, search_type, folders, extensions）
+
+    Returns:
+        候補の検索条件
+    """
+    # 再ランキングを行う場合は、多めの候補を検索し、再ランキング後に上位のみを残す
+    retrieval_kwargs = search_kwargs
+    if ct.RERANK_ENABLED:
+        retrieval_kwargs = {**search_kwargs, "k": max(search_kwargs["k"], ct.RERANK_FETCH_K)}
+    # 再ランキング・統合の候補は件数を減らさずに取得する（「adaptive」の打ち切りは、再ランキング・統合の後に行う）
+    if (ct.RERANK_ENABLED or ct.QUERY_EXPANSION_ENABLED) and search_kwargs["search_type"] == "adaptive":
+        retrieval_kwargs = {**retrieval_kwargs, "search_type": "similarity"}
+    return retrieval_kwargs
+
+def inquiry_final_k():
+    """
+    「社内問い合わせ」モードで、言い換えた質問での検索結果を統合した後の件数の上限を取得する関数
+    """
+    # 再ランキングを行う場合は、再ランキングの候補の件数まで残す
+    return ct.RERANK_FETCH_K if ct.RERANK_ENABLED else ct.QUERY_EXPANSION_FINAL_K
+
+async def aretrieve_expanded(index, user_message, query_vector, search_kwargs, session_id="", deadline=None,
+                             final_k=ct.QUERY_EXPANSION_FINAL_K, results=None):
+    """
+    ユーザー入力と、それを言い換えた質問で並列に検索し、Reciprocal Rank Fusionで検索結果を統合する関数
+
+    Args:
+        index: 共有のインデックス
+        user_message: ユーザー入力値
+        query_vector: 正規化済みのクエリベクトル
+        search_kwargs: リクエストごとの検索条件（k, search_type, folders, extensions）
+        session_id: 呼び出し元のセッションID（LLMの実行枠の割り当てに使用）
+        deadline: リクエストの締め切り（「time.perf_counter」の値、Noneの場合は制限なし）
+        final_k: 統合後の件数の上限
+        results: 検索済みの、ユーザー入力での検索結果（Noneの場合は、言い換えた質問と並列に検索する）
+
+    Returns:
+        (Document, 類似度スコア) のリスト（統合後の順位の順）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    paraphrases = await aexpand_query(user_message, session_id, deadline)
+
+    # 言い換えた質問の埋め込みに失敗した場合は、その質問での検索を省く
+    vectors = await asyncio.gather(
+        *[index.aembed_query(paraphrase) for paraphrase in paraphrases], return_exceptions=True
+    )
+    vectors = [vector for vector in vectors if not isinstance(vector, BaseException)]
+    if results is None:
+        vectors = [query_vector] + vectors
+
+    result_lists = await asyncio.gather(*[aretrieve(index, vector, **search_kwargs) for vector in vectors])
+    if results is not None:
+        result_lists = [results] + result_lists
+    fused = reciprocal_rank_fusion(result_lists, min(search_kwargs["k"], final_k))
+
+    logger.info({"query_expansion": {
+        "paraphrases": paraphrases,
+        "queries": len(result_lists),
+        "candidates": sum(len(result_list) for result_list in result_lists),
+        "fused": len(fused)
+    }})
+    return fused
+
+async def aexpand_query(user_message, session_id="", deadline=None):
+    """
+    ユーザー入力を、社内文書の検索に使える別の表現の質問に言い換える関数
+
+    LLMでの言い換えが時間内に完了しない場合やLLMに接続できない場合は、規則に基づいて言い換える
+
+    Args:
+        user_message: ユーザー入力値
+        session_id: 呼び出し元のセッションID（LLMの実行枠の割り当てに使用）
+        deadline: リクエストの締め切り（「time.perf_counter」の値、Noneの場合は制限なし）
+
+    Returns:
+        言い換えた質問のリスト
+    """
+    if ct.QUERY_EXPANSION_METHOD == "llm" and not llm_caller.is_open():
+        remaining = remaining_seconds(deadline)
+        timeout = ct.QUERY_EXPANSION_TIMEOUT_SECONDS
+        if remaining is not None:
+            timeout = min(remaining, timeout)
+        try:
+            text = await asyncio.wait_for(
+                arun_history_chain(
+                    ct.SYSTEM_PROMPT_EXPAND_QUERY,
+                    [],
+                    f"次の質問の言い換えを{ct.QUERY_EXPANSION_COUNT}個作成してください：\n{user_message}",
+                    session_id
+                ),
+                timeout
+            )
+            paraphrases = parse_paraphrases(user_message, text)
+            if paraphrases:
+                return paraphrases
+        except (TimeoutError, CircuitOpenError, *TRANSIENT_ERRORS) as e:
+            logging.getLogger(ct.LOGGER_NAME).warning({"query_expansion": "rule_fallback", "error": type(e).__name__})
+
+    return rule_based_paraphrases(user_message)
+
+def open_answer_stream(chain, inputs, response, started_at, ticket, prompt_tokens, deadline=None):
+    """
+    LLMの実行枠を割り当て済みの、回答のトークンを返すストリームを作成する関数
+
+    実行枠は生成の完了時（「astream_answer」の終了時）に解放するが、画面の表示が始まる前に
+    ストリームが閉じられた・破棄された場合（表示前に画面が再実行された場合等）も解放する
+
+    引数は「astream_answer」と同じ
+
+    Returns:
+        回答のトークンを返す非同期イテレーター
+    """
+    from resources import GuardedStream
+
+    async def release_ticket():
+        # 生成を開始していないため、予約したトークン使用量も取り消す
+        ticket.used_tokens = 0
+        llm_scheduler.release(ticket)
+
+    return GuardedStream(
+        astream_answer(chain, inputs, response, started_at, ticket, prompt_tokens, deadline),
+        release_ticket
+    )
+
+async def astream_answer(chain, inputs, response, started_at, ticket, prompt_tokens, deadline=None):
+    """
+    チェーンの回答をトークン単位で返す非同期ジェネレーター
+
+    生成が完了した時点で、回答全体を「response」の「result」に格納し、LLMの実行枠を解放する
+    締め切りを過ぎた場合は、その時点までの回答で打ち切り、「response」の「notice」に注意書きを格納する
+    最初のトークンまでの時間（time to first token）と、生成全体にかかった時間をログ出力する
+
+    Args:
+        chain: 回答を生成するチェーン
+        inputs: チェーンの入力値
+        response: 回答全体を格納する辞書
+        started_at: リクエストの開始時刻（「time.perf_counter」の値）
+        ticket: スケジューラーから割り当てられたLLMの実行枠
+        prompt_tokens: プロンプトのトークン数
+        deadline: リクエストの締め切り（「time.perf_counter」の値、Noneの場合は制限なし）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    chunks = []
+    first_token_at = None
+    # LLMの呼び出しには、リトライ・ヘッジ・サーキットブレーカーを適用
+    stream = llm_caller.stream(lambda: chain.astream(inputs))
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), remaining_seconds(deadline))
+            except StopAsyncIteration:
+                break
+            except TimeoutError:
+                logger.warning({"deadline_exceeded": "streaming", "answer_length": len("".join(chunks))})
+                response["notice"] = ct.DEADLINE_TRUNCATED_NOTICE
+                break
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                logger.info({"time_to_first_token": round(first_token_at - started_at, 3)})
+            chunks.append(chunk)
+            yield chunk
+    finally:
+        await stream.aclose()
+        ticket.used_tokens = prompt_tokens + count_tokens("".join(chunks))
+        llm_scheduler.release(ticket)
+
+    response["result"] = "".join(chunks)
+    logger.info({
+        "time_to_first_token": round((first_token_at or time.perf_counter()) - started_at, 3),
+        "total_time": round(time.perf_counter() - started_at, 3),
+        "answer_length": len(response["result"]),
+        "scheduler": llm_scheduler.stats()
+    })
+
+def cache_on_complete(result_stream, response, callback):
+    """
+    トークンをそのまま返し、すべて返し終えた時点で「result_stream」を除いた回答をコールバックに渡す
+    （途中で中断された場合や、開始前に閉じられた・破棄された場合は、回答の代わりにNoneを渡す）
+
+    Args:
+        result_stream: 回答のトークンを返す非同期イテレーター
+        response: 生成完了後に回答全体が格納される辞書
+        callback: 完成した回答（辞書）を受け取る関数
+
+    Returns:
+        トークンを返す非同期イテレーター
+    """
+    from resources import GuardedStream
+
+    async def relay():
+        final = None
+        try:
+            async for chunk in result_stream:
+                yield chunk
+            final = {key: value for key, value in response.items() if key != "result_stream"}
+        finally:
+            callback(final)
+
+    async def cancel():
+        # 開始前に閉じられた場合は、包んでいるストリームも閉じる（LLMの実行枠の解放等）
+        callback(None)
+        await result_stream.aclose()
+
+    return GuardedStream(relay(), cancel)
+
+def get_token_encoding():
+    """
+    トークン数の算出に使うエンコーディングを取得
+
+    トークナイザー（tiktoken）のエンコーディングを読み込めない環境では、Falseを返す
+
+    Returns:
+        エンコーディング（読み込めない場合はFalse）
+    """
+    global _token_encoding
+
+    if _token_encoding is None:
+        try:
+            import tiktoken
+            _token_encoding = tiktoken.get_encoding(ct.TOKEN_ENCODING_NAME)
+        except Exception as e:
+            print(f"DEBUG: トークナイザーの読み込みエラー（文字数で見積もり）: {type(e).__name__}: {str(e)}")
+            _token_encoding = False
+    return _token_encoding
+
+def count_tokens(text):
+    """
+    テキストのトークン数を算出
+
+    トークナイザー（tiktoken）のエンコーディングを読み込めない環境では、1文字を1トークンとして見積もる
+    （日本語の文章では、実際のトークン数と同程度かやや多めの値になる）
+
+    Args:
+        text: 対象のテキスト
+
+    Returns:
+        トークン数
+    """
+    encoding = get_token_encoding()
+    if encoding is False:
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text, max_tokens):
+    """
+    テキストを、先頭から指定のトークン数以内に切り詰める
+
+    Args:
+        text: 対象のテキスト
+        max_tokens: トークン数の上限
+
+    Returns:
+        切り詰めたテキスト（上限以内の場合はそのまま）
+    """
+    encoding = get_token_encoding()
+    if encoding is False:
+        return text[:max_tokens]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+def get_history_answer(llm_response):
+    """
+    会話履歴に残す回答を取得
+
+    回答の文章がない場合（「社内文書検索」モード等）は、参照元のファイルパスの一覧を回答とする
+
+    Args:
+        llm_response: LLMからの回答
+
+    Returns:
+        会話履歴に残す回答
+    """
+    if llm_response["result"]:
+        return llm_response["result"]
+    sources = dict.fromkeys(doc.metadata["source"] for doc in llm_response["source_documents"])
+    return "、".join(sources) or ct.NO_DOC_MATCH_ANSWER
+
+def get_phrase_search_response(phrase_index, user_message, phrase):
+    """
+    フレーズの完全一致検索結果を、LLMレスポンスと同じ形式で返す関数
+
+    Args:
+        phrase_index: フレーズ検索用のインデックス
+        user_message: ユーザー入力値
+        phrase: 検索するフレーズ
+
+    Returns:
+        dict: 「query」「result」「source_documents」を持つ辞書
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    start = time.perf_counter()
+    hits = phrase_index.search(phrase)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    logger.info({"phrase_search": phrase, "hits": len(hits), "elapsed_ms": round(elapsed_ms, 2)})
+
+    # 画面表示側で参照元として扱えるよう、ヒットしたページをDocumentに変換
+    source_documents = []
+    for hit in hits:
+        metadata = {"source": hit["source"]}
+        if hit["page"] is not None:
+            metadata["page"] = hit["page"]
+        source_documents.append(Document(page_content=phrase, metadata=metadata))
+
+    return {
+        "query": user_message,
+        "result": "" if source_documents else ct.NO_DOC_MATCH_ANSWER,
+        "source_documents": source_documents
+    }
+
 
 def get_source_icon(file_path):
     """